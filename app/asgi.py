@@ -12,6 +12,7 @@ from loguru import logger
 from app.config import config
 from app.models.exception import HttpException
 from app.router import root_api_router
+from app.services.utils import media_probe, song_index
 from app.utils import utils
 
 
@@ -80,3 +81,7 @@ def shutdown_event():
 @app.on_event("startup")
 def startup_event():
     logger.info("startup event")
+    # index the songs added while the service was down, before the first GET /musics or random bgm needs them
+    song_index.refresh_in_background()
+    # drop the probe cache entries of the files deleted while the service was down
+    media_probe.prune_in_background()
@@ -65,6 +65,7 @@ proxy = _cfg.get("proxy", {})
 gemini = _cfg.get("gemini", {})
 azure = _cfg.get("azure", {})
 siliconflow = _cfg.get("siliconflow", {})
+encoding_profiles = _cfg.get("encoding_profiles", {})
 ui = _cfg.get(
     "ui",
     {
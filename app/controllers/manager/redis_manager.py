@@ -9,6 +9,8 @@ from app.services import task as tm
 
 FUNC_MAP = {
     "start": tm.start,
+    "promote": tm.promote,
+    "restyle": tm.restyle,
     # 'start_test': tm.start_test
 }
 
@@ -1,4 +1,4 @@
-import glob
+import json
 import os
 import pathlib
 import shutil
@@ -14,6 +14,7 @@ from app.controllers import base
 from app.controllers.manager.memory_manager import InMemoryTaskManager
 from app.controllers.manager.redis_manager import RedisTaskManager
 from app.controllers.v1.base import new_router
+from app.models import const
 from app.models.exception import HttpException
 from app.models.schema import (
     AudioRequest,
@@ -24,10 +25,13 @@ from app.models.schema import (
     TaskQueryRequest,
     TaskQueryResponse,
     TaskResponse,
+    TaskRestyleRequest,
+    TaskTimelineResponse,
     TaskVideoRequest,
 )
 from app.services import state as sm
 from app.services import task as tm
+from app.services.utils import song_index
 from app.utils import utils
 
 # 认证依赖项
@@ -149,6 +153,18 @@ def get_task(
             for v in combined_videos:
                 urls.append(file_to_uri(v))
             task["combined_videos"] = urls
+        if "preview_videos" in task:
+            preview_videos = task["preview_videos"]
+            urls = []
+            for v in preview_videos:
+                urls.append(file_to_uri(v))
+            task["preview_videos"] = urls
+        if "timelines" in task:
+            timelines = task["timelines"]
+            urls = []
+            for v in timelines:
+                urls.append(file_to_uri(v))
+            task["timelines"] = urls
         return utils.get_response(200, task)
 
     raise HttpException(
@@ -156,6 +172,109 @@ def get_task(
     )
 
 
+@router.get(
+    "/tasks/{task_id}/timeline",
+    response_model=TaskTimelineResponse,
+    summary="Get the edit decision lists of a task",
+)
+def get_task_timeline(
+    request: Request, task_id: str = Path(..., description="Task ID")
+):
+    request_id = base.get_task_id(request)
+    task = sm.state.get_task(task_id)
+    if not task:
+        raise HttpException(
+            task_id=task_id, status_code=404, message=f"{request_id}: task not found"
+        )
+
+    timelines = []
+    for timeline_file in task.get("timelines", []):
+        if not os.path.exists(timeline_file):
+            continue
+        with open(timeline_file, "r", encoding="utf-8") as f:
+            timelines.append(json.load(f))
+    return utils.get_response(200, {"timelines": timelines})
+
+
+@router.post(
+    "/tasks/{task_id}/promote",
+    response_model=TaskResponse,
+    summary="Render the full resolution videos of a preview task",
+)
+def promote_task(request: Request, task_id: str = Path(..., description="Task ID")):
+    request_id = base.get_task_id(request)
+    task = sm.state.get_task(task_id)
+    if not task:
+        raise HttpException(
+            task_id=task_id, status_code=404, message=f"{request_id}: task not found"
+        )
+    if task.get("state") != const.TASK_STATE_COMPLETE or not task.get("preview"):
+        raise HttpException(
+            task_id=task_id,
+            status_code=400,
+            message=f"{request_id}: task is not a completed preview",
+        )
+
+    # claimed before the work is queued, a concurrent promote or restyle of the task is refused
+    if not sm.state.transition_task(task_id, const.TASK_STATE_COMPLETE, const.TASK_STATE_PROCESSING):
+        raise HttpException(
+            task_id=task_id, status_code=409, message=f"{request_id}: task is being processed"
+        )
+    task_manager.add_task(tm.promote, task_id=task_id)
+    logger.success(f"Task promoted: {task_id}")
+    return utils.get_response(200, {"task_id": task_id, "request_id": request_id})
+
+
+@router.post(
+    "/tasks/{task_id}/restyle",
+    response_model=TaskResponse,
+    summary="Render the videos of a task again with new subtitle and audio styles",
+)
+def restyle_task(
+    request: Request,
+    body: TaskRestyleRequest,
+    task_id: str = Path(..., description="Task ID"),
+):
+    request_id = base.get_task_id(request)
+    task = sm.state.get_task(task_id)
+    if not task:
+        raise HttpException(
+            task_id=task_id, status_code=404, message=f"{request_id}: task not found"
+        )
+    if task.get("state") != const.TASK_STATE_COMPLETE or not task.get("videos"):
+        raise HttpException(
+            task_id=task_id,
+            status_code=400,
+            message=f"{request_id}: task has no completed videos",
+        )
+
+    style = body.model_dump(exclude_none=True)
+    if not style:
+        raise HttpException(
+            task_id=task_id, status_code=400, message=f"{request_id}: no style to change"
+        )
+    # the subtitles are rendered again over the combined videos, only the audio can be changed without them
+    combined_videos = task.get("combined_videos", [])
+    if not set(style).issubset(tm.audio_style_fields) and (
+        len(combined_videos) != len(task["videos"])
+        or not all(os.path.exists(v) for v in combined_videos)
+    ):
+        raise HttpException(
+            task_id=task_id,
+            status_code=400,
+            message=f"{request_id}: task has no combined videos, only the audio style can be changed",
+        )
+
+    # claimed before the work is queued, a concurrent promote or restyle of the task is refused
+    if not sm.state.transition_task(task_id, const.TASK_STATE_COMPLETE, const.TASK_STATE_PROCESSING):
+        raise HttpException(
+            task_id=task_id, status_code=409, message=f"{request_id}: task is being processed"
+        )
+    task_manager.add_task(tm.restyle, task_id=task_id, style=style)
+    logger.success(f"Task restyled: {task_id}")
+    return utils.get_response(200, {"task_id": task_id, "request_id": request_id})
+
+
 @router.delete(
     "/tasks/{task_id}",
     response_model=TaskDeletionResponse,
@@ -183,16 +302,17 @@ def delete_video(request: Request, task_id: str = Path(..., description="Task ID
     "/musics", response_model=BgmRetrieveResponse, summary="Retrieve local BGM files"
 )
 def get_bgm_list(request: Request):
-    suffix = "*.mp3"
-    song_dir = utils.song_dir()
-    files = glob.glob(os.path.join(song_dir, suffix))
+    # served from the song index, the files are only analyzed when the songs directory changes
     bgm_list = []
-    for file in files:
+    for song in song_index.songs():
         bgm_list.append(
             {
-                "name": os.path.basename(file),
-                "size": os.path.getsize(file),
-                "file": file,
+                "name": song["name"],
+                "size": song["size"],
+                "file": song["file"],
+                "duration": song["duration"],
+                "sample_rate": song["sample_rate"],
+                "loudness": song["loudness"],
             }
         )
     response = {"files": bgm_list}
@@ -215,6 +335,10 @@ def upload_bgm_file(request: Request, file: UploadFile = File(...)):
             # If the file already exists, it will be overwritten
             file.file.seek(0)
             buffer.write(file.file.read())
+        try:
+            song_index.add(save_path)
+        except Exception as e:
+            logger.warning(f"failed to index the uploaded bgm: {save_path} => {str(e)}")
         response = {"file": save_path}
         return utils.get_response(200, response)
 
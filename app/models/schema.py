@@ -27,6 +27,22 @@ class VideoTransitionMode(str, Enum):
     slide_out = "SlideOut"
 
 
+class VideoRenderMode(str, Enum):
+    # combine the materials into combined-N.mp4, then render the final video from it
+    standard = "standard"
+    # render the materials, subtitles and audio into the final video in a single encode
+    fused = "fused"
+
+
+class SubtitleMode(str, Enum):
+    # draw the subtitles into the frames
+    burn = "burn"
+    # mux the subtitles as a text track, the frames are left as they are
+    soft = "soft"
+    # burn the subtitles in and mux them as a text track
+    both = "both"
+
+
 class VideoAspect(str, Enum):
     landscape = "16:9"
     portrait = "9:16"
@@ -76,6 +92,9 @@ class VideoParams(BaseModel):
     video_transition_mode: Optional[VideoTransitionMode] = None
     video_clip_duration: Optional[int] = 5
     video_count: Optional[int] = 1
+    video_render_mode: Optional[VideoRenderMode] = VideoRenderMode.standard.value
+    video_encoding_profile: Optional[str] = "standard"  # draft, standard, archive
+    video_preview: Optional[bool] = False  # render a low resolution proxy, see POST /tasks/{task_id}/promote
 
     video_source: Optional[str] = "pexels"
     video_materials: Optional[List[MaterialInfo]] = (
@@ -92,6 +111,7 @@ class VideoParams(BaseModel):
     bgm_volume: Optional[float] = 0.2
 
     subtitle_enabled: Optional[bool] = True
+    subtitle_mode: Optional[SubtitleMode] = SubtitleMode.burn.value  # burn, soft, both
     subtitle_position: Optional[str] = "bottom"  # top, bottom, center
     custom_position: float = 70.0
     font_name: Optional[str] = "STHeitiMedium.ttc"
@@ -181,6 +201,28 @@ class TaskQueryRequest(BaseModel):
     pass
 
 
+class TaskRestyleRequest(BaseModel):
+    """
+    The subtitle and audio styles to change, the fields left out keep the values of the task.
+    """
+
+    voice_volume: Optional[float] = None
+    bgm_type: Optional[str] = None
+    bgm_file: Optional[str] = None
+    bgm_volume: Optional[float] = None
+
+    subtitle_enabled: Optional[bool] = None
+    subtitle_mode: Optional[SubtitleMode] = None
+    subtitle_position: Optional[str] = None
+    custom_position: Optional[float] = None
+    font_name: Optional[str] = None
+    text_fore_color: Optional[str] = None
+    text_background_color: Optional[Union[bool, str]] = None
+    font_size: Optional[int] = None
+    stroke_color: Optional[str] = None
+    stroke_width: Optional[float] = None
+
+
 class VideoScriptRequest(VideoScriptParams, BaseModel):
     pass
 
@@ -229,6 +271,32 @@ class TaskQueryResponse(BaseResponse):
         }
 
 
+class TaskTimelineResponse(BaseResponse):
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "status": 200,
+                "message": "success",
+                "data": {
+                    "timelines": [
+                        [
+                            {
+                                "slot": 1,
+                                "start": 0.0,
+                                "duration": 5.0,
+                                "source": "/MoneyPrinterTurbo/storage/cache_videos/vid-1.mp4",
+                                "in": 0,
+                                "out": 5,
+                                "transition": "FadeIn",
+                                "side": "",
+                            }
+                        ]
+                    ]
+                },
+            },
+        }
+
+
 class TaskDeletionResponse(BaseResponse):
     class Config:
         json_schema_extra = {
@@ -285,6 +353,9 @@ class BgmRetrieveResponse(BaseResponse):
                             "name": "output013.mp3",
                             "size": 1891269,
                             "file": "/MoneyPrinterTurbo/resource/songs/output013.mp3",
+                            "duration": 118.19,
+                            "sample_rate": 44100,
+                            "loudness": -19.8,
                         }
                     ]
                 },
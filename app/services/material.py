@@ -1,14 +1,18 @@
 import os
 import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 from urllib.parse import urlencode
 
 import requests
 from loguru import logger
-from moviepy.video.io.VideoFileClip import VideoFileClip
 
 from app.config import config
 from app.models.schema import MaterialInfo, VideoAspect, VideoConcatMode
+from app.services.utils import media_probe
 from app.utils import utils
 
 requested_count = 0
@@ -144,12 +148,128 @@ def search_videos_pixabay(
     return []
 
 
-def save_video(video_url: str, save_dir: str = "") -> str:
+class DownloadStats:
+    """
+    Counters of the material downloads of a task, the bytes and seconds of the successful attempts give the speed.
+    """
+
+    def __init__(self):
+        self.downloads = 0
+        self.failures = 0
+        self.retries = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, size: int, seconds: float):
+        with self._lock:
+            self.downloads += 1
+            self.bytes += size
+            self.seconds += seconds
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "downloads": self.downloads,
+                "failures": self.failures,
+                "retries": self.retries,
+                "bytes": self.bytes,
+                "bytes_per_second": int(self.bytes / self.seconds) if self.seconds else 0,
+            }
+
+
+# a download holds one chunk in memory at a time, whatever the size of the video
+download_chunk_size = 1024 * 1024
+# a temp file of a download that was not written for this many seconds was left by a crash
+stale_temp_file_age = 3600
+
+
+class IncompleteDownloadError(IOError):
+    pass
+
+
+def is_retryable(e: Exception) -> bool:
+    """
+    Whether a failed download may succeed when it is tried again: a connection error, a timeout, a response cut short,
+    or a server error or rate limit. A 4xx response, e.g. a deleted video, fails the same way every time.
+    """
+    if isinstance(e, requests.HTTPError):
+        status_code = e.response.status_code if e.response is not None else 0
+        return status_code == 429 or status_code >= 500
+    return isinstance(e, (requests.ConnectionError, requests.Timeout, IncompleteDownloadError))
+
+
+def delete_stale_temp_files(save_dir: str):
+    """
+    Delete the temp files of the downloads that were interrupted by a crash, see save_video().
+    """
+    try:
+        names = os.listdir(save_dir)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if not name.endswith(".tmp"):
+            continue
+        file_path = os.path.join(save_dir, name)
+        try:
+            if time.time() - os.path.getmtime(file_path) > stale_temp_file_age:
+                logger.info(f"deleting the temp file of an interrupted download: {file_path}")
+                os.remove(file_path)
+        except Exception:
+            pass
+
+
+def fetch_video(video_url: str, output_file: str) -> int:
+    """
+    Stream the video into output_file in chunks of download_chunk_size, returns the number of bytes written.
+    Raises an exception if the request fails or the response is cut short.
+    """
+    headers = {
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36"
+    }
+    with requests.get(
+        video_url,
+        headers=headers,
+        proxies=config.proxy,
+        verify=False,
+        timeout=(60, 240),
+        stream=True,
+    ) as r:
+        r.raise_for_status()
+        # the length of the encoded body, it can only be checked when the body is not decoded
+        expected_size = 0
+        if not r.headers.get("Content-Encoding"):
+            expected_size = int(r.headers.get("Content-Length") or 0)
+        size = 0
+        with open(output_file, "wb") as f:
+            for chunk in r.iter_content(chunk_size=download_chunk_size):
+                f.write(chunk)
+                size += len(chunk)
+    if expected_size and size != expected_size:
+        raise IncompleteDownloadError(f"incomplete download, {size} of {expected_size} bytes")
+    return size
+
+
+def save_video(video_url: str, save_dir: str = "", stats: DownloadStats = None) -> str:
+    """
+    Download the video to save_dir, or find it there, returns its path or "" if it is not a valid video.
+    Connection errors, timeouts and server errors are retried, the other failures raise an exception at once.
+    The downloads are counted in stats.
+    """
+    stats = stats or DownloadStats()
     if not save_dir:
         save_dir = utils.storage_dir("cache_videos")
 
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
+    # concurrent downloads may create it at the same time
+    os.makedirs(save_dir, exist_ok=True)
 
     url_without_query = video_url.split("?")[0]
     url_hash = utils.md5(url_without_query)
@@ -161,39 +281,109 @@ def save_video(video_url: str, save_dir: str = "") -> str:
         logger.info(f"video already exists: {video_path}")
         return video_path
 
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36"
-    }
-
-    # if video does not exist, download it
-    with open(video_path, "wb") as f:
-        f.write(
-            requests.get(
-                video_url,
-                headers=headers,
-                proxies=config.proxy,
-                verify=False,
-                timeout=(60, 240),
-            ).content
-        )
-
-    if os.path.exists(video_path) and os.path.getsize(video_path) > 0:
+    # the video is only moved to video_path once it is complete and valid,
+    # a crash or a concurrent reader never sees a partial file there
+    temp_file = f"{video_path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    retries = config.app.get("material_download_retries", 2)
+    for attempt in range(retries + 1):
+        if attempt:
+            stats.record_retry()
+            time.sleep(min(2 ** (attempt - 1), 10))
+        start = time.monotonic()
         try:
-            clip = VideoFileClip(video_path)
-            duration = clip.duration
-            fps = clip.fps
-            clip.close()
-            if duration > 0 and fps > 0:
-                return video_path
+            size = fetch_video(video_url, temp_file)
         except Exception as e:
-            try:
-                os.remove(video_path)
-            except Exception:
-                pass
-            logger.warning(f"invalid video file: {video_path} => {str(e)}")
+            delete_file(temp_file)
+            logger.warning(f"failed to download video, attempt {attempt + 1} of {retries + 1}: {video_url} => {str(e)}")
+            if attempt == retries or not is_retryable(e):
+                stats.record_failure()
+                raise
+            continue
+        seconds = time.monotonic() - start
+        stats.record(size, seconds)
+        logger.debug(f"downloaded {size} bytes in {seconds:.2f} seconds: {video_url}")
+        break
+
+    try:
+        infos = media_probe.read_infos(temp_file)
+        if infos["duration"] > 0 and infos["fps"] > 0:
+            os.replace(temp_file, video_path)
+            return video_path
+        logger.warning(f"invalid video file: {video_path} => duration: {infos['duration']}, fps: {infos['fps']}")
+    except Exception as e:
+        logger.warning(f"invalid video file: {video_path} => {str(e)}")
+    delete_file(temp_file)
     return ""
 
 
+def delete_file(file_path: str):
+    try:
+        os.remove(file_path)
+    except Exception:
+        pass
+
+
+def download_items(
+    video_items: List[MaterialInfo],
+    save_dir: str = "",
+    audio_duration: float = 0.0,
+    max_clip_duration: int = 5,
+    workers: int = 1,
+    stats: DownloadStats = None,
+) -> List[str]:
+    """
+    Download the videos in order until their clips cover audio_duration, with up to workers downloads at a time.
+    The results are taken in the order of video_items, so the same videos are returned, in the same order, as by
+    downloading them one after another. A download only starts while the ones in flight may not be enough,
+    and the downloads that did not start are cancelled once the duration is covered.
+    The downloads are counted in stats.
+    """
+    stats = stats or DownloadStats()
+    delete_stale_temp_files(save_dir or utils.storage_dir("cache_videos"))
+    video_paths = []
+    total_duration = 0.0
+    # the downloads in flight with the clip duration they add, in the order of video_items
+    pending = deque()
+    items = iter(video_items)
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        while True:
+            # the pending downloads would already be enough if they all succeed
+            pending_duration = sum(seconds for _, _, seconds in pending)
+            while len(pending) < max(1, workers) and total_duration + pending_duration <= audio_duration:
+                item = next(items, None)
+                if item is None:
+                    break
+                logger.info(f"downloading video: {item.url}")
+                seconds = min(max_clip_duration, item.duration)
+                pending.append((item, executor.submit(save_video, video_url=item.url, save_dir=save_dir, stats=stats), seconds))
+                pending_duration += seconds
+            if not pending:
+                break
+
+            item, future, seconds = pending.popleft()
+            try:
+                saved_video_path = future.result()
+            except Exception as e:
+                logger.error(f"failed to download video: {utils.to_json(item)} => {str(e)}")
+                continue
+            if not saved_video_path:
+                continue
+            logger.info(f"video saved: {saved_video_path}")
+            video_paths.append(saved_video_path)
+            total_duration += seconds
+            if total_duration > audio_duration:
+                logger.info(
+                    f"total duration of downloaded videos: {total_duration} seconds, skip downloading more"
+                )
+                break
+    finally:
+        # the downloads already running finish in the background, their videos are kept in the cache
+        executor.shutdown(wait=False, cancel_futures=True)
+    logger.info(f"material downloads: {stats.stats()}")
+    return video_paths
+
+
 def download_videos(
     task_id: str,
     search_terms: List[str],
@@ -202,6 +392,7 @@ def download_videos(
     video_contact_mode: VideoConcatMode = VideoConcatMode.random,
     audio_duration: float = 0.0,
     max_clip_duration: int = 5,
+    stats: DownloadStats = None,
 ) -> List[str]:
     valid_video_items = []
     valid_video_urls = []
@@ -227,8 +418,6 @@ def download_videos(
     logger.info(
         f"found total videos: {len(valid_video_items)}, required duration: {audio_duration} seconds, found duration: {found_duration} seconds"
     )
-    video_paths = []
-
     material_directory = config.app.get("material_directory", "").strip()
     if material_directory == "task":
         material_directory = utils.task_dir(task_id)
@@ -238,25 +427,14 @@ def download_videos(
     if video_contact_mode.value == VideoConcatMode.random.value:
         random.shuffle(valid_video_items)
 
-    total_duration = 0.0
-    for item in valid_video_items:
-        try:
-            logger.info(f"downloading video: {item.url}")
-            saved_video_path = save_video(
-                video_url=item.url, save_dir=material_directory
-            )
-            if saved_video_path:
-                logger.info(f"video saved: {saved_video_path}")
-                video_paths.append(saved_video_path)
-                seconds = min(max_clip_duration, item.duration)
-                total_duration += seconds
-                if total_duration > audio_duration:
-                    logger.info(
-                        f"total duration of downloaded videos: {total_duration} seconds, skip downloading more"
-                    )
-                    break
-        except Exception as e:
-            logger.error(f"failed to download video: {utils.to_json(item)} => {str(e)}")
+    video_paths = download_items(
+        valid_video_items,
+        save_dir=material_directory,
+        audio_duration=audio_duration,
+        max_clip_duration=max_clip_duration,
+        workers=config.app.get("material_download_workers", 4),
+        stats=stats,
+    )
     logger.success(f"downloaded {len(video_paths)} videos")
     return video_paths
 
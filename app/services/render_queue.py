@@ -0,0 +1,157 @@
+import json
+import os
+import socket
+import time
+import uuid
+from typing import List
+
+import redis
+from loguru import logger
+
+from app.config import config
+from app.models.schema import VideoParams
+from app.services import video
+
+# the segments waiting for a worker, shared by every render of the fleet
+queue_name = "render_segment_queue"
+# each render collects the results of its segments in its own list
+results_prefix = "render_segment_results"
+# results nobody collects, e.g. of a render that timed out, are dropped after a day
+results_ttl = 24 * 3600
+
+
+def redis_url() -> str:
+    host = config.app.get("redis_host", "localhost")
+    port = config.app.get("redis_port", 6379)
+    db = config.app.get("redis_db", 0)
+    password = config.app.get("redis_password", None)
+    return f"redis://:{password}@{host}:{port}/{db}"
+
+
+def get_client() -> redis.Redis:
+    return redis.Redis.from_url(redis_url())
+
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def dump_segment_job(job: dict, job_id: str, index: int) -> str:
+    data = dict(job, job_id=job_id, index=index)
+    data["timeline"] = video.dump_timeline(job["timeline"])
+    # the enum fields default to their plain values, e.g. "random", which are dumped as they are without a warning
+    data["params"] = job["params"].model_dump(mode="json", warnings=False)
+    return json.dumps(data)
+
+
+def load_segment_job(payload) -> dict:
+    job = json.loads(payload)
+    job["timeline"] = video.load_timeline(job["timeline"])
+    job["params"] = VideoParams(**job["params"])
+    return job
+
+
+def process_next(client: redis.Redis, timeout: int = 0) -> bool:
+    """
+    Render the next segment of the queue and report it to its render.
+    Waits up to timeout seconds for one, 0 returns at once. Returns False if the queue was empty.
+    """
+    if timeout:
+        popped = client.blpop([queue_name], timeout=timeout)
+        payload = popped[1] if popped else None
+    else:
+        payload = client.lpop(queue_name)
+    if payload is None:
+        return False
+
+    job = load_segment_job(payload)
+    job_id = job.pop("job_id")
+    index = job.pop("index")
+    result = {"index": index, "output_file": job["output_file"], "worker": worker_name(), "ok": False, "error": ""}
+    logger.info(f"rendering segment {index+1} of {job_id}: {job['output_file']}")
+    try:
+        result["ok"] = bool(video.render_segment(**job))
+    except Exception as e:
+        logger.error(f"failed to render segment {index+1} of {job_id}: {str(e)}")
+        result["error"] = str(e)
+
+    results_key = f"{results_prefix}:{job_id}"
+    client.rpush(results_key, json.dumps(result))
+    client.expire(results_key, results_ttl)
+    return True
+
+
+def render_segments(segment_jobs: List[dict], timeout: int = 0) -> List[str]:
+    """
+    Push the segments to the Redis queue and wait for the worker nodes to render them, the output files must be
+    on a storage directory shared by the nodes. The coordinator renders segments of the queue too while it waits,
+    so a render completes without any worker. Segments that failed or are still missing after timeout seconds,
+    e.g. taken by a node that went down, are rendered locally.
+    Returns the segment files in order.
+    """
+    timeout = timeout or config.app.get("render_segment_timeout", 1800)
+    client = get_client()
+    job_id = uuid.uuid4().hex
+    results_key = f"{results_prefix}:{job_id}"
+    payloads = [dump_segment_job(job, job_id, i) for i, job in enumerate(segment_jobs)]
+    client.rpush(queue_name, *payloads)
+    logger.info(f"queued {len(payloads)} segments of {job_id}")
+
+    segment_files = [""] * len(segment_jobs)
+    pending = set(range(len(segment_jobs)))
+    deadline = time.monotonic() + timeout
+    try:
+        while pending and time.monotonic() < deadline:
+            result = client.lpop(results_key)
+            if result is None:
+                # help with the queue instead of idling, the next segment may be this render's or another one's
+                if process_next(client):
+                    continue
+                popped = client.blpop([results_key], timeout=1)
+                if popped is None:
+                    continue
+                result = popped[1]
+
+            result = json.loads(result)
+            pending.discard(result["index"])
+            if result["ok"]:
+                segment_files[result["index"]] = result["output_file"]
+                logger.debug(f"segment {result['index']+1} of {job_id} rendered by {result['worker']}")
+            else:
+                logger.warning(f"segment {result['index']+1} of {job_id} failed on {result['worker']}: {result['error']}")
+    finally:
+        # nobody renders what is left of this render once it stops waiting
+        for payload in payloads:
+            client.lrem(queue_name, 0, payload)
+        client.delete(results_key)
+
+    for i, job in enumerate(segment_jobs):
+        if segment_files[i]:
+            continue
+        logger.warning(f"segment {i+1} of {job_id} is missing, rendering it locally")
+        # a late worker may still write the original file
+        local_file = job["output_file"].replace(".mp4", "-local.mp4")
+        segment_files[i] = video.render_segment(**dict(job, output_file=local_file))
+    return segment_files
+
+
+def run_worker(max_jobs: int = 0, idle_timeout: int = 0) -> int:
+    """
+    Render the segments of the queue until max_jobs are done, or the queue stayed empty for idle_timeout seconds,
+    0 runs forever. Returns the number of segments processed.
+    """
+    client = get_client()
+    logger.info(f"render worker {worker_name()} waiting for segments on {queue_name}")
+    processed = 0
+    idle_since = time.monotonic()
+    while not max_jobs or processed < max_jobs:
+        if process_next(client, timeout=1):
+            processed += 1
+            idle_since = time.monotonic()
+        elif idle_timeout and time.monotonic() - idle_since >= idle_timeout:
+            break
+    return processed
+
+
+if __name__ == "__main__":
+    run_worker()
@@ -1,4 +1,5 @@
 import ast
+import threading
 from abc import ABC, abstractmethod
 
 from app.config import config
@@ -19,11 +20,20 @@ class BaseState(ABC):
     def get_all_tasks(self, page: int, page_size: int):
         pass
 
+    @abstractmethod
+    def transition_task(self, task_id: str, from_state: int, to_state: int) -> bool:
+        """
+        Set the state of the task to to_state only if it is from_state, in one atomic step, the other fields are kept.
+        Returns False if the task is missing or in another state, e.g. claimed by a concurrent request.
+        """
+        pass
+
 
 # Memory state management
 class MemoryState(BaseState):
     def __init__(self):
         self._tasks = {}
+        self._lock = threading.Lock()
 
     def get_all_tasks(self, page: int, page_size: int):
         start = (page - 1) * page_size
@@ -50,6 +60,14 @@ class MemoryState(BaseState):
             **kwargs,
         }
 
+    def transition_task(self, task_id: str, from_state: int, to_state: int) -> bool:
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if not task or task.get("state") != from_state:
+                return False
+            self._tasks[task_id] = {**task, "state": to_state}
+            return True
+
     def get_task(self, task_id: str):
         return self._tasks.get(task_id, None)
 
@@ -108,6 +126,17 @@ class RedisState(BaseState):
         for field, value in fields.items():
             self._redis.hset(task_id, field, str(value))
 
+    def transition_task(self, task_id: str, from_state: int, to_state: int) -> bool:
+        # the state is compared and set by the redis server, no other client runs in between
+        script = """
+        if redis.call('hget', KEYS[1], 'state') == ARGV[1] then
+            redis.call('hset', KEYS[1], 'state', ARGV[2])
+            return 1
+        end
+        return 0
+        """
+        return bool(self._redis.eval(script, 1, task_id, str(from_state), str(to_state)))
+
     def get_task(self, task_id: str):
         task_data = self._redis.hgetall(task_id)
         if not task_data:
@@ -1,13 +1,17 @@
+import json
 import math
+import multiprocessing
 import os.path
+import random
 import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from os import path
 
 from loguru import logger
 
 from app.config import config
 from app.models import const
-from app.models.schema import VideoConcatMode, VideoParams
+from app.models.schema import VideoConcatMode, VideoParams, VideoRenderMode
 from app.services import llm, material, subtitle, video, voice
 from app.services import state as sm
 from app.utils import utils
@@ -58,12 +62,14 @@ def generate_terms(task_id, params, video_script):
     return video_terms
 
 
-def save_script_data(task_id, video_script, video_terms, params):
+def save_script_data(task_id, video_script, video_terms, params, seed=None, bgm_files=None):
     script_file = path.join(utils.task_dir(task_id), "script.json")
     script_data = {
         "script": video_script,
         "search_terms": video_terms,
         "params": params,
+        "seed": seed,
+        "bgm_files": bgm_files or [],
     }
 
     with open(script_file, "w", encoding="utf-8") as f:
@@ -123,7 +129,7 @@ def generate_subtitle(task_id, params, video_script, sub_maker, audio_file):
     return subtitle_path
 
 
-def get_video_materials(task_id, params, video_terms, audio_duration):
+def get_video_materials(task_id, params, video_terms, audio_duration, download_stats=None):
     if params.video_source == "local":
         logger.info("\n\n## preprocess local materials")
         materials = video.preprocess_video(
@@ -146,6 +152,7 @@ def get_video_materials(task_id, params, video_terms, audio_duration):
             video_contact_mode=params.video_concat_mode,
             audio_duration=audio_duration * params.video_count,
             max_clip_duration=params.video_clip_duration,
+            stats=download_stats,
         )
         if not downloaded_videos:
             sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
@@ -156,8 +163,29 @@ def get_video_materials(task_id, params, video_terms, audio_duration):
         return downloaded_videos
 
 
+def resolve_bgm_files(params, seed=None):
+    """
+    Pick the bgm of each variant. The picks have their own rng, so they do not depend on how many draws the
+    clips and transitions took, and they are saved in script.json for the promotions and restyles of the task.
+    """
+    bgm_files = []
+    for i in range(params.video_count):
+        rng = random.Random(f"{seed}-{i + 1}-bgm") if seed is not None else None
+        bgm_files.append(video.get_bgm_file(bgm_type=params.bgm_type, bgm_file=params.bgm_file, rng=rng))
+    return bgm_files
+
+
+def variant_params(params, bgm_file):
+    """
+    The params of a variant rendered with the bgm picked for it.
+    """
+    if not bgm_file:
+        return params
+    return params.model_copy(update={"bgm_file": bgm_file})
+
+
 def generate_final_videos(
-    task_id, params, downloaded_videos, audio_file, subtitle_path
+    task_id, params, downloaded_videos, audio_file, subtitle_path, seed=None, bgm_files=None
 ):
     final_video_paths = []
     combined_video_paths = []
@@ -166,15 +194,69 @@ def generate_final_videos(
     )
     video_transition_mode = params.video_transition_mode
 
-    _progress = 50
+    # previews are written next to the final videos, so promoting a preview keeps it
+    output_prefix = "preview" if params.video_preview else "final"
+
+    if not bgm_files or len(bgm_files) != params.video_count:
+        bgm_files = resolve_bgm_files(params, seed)
+
+    variants = []
     for i in range(params.video_count):
         index = i + 1
-        combined_video_path = path.join(
-            utils.task_dir(task_id), f"combined-{index}.mp4"
+        variants.append(
+            {
+                "index": index,
+                "params": variant_params(params, bgm_files[i]),
+                # the same seed picks the same clips, transitions and bgm, e.g. when a preview is promoted
+                "rng": random.Random(f"{seed}-{index}") if seed is not None else None,
+                "combined_video_path": path.join(
+                    utils.task_dir(task_id), f"combined-{index}.mp4"
+                ),
+                "final_video_path": path.join(
+                    utils.task_dir(task_id), f"{output_prefix}-{index}.mp4"
+                ),
+                # the edit decision list of the video, a promoted preview keeps the same timeline
+                "timeline_path": path.join(
+                    utils.task_dir(task_id), f"timeline-{index}.json"
+                ),
+            }
         )
-        logger.info(f"\n\n## combining video: {index} => {combined_video_path}")
+    timeline_paths = [variant["timeline_path"] for variant in variants]
+
+    _progress = 50
+    if params.video_render_mode == VideoRenderMode.fused:
+        for variant in variants:
+            index = variant["index"]
+            final_video_path = variant["final_video_path"]
+            combined_video_path = variant["combined_video_path"]
+            if not config.app.get("keep_combined_video", False):
+                combined_video_path = ""
+            logger.info(f"\n\n## generating video in a single pass: {index} => {final_video_path}")
+            video.generate_video_fused(
+                video_paths=downloaded_videos,
+                audio_path=audio_file,
+                subtitle_path=subtitle_path,
+                output_file=final_video_path,
+                params=variant["params"],
+                video_concat_mode=video_concat_mode,
+                combined_video_path=combined_video_path,
+                rng=variant["rng"],
+                timeline_file=variant["timeline_path"],
+            )
+
+            _progress += 50 / params.video_count
+            sm.state.update_task(task_id, progress=_progress)
+
+            final_video_paths.append(final_video_path)
+            if combined_video_path:
+                combined_video_paths.append(combined_video_path)
+        return final_video_paths, combined_video_paths, timeline_paths
+
+    combined_video_paths = [variant["combined_video_path"] for variant in variants]
+    if params.video_count == 1:
+        logger.info(f"\n\n## combining video: 1 => {combined_video_paths[0]}")
         video.combine_videos(
-            combined_video_path=combined_video_path,
+            combined_video_path=combined_video_paths[0],
             video_paths=downloaded_videos,
             audio_file=audio_file,
             video_aspect=params.video_aspect,
@@ -182,29 +264,67 @@ def generate_final_videos(
             video_transition_mode=video_transition_mode,
             max_clip_duration=params.video_clip_duration,
             threads=params.n_threads,
+            encoding_profile=video.get_final_encoding_profile(params)["name"],
+            preview=params.video_preview,
+            rng=variants[0]["rng"],
+            timeline_file=timeline_paths[0],
         )
-
-        _progress += 50 / params.video_count / 2
-        sm.state.update_task(task_id, progress=_progress)
-
-        final_video_path = path.join(utils.task_dir(task_id), f"final-{index}.mp4")
-
-        logger.info(f"\n\n## generating video: {index} => {final_video_path}")
-        video.generate_video(
-            video_path=combined_video_path,
-            audio_path=audio_file,
-            subtitle_path=subtitle_path,
-            output_file=final_video_path,
-            params=params,
+    else:
+        # the variants share the normalized clips, only their order differs
+        logger.info(f"\n\n## combining {params.video_count} videos from a shared pool of clips")
+        video.combine_video_variants(
+            combined_video_paths=combined_video_paths,
+            video_paths=downloaded_videos,
+            audio_file=audio_file,
+            video_aspect=params.video_aspect,
+            video_transition_mode=video_transition_mode,
+            max_clip_duration=params.video_clip_duration,
+            threads=params.n_threads,
+            encoding_profile=video.get_final_encoding_profile(params)["name"],
+            preview=params.video_preview,
+            rngs=[variant["rng"] for variant in variants],
+            timeline_files=timeline_paths,
         )
 
-        _progress += 50 / params.video_count / 2
-        sm.state.update_task(task_id, progress=_progress)
-
-        final_video_paths.append(final_video_path)
-        combined_video_paths.append(combined_video_path)
+    _progress += 25
+    sm.state.update_task(task_id, progress=_progress)
+
+    render_jobs = []
+    for variant in variants:
+        render_jobs.append(
+            {
+                "video_path": variant["combined_video_path"],
+                "audio_path": audio_file,
+                "subtitle_path": subtitle_path,
+                "output_file": variant["final_video_path"],
+                "params": variant["params"],
+                "rng": variant["rng"],
+            }
+        )
 
-    return final_video_paths, combined_video_paths
+    variant_workers = min(config.app.get("variant_workers", 1), params.video_count)
+    if variant_workers <= 1:
+        for index, render_job in enumerate(render_jobs, 1):
+            logger.info(f"\n\n## generating video: {index} => {render_job['output_file']}")
+            video.generate_video(**render_job)
+            _progress += 25 / params.video_count
+            sm.state.update_task(task_id, progress=_progress)
+    else:
+        logger.info(f"\n\n## generating {params.video_count} videos with {variant_workers} workers")
+        with ProcessPoolExecutor(
+            max_workers=variant_workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            futures = [
+                executor.submit(video.generate_video, **render_job)
+                for render_job in render_jobs
+            ]
+            for future in as_completed(futures):
+                future.result()
+                _progress += 25 / params.video_count
+                sm.state.update_task(task_id, progress=_progress)
+
+    final_video_paths = [variant["final_video_path"] for variant in variants]
+    return final_video_paths, combined_video_paths, timeline_paths
 
 
 def start(task_id, params: VideoParams, stop_at: str = "video"):
@@ -236,7 +356,9 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
             sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
             return
 
-    save_script_data(task_id, video_script, video_terms, params)
+    seed = random.randrange(2**32)
+    bgm_files = resolve_bgm_files(params, seed)
+    save_script_data(task_id, video_script, video_terms, params, seed, bgm_files)
 
     if stop_at == "terms":
         sm.state.update_task(
@@ -282,11 +404,14 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
     sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=40)
 
     # 5. Get video materials
+    download_stats = material.DownloadStats()
     downloaded_videos = get_video_materials(
-        task_id, params, video_terms, audio_duration
+        task_id, params, video_terms, audio_duration, download_stats
     )
     if not downloaded_videos:
-        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+        sm.state.update_task(
+            task_id, state=const.TASK_STATE_FAILED, download_stats=download_stats.stats()
+        )
         return
 
     if stop_at == "materials":
@@ -295,14 +420,15 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
             state=const.TASK_STATE_COMPLETE,
             progress=100,
             materials=downloaded_videos,
+            download_stats=download_stats.stats(),
         )
-        return {"materials": downloaded_videos}
+        return {"materials": downloaded_videos, "download_stats": download_stats.stats()}
 
     sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=50)
 
     # 6. Generate final videos
-    final_video_paths, combined_video_paths = generate_final_videos(
-        task_id, params, downloaded_videos, audio_file, subtitle_path
+    final_video_paths, combined_video_paths, timeline_paths = generate_final_videos(
+        task_id, params, downloaded_videos, audio_file, subtitle_path, seed, bgm_files
     )
 
     if not final_video_paths:
@@ -316,13 +442,201 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
     kwargs = {
         "videos": final_video_paths,
         "combined_videos": combined_video_paths,
+        "timelines": timeline_paths,
         "script": video_script,
         "terms": video_terms,
         "audio_file": audio_file,
         "audio_duration": audio_duration,
         "subtitle_path": subtitle_path,
         "materials": downloaded_videos,
+        "download_stats": download_stats.stats(),
+        "preview": params.video_preview,
+    }
+    sm.state.update_task(
+        task_id, state=const.TASK_STATE_COMPLETE, progress=100, **kwargs
+    )
+    return kwargs
+
+
+def promote(task_id):
+    """
+    Render the full resolution videos of a preview task, reusing its script, audio, subtitles,
+    downloaded materials and the clips, transitions and bgm picked for the preview.
+    """
+    logger.info(f"promote task: {task_id}")
+    task = sm.state.get_task(task_id)
+    script_file = path.join(utils.task_dir(task_id), "script.json")
+    if not task or not task.get("materials") or not os.path.exists(script_file):
+        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+        logger.error(f"task {task_id} has no preview to promote.")
+        return
+
+    with open(script_file, "r", encoding="utf-8") as f:
+        script_data = json.load(f)
+    params = VideoParams(**script_data["params"])
+    params.video_preview = False
+    if type(params.video_concat_mode) is str:
+        params.video_concat_mode = VideoConcatMode(params.video_concat_mode)
+
+    # keep the results of the preview, the state is replaced on every update
+    kwargs = {
+        k: v for k, v in task.items() if k not in ["task_id", "state", "progress"]
+    }
+    sm.state.update_task(
+        task_id, state=const.TASK_STATE_PROCESSING, progress=50, **kwargs
+    )
+
+    try:
+        final_video_paths, combined_video_paths, timeline_paths = generate_final_videos(
+            task_id,
+            params,
+            task["materials"],
+            task["audio_file"],
+            task["subtitle_path"],
+            script_data.get("seed"),
+            script_data.get("bgm_files"),
+        )
+    except Exception as e:
+        logger.error(f"failed to promote task {task_id}: {str(e)}")
+        final_video_paths = []
+
+    if not final_video_paths:
+        # the preview videos are written to other files, they are kept
+        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED, **kwargs)
+        return
+
+    # later restyles render the promoted videos at full resolution
+    save_script_data(
+        task_id,
+        script_data["script"],
+        script_data["search_terms"],
+        params,
+        script_data.get("seed"),
+        script_data.get("bgm_files"),
+    )
+
+    logger.success(
+        f"task {task_id} promoted, generated {len(final_video_paths)} videos."
+    )
+
+    kwargs.update(
+        {
+            "videos": final_video_paths,
+            "combined_videos": combined_video_paths,
+            "timelines": timeline_paths,
+            "preview_videos": task.get("videos", []),
+            "preview": False,
+        }
+    )
+    sm.state.update_task(
+        task_id, state=const.TASK_STATE_COMPLETE, progress=100, **kwargs
+    )
+    return kwargs
+
+
+# the style fields that only change the audio, restyling them keeps the video streams of the final videos
+audio_style_fields = {"voice_volume", "bgm_type", "bgm_file", "bgm_volume"}
+
+
+def restyle(task_id, style: dict):
+    """
+    Render the final videos of a completed task again with new subtitle and audio styles, reusing its
+    combined videos, audio and subtitles. When only audio_style_fields changed, the new audio is muxed
+    next to the video streams of the final videos, without rendering them again.
+    The bgm picked for each video at render time is kept unless the bgm_type or bgm_file changed.
+    """
+    logger.info(f"restyle task: {task_id}, style: {style}")
+    task = sm.state.get_task(task_id)
+    script_file = path.join(utils.task_dir(task_id), "script.json")
+    if not task or not task.get("videos") or not os.path.exists(script_file):
+        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+        logger.error(f"task {task_id} has no videos to restyle.")
+        return
+
+    with open(script_file, "r", encoding="utf-8") as f:
+        script_data = json.load(f)
+    previous_params = VideoParams(**script_data["params"])
+    params = VideoParams(**{**script_data["params"], **style})
+    changed = {k for k in style if getattr(params, k) != getattr(previous_params, k)}
+
+    if not changed:
+        logger.info(f"task {task_id} already has the styles, nothing to render.")
+        kwargs = {k: v for k, v in task.items() if k not in ["task_id", "state", "progress"]}
+        sm.state.update_task(task_id, state=const.TASK_STATE_COMPLETE, progress=100, **kwargs)
+        return kwargs
+
+    final_video_paths = task["videos"]
+    combined_video_paths = task.get("combined_videos", [])
+    audio_only = changed.issubset(audio_style_fields)
+    if not audio_only and (
+        len(combined_video_paths) != len(final_video_paths)
+        or not all(os.path.exists(p) for p in combined_video_paths)
+    ):
+        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+        logger.error(f"task {task_id} has no combined videos to render the subtitles again.")
+        return
+
+    # keep the results of the task, the state is replaced on every update
+    kwargs = {
+        k: v for k, v in task.items() if k not in ["task_id", "state", "progress"]
     }
+    sm.state.update_task(
+        task_id, state=const.TASK_STATE_PROCESSING, progress=50, **kwargs
+    )
+
+    subtitle_path = task.get("subtitle_path", "") if params.subtitle_enabled else ""
+    seed = script_data.get("seed")
+    bgm_files = script_data.get("bgm_files") or []
+    if changed & {"bgm_type", "bgm_file"} or len(bgm_files) != len(final_video_paths):
+        bgm_files = resolve_bgm_files(params.model_copy(update={"video_count": len(final_video_paths)}), seed)
+    # the videos are rendered next to the final ones and replace them once all of them are rendered,
+    # a failed render keeps the previous videos
+    part_files = []
+    for final_video_path in final_video_paths:
+        base, ext = os.path.splitext(final_video_path)
+        part_files.append(f"{base}.part{ext}")
+    _progress = 50
+    try:
+        for i, final_video_path in enumerate(final_video_paths):
+            index = i + 1
+            rng = random.Random(f"{seed}-{index}") if seed is not None else None
+            if audio_only:
+                logger.info(f"\n\n## remixing audio: {index} => {final_video_path}")
+                video.remux_audio(
+                    final_video_path,
+                    task["audio_file"],
+                    variant_params(params, bgm_files[i]),
+                    rng,
+                    subtitle_path=subtitle_path,
+                    output_file=part_files[i],
+                )
+            else:
+                logger.info(f"\n\n## generating video: {index} => {final_video_path}")
+                video.generate_video(
+                    video_path=combined_video_paths[i],
+                    audio_path=task["audio_file"],
+                    subtitle_path=subtitle_path,
+                    output_file=part_files[i],
+                    params=variant_params(params, bgm_files[i]),
+                    rng=rng,
+                )
+            _progress += 50 / len(final_video_paths)
+            sm.state.update_task(task_id, progress=_progress, **kwargs)
+    except Exception as e:
+        logger.error(f"failed to restyle task {task_id}: {str(e)}")
+        video.delete_files(part_files)
+        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED, **kwargs)
+        return
+
+    for part_file, final_video_path in zip(part_files, final_video_paths):
+        os.replace(part_file, final_video_path)
+
+    # later restyles and promotions start from the new styles
+    save_script_data(task_id, script_data["script"], script_data["search_terms"], params, seed, bgm_files)
+    logger.success(
+        f"task {task_id} restyled, {'remixed the audio of' if audio_only else 'rendered'} {len(final_video_paths)} videos."
+    )
+
     sm.state.update_task(
         task_id, state=const.TASK_STATE_COMPLETE, progress=100, **kwargs
     )
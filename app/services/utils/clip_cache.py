@@ -0,0 +1,149 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+from loguru import logger
+
+from app.config import config
+from app.utils import utils
+
+
+_file_hashes = {}
+
+
+def file_hash(file_path: str) -> str:
+    """
+    md5 of the file content, memoized by path, size and mtime so a source is read once per process.
+    """
+    stat = os.stat(file_path)
+    memo_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_hashes:
+        h = hashlib.md5()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        _file_hashes[memo_key] = h.hexdigest()
+    return _file_hashes[memo_key]
+
+
+def link_or_copy(src: str, dst: str):
+    """
+    Place src at dst, as a hard link when the file system allows it.
+    dst is replaced by a rename and never written in place, it may be a hard link to another cache entry.
+    """
+    temp_file = f"{dst}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+        os.link(src, temp_file)
+    except Exception:
+        shutil.copyfile(src, temp_file)
+    try:
+        os.replace(temp_file, dst)
+    except Exception:
+        os.remove(temp_file)
+        raise
+
+
+class ClipCache:
+    """
+    Persistent cache of normalized sub-clips, keyed by the source content and every parameter
+    that changes the encoded output. Entries are evicted least recently used first once the
+    cache grows over max_size bytes.
+    Entries share their file with the clips put or restored by hard links, so a clip must be
+    replaced by a new file, never overwritten in place, see video.process_subclip().
+    """
+
+    def __init__(self, cache_dir: str, max_size: int, enabled: bool = True):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def key(self, source_file: str, **params) -> str:
+        data = {"source": file_hash(source_file), **params}
+        return utils.md5(json.dumps(data, sort_keys=True, default=str))
+
+    def _paths(self, key: str):
+        video_file = os.path.join(self.cache_dir, f"{key}.mp4")
+        meta_file = os.path.join(self.cache_dir, f"{key}.json")
+        return video_file, meta_file
+
+    def get(self, key: str, output_file: str):
+        """
+        Place the cached clip at output_file and return its metadata, or None on a miss.
+        """
+        if not self.enabled:
+            return None
+
+        video_file, meta_file = self._paths(key)
+        try:
+            with open(meta_file, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            link_or_copy(video_file, output_file)
+            # mark the entry as recently used
+            os.utime(video_file)
+            os.utime(meta_file)
+        except Exception:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return meta
+
+    def put(self, key: str, file_path: str, **meta):
+        if not self.enabled:
+            return
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            video_file, meta_file = self._paths(key)
+            link_or_copy(file_path, video_file)
+            with open(meta_file, "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+        except Exception as e:
+            logger.warning(f"failed to cache clip: {file_path} => {str(e)}")
+            return
+
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            total_size = 0
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith(".mp4"):
+                    continue
+                video_file = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(video_file)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name[: -len(".mp4")]))
+                total_size += stat.st_size
+
+            for _, size, key in sorted(entries):
+                if total_size <= self.max_size:
+                    break
+                for file in self._paths(key):
+                    try:
+                        os.remove(file)
+                    except Exception:
+                        pass
+                total_size -= size
+                logger.debug(f"evicted cached clip: {key}")
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+clip_cache = ClipCache(
+    cache_dir=utils.storage_dir("cache_clips"),
+    max_size=int(config.app.get("clip_cache_max_size_mb", 2048)) * 1024 * 1024,
+    enabled=config.app.get("clip_cache_enabled", True),
+)
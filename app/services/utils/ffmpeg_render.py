@@ -0,0 +1,123 @@
+from typing import List
+
+from app.models.schema import VideoTransitionMode
+
+# the transitions of video_effects last one second
+transition_duration = 1
+
+
+def fit_filter(clip_w: int, clip_h: int, video_width: int, video_height: int) -> str:
+    """
+    Scale a clip into the frame, letterboxed or pillarboxed the same way as video_effects.fit_to_frame().
+    """
+    if clip_w * video_height == clip_h * video_width:
+        return f"scale={video_width}:{video_height}:flags=lanczos"
+
+    scale_factor = min(video_width / clip_w, video_height / clip_h)
+    new_width = min(video_width, int(clip_w * scale_factor))
+    new_height = min(video_height, int(clip_h * scale_factor))
+    x = (video_width - new_width) // 2
+    y = (video_height - new_height) // 2
+    return f"scale={new_width}:{new_height}:flags=lanczos,pad={video_width}:{video_height}:{x}:{y}:black"
+
+
+def transition_filter(transition: str, duration: float) -> str:
+    if transition == VideoTransitionMode.fade_in.value:
+        return f"fade=t=in:st=0:d={transition_duration}"
+    if transition == VideoTransitionMode.fade_out.value:
+        return f"fade=t=out:st={max(0.0, duration - transition_duration):.6f}:d={transition_duration}"
+    # SlideIn and SlideOut only set the position of the clip in MoviePy, which is ignored when the clip
+    # is not composited, so they leave the frames as they are
+    return ""
+
+
+def build_render_args(
+    slots: List[dict],
+    overlays: List[dict],
+    video_width: int,
+    video_height: int,
+    fps: int,
+    combined: bool = False,
+):
+    """
+    Compile a timeline into the inputs and the filter_complex graph of a single ffmpeg run.
+
+    slots: the clips in order, each with source, start, duration, width, height and transition
+    overlays: the subtitle images, each with image, x, y, start and end
+    The graph outputs [vout], and [vcombined], the video before the subtitles, when combined is set.
+    The audio is mixed on its own, see build_audio_args().
+    Returns the input arguments and the filter_complex graph.
+    """
+    input_args = []
+    filters = []
+
+    input_count = 0
+    video_labels = []
+    for i, slot in enumerate(slots):
+        input_args.extend(["-ss", f"{slot['start']:.6f}", "-t", f"{slot['duration']:.6f}", "-i", slot["source"]])
+        chain = [
+            f"[{input_count}:v:0]fps={fps}",
+            fit_filter(slot["width"], slot["height"], video_width, video_height),
+            "setsar=1",
+            "format=yuv420p",
+            # a source a frame short is padded with its last frame, so the clips keep their slots
+            "tpad=stop=-1:stop_mode=clone",
+            f"trim=duration={slot['duration']:.6f}",
+            "setpts=PTS-STARTPTS",
+        ]
+        input_count += 1
+        transition = transition_filter(slot["transition"], slot["duration"])
+        if transition:
+            chain.append(transition)
+        filters.append(",".join(chain) + f"[v{i}]")
+        video_labels.append(f"[v{i}]")
+
+    filters.append(f"{''.join(video_labels)}concat=n={len(video_labels)}:v=1:a=0[vcat]")
+    video_label = "[vcat]"
+    if combined:
+        filters.append("[vcat]split=2[vbase][vcombined]")
+        video_label = "[vbase]"
+
+    for i, overlay in enumerate(overlays):
+        input_args.extend(["-i", overlay["image"]])
+        filters.append(
+            f"{video_label}[{input_count}:v:0]overlay=x={overlay['x']}:y={overlay['y']}"
+            f":enable='gte(t,{overlay['start']:.6f})*lt(t,{overlay['end']:.6f})'[o{i}]"
+        )
+        input_count += 1
+        video_label = f"[o{i}]"
+    filters.append(f"{video_label}format=yuv420p[vout]")
+    return input_args, ";".join(filters)
+
+
+def build_audio_args(
+    input_index: int,
+    audio_path: str,
+    voice_volume: float,
+    bgm_file: str,
+    bgm_volume: float,
+    bgm_duration: float,
+    duration: float,
+):
+    """
+    The inputs and filters that mix the voice with the looped background music into [aout], cut at duration.
+    input_index is the index of the first audio input in the ffmpeg command.
+    """
+    input_args = ["-i", audio_path]
+    filters = [f"[{input_index}:a:0]volume={voice_volume}[voice]"]
+    if bgm_file:
+        input_args.extend(["-i", bgm_file])
+        # the same order as the MoviePy effects: volume, fade out the end of the track, then loop it
+        filters.append(
+            f"[{input_index + 1}:a:0]volume={bgm_volume},"
+            f"afade=t=out:st={max(0.0, bgm_duration - 3):.6f}:d=3,"
+            "aloop=loop=-1:size=2147483647[bgm]"
+        )
+        # the looped bgm never ends, the mix is cut at the end of the video
+        filters.append(
+            "[voice][bgm]amix=inputs=2:duration=longest:normalize=0,"
+            f"atrim=duration={duration:.6f}[aout]"
+        )
+    else:
+        filters.append(f"[voice]apad,atrim=duration={duration:.6f}[aout]")
+    return input_args, filters
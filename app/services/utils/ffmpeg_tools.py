@@ -0,0 +1,166 @@
+import os
+import subprocess
+from typing import List
+
+from loguru import logger
+from moviepy.config import FFMPEG_BINARY
+from moviepy.tools import cross_platform_popen_params
+
+from app.services.utils import media_probe
+
+
+def run_ffmpeg(args: List[str]) -> bool:
+    cmd = [FFMPEG_BINARY, "-y", "-hide_banner", "-loglevel", "error", *args]
+    logger.debug(f"running ffmpeg: {' '.join(cmd)}")
+    popen_params = cross_platform_popen_params(
+        {
+            "stdout": subprocess.DEVNULL,
+            "stderr": subprocess.PIPE,
+            "stdin": subprocess.DEVNULL,
+        }
+    )
+    try:
+        proc = subprocess.run(cmd, **popen_params)
+    except Exception as e:
+        logger.error(f"failed to run ffmpeg: {str(e)}")
+        return False
+
+    if proc.returncode != 0:
+        err = proc.stderr.decode("utf-8", errors="ignore").strip()
+        logger.error(f"ffmpeg exited with code {proc.returncode}: {err}")
+        return False
+    return True
+
+
+def stream_signature(video_path: str):
+    """
+    The stream parameters that must match for two files to be joined with stream copy.
+    """
+    # temp clips are probed once and deleted right after, keep them out of the probe cache
+    infos = media_probe.read_infos(video_path)
+    return (
+        infos["video_codec"],
+        infos["video_profile"],
+        infos["pix_fmt"],
+        infos["time_base"],
+        (infos["width"], infos["height"]),
+        infos["fps"],
+        infos["audio_found"],
+    )
+
+
+def is_concat_compatible(video_paths: List[str]) -> bool:
+    signatures = set()
+    for video_path in set(video_paths):
+        try:
+            signatures.add(stream_signature(video_path))
+        except Exception as e:
+            logger.warning(f"failed to probe video: {video_path} => {str(e)}")
+            return False
+        if len(signatures) > 1:
+            return False
+    return len(signatures) == 1
+
+
+def concat_videos(video_paths: List[str], output_file: str) -> bool:
+    """
+    Join the videos in a single pass with the concat demuxer, without re-encoding.
+    All inputs must share the same codec, profile, pixel format, time base, resolution and fps,
+    see is_concat_compatible().
+    """
+    list_file = f"{output_file}.concat.txt"
+    with open(list_file, "w", encoding="utf-8") as f:
+        for video_path in video_paths:
+            video_path = os.path.abspath(video_path).replace("\\", "/")
+            video_path = video_path.replace("'", "'\\''")
+            f.write(f"file '{video_path}'\n")
+
+    try:
+        return run_ffmpeg(
+            [
+                "-f",
+                "concat",
+                "-safe",
+                "0",
+                "-i",
+                list_file,
+                "-c",
+                "copy",
+                "-movflags",
+                "+faststart",
+                output_file,
+            ]
+        )
+    finally:
+        try:
+            os.remove(list_file)
+        except Exception:
+            pass
+
+
+def extract_clip(video_path: str, start_time: float, frame_count: int, output_file: str) -> bool:
+    """
+    Copy frame_count frames of the first video stream from start_time, without re-encoding.
+    start_time must be a keyframe, otherwise the clip starts at the keyframe before it.
+    The length is a frame count, a duration would also copy the reordered frames past the end.
+    """
+    return run_ffmpeg(
+        [
+            "-ss",
+            f"{start_time:.6f}",
+            "-i",
+            video_path,
+            "-frames:v",
+            str(frame_count),
+            "-map",
+            "0:v:0",
+            "-c",
+            "copy",
+            "-an",
+            "-avoid_negative_ts",
+            "make_zero",
+            "-movflags",
+            "+faststart",
+            output_file,
+        ]
+    )
+
+
+def mux_subtitles(video_path: str, subtitle_path: str, output_file: str) -> bool:
+    """
+    Add the srt file as a mov_text subtitle track, the video and audio streams are copied.
+    """
+    return run_ffmpeg(
+        [
+            "-i",
+            video_path,
+            "-i",
+            subtitle_path,
+            "-map",
+            "0",
+            "-map",
+            "1:s:0",
+            "-c",
+            "copy",
+            "-c:s",
+            "mov_text",
+            "-movflags",
+            "+faststart",
+            output_file,
+        ]
+    )
+
+
+def replace_audio(video_path: str, audio_path: str, output_file: str, subtitle_path: str = "") -> bool:
+    """
+    Mux the first video stream of video_path with the first audio stream of audio_path, both are copied.
+    With subtitle_path, the srt file is added as a mov_text track.
+    """
+    input_args = ["-i", video_path, "-i", audio_path]
+    map_args = ["-map", "0:v:0", "-map", "1:a:0"]
+    codec_args = ["-c", "copy"]
+    if subtitle_path:
+        input_args += ["-i", subtitle_path]
+        map_args += ["-map", "2:s:0"]
+        codec_args += ["-c:s", "mov_text"]
+    return run_ffmpeg([*input_args, *map_args, *codec_args, "-movflags", "+faststart", output_file])
@@ -0,0 +1,272 @@
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+from typing import List
+
+from loguru import logger
+from moviepy.config import FFMPEG_BINARY
+from moviepy.tools import cross_platform_popen_params
+from moviepy.video.io.ffmpeg_reader import FFmpegInfosParser
+from PIL import Image
+
+from app.config import config
+from app.models import const
+from app.utils import utils
+
+# the entries read or written by this process, by absolute path, the least recently used ones are dropped
+# past max_memory_entries
+_lock = threading.Lock()
+_entries = OrderedDict()
+max_memory_entries = 1024
+# bumped when read_infos() returns new fields, the entries written before are probed again
+entry_version = 2
+# the cache directory is pruned every prune_interval entries written by a process, see prune()
+prune_interval = 200
+_saves_since_prune = 0
+
+
+def cache_dir() -> str:
+    return utils.storage_dir("cache_probe", create=True)
+
+
+def entry_file(file_path: str) -> str:
+    # one file per media file, the render workers of other processes write their entries without a shared lock
+    return os.path.join(cache_dir(), f"{utils.md5(file_path)}.json")
+
+
+def _remember(file_path: str, entry: dict):
+    _entries[file_path] = entry
+    _entries.move_to_end(file_path)
+    while len(_entries) > max_memory_entries:
+        _entries.popitem(last=False)
+
+
+def _load_entry(file_path: str):
+    entry = _entries.get(file_path)
+    if entry is not None:
+        _entries.move_to_end(file_path)
+        return entry
+
+    try:
+        with open(entry_file(file_path), "r", encoding="utf-8") as f:
+            entry = json.load(f)
+        # mark the entry as recently used, see prune()
+        os.utime(entry_file(file_path))
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"failed to load probe cache entry, probing again: {file_path} => {str(e)}")
+        return None
+    if entry.get("file") != file_path:
+        return None
+    _remember(file_path, entry)
+    return entry
+
+
+def _save_entry(file_path: str, entry: dict):
+    global _saves_since_prune
+    entry = dict(entry, file=file_path)
+    _remember(file_path, entry)
+    try:
+        # write to a temp file first so a concurrent reader never sees a partial entry
+        temp_file = f"{entry_file(file_path)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(temp_file, entry_file(file_path))
+    except Exception as e:
+        logger.warning(f"failed to save probe cache: {str(e)}")
+
+    _saves_since_prune += 1
+    if _saves_since_prune >= prune_interval:
+        _saves_since_prune = 0
+        prune_in_background()
+
+
+def prune():
+    """
+    Remove the cache entries of the files that were deleted, e.g. the audio of a deleted task, then the least
+    recently used ones past probe_cache_max_entries.
+    """
+    max_entries = config.app.get("probe_cache_max_entries", 10000)
+    entries = []
+    for name in os.listdir(cache_dir()):
+        entry_path = os.path.join(cache_dir(), name)
+        try:
+            if not name.endswith(".json"):
+                # a temp file left by a crash, older than any write in progress
+                if name.endswith(".tmp") and time.time() - os.stat(entry_path).st_mtime > 3600:
+                    os.remove(entry_path)
+                continue
+            mtime = os.stat(entry_path).st_mtime
+            with open(entry_path, "r", encoding="utf-8") as f:
+                source_file = json.load(f).get("file")
+            if source_file and os.path.exists(source_file):
+                entries.append((mtime, entry_path))
+            else:
+                os.remove(entry_path)
+        except Exception:
+            # removed by another process or being replaced, the next prune sees it again
+            continue
+
+    for _, entry_path in sorted(entries)[: max(0, len(entries) - max_entries)]:
+        try:
+            os.remove(entry_path)
+        except Exception:
+            pass
+
+
+def prune_in_background() -> threading.Thread:
+    thread = threading.Thread(target=prune, daemon=True)
+    thread.start()
+    return thread
+
+
+def read_stream_infos(file_path: str):
+    """
+    Run ffmpeg -i on the file, returns the infos parsed by moviepy and the line of the first video stream.
+    """
+    cmd = [FFMPEG_BINARY, "-hide_banner", "-i", file_path]
+    popen_params = cross_platform_popen_params(
+        {
+            "stdout": subprocess.DEVNULL,
+            "stderr": subprocess.PIPE,
+            "stdin": subprocess.DEVNULL,
+        }
+    )
+    proc = subprocess.run(cmd, **popen_params)
+    output = proc.stderr.decode("utf-8", errors="ignore")
+    try:
+        infos = FFmpegInfosParser(output, file_path).parse()
+    except Exception as e:
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"'{file_path}' not found")
+        raise IOError(f"failed to read media infos: {file_path} => {output.strip()[-500:]}") from e
+
+    video_stream = next((line for line in output.splitlines() if re.search(r"Stream #\S+.*: Video: ", line)), "")
+    return infos, video_stream
+
+
+def read_infos(file_path: str) -> dict:
+    """
+    Read the container metadata of a video or image, without decoding any frame.
+    """
+    ext = utils.parse_extension(file_path)
+    if ext in const.FILE_TYPE_IMAGES:
+        with Image.open(file_path) as img:
+            width, height = img.size
+        return {
+            "duration": 0.0,
+            "width": width,
+            "height": height,
+            "fps": 0.0,
+            "video_codec": ext,
+            "video_profile": "",
+            "pix_fmt": "",
+            "time_base": "",
+            "video_found": True,
+            "audio_found": False,
+        }
+
+    infos, video_stream = read_stream_infos(file_path)
+    width, height = infos.get("video_size") or (0, 0)
+    # e.g. "Video: h264 (High) (avc1 / 0x31637661), yuv420p(progressive), 1080x1920, ..., 30 tbr, 15360 tbn"
+    pix_fmt = re.search(r"Video: [^,]*, ([0-9a-z_]+)", video_stream)
+    tbn = re.search(r"([0-9.]+k?) tbn", video_stream)
+    return {
+        "duration": infos.get("duration") or 0.0,
+        "width": width,
+        "height": height,
+        "fps": infos.get("video_fps") or 0.0,
+        "video_codec": infos.get("video_codec_name"),
+        "video_profile": (infos.get("video_profile") or "").strip("()"),
+        "pix_fmt": pix_fmt.group(1) if pix_fmt else "",
+        "time_base": f"1/{tbn.group(1)}" if tbn else "",
+        "video_found": infos.get("video_found", False),
+        "audio_found": infos.get("audio_found", False),
+    }
+
+
+def probe(file_path: str) -> dict:
+    """
+    Return the metadata of a media file: duration, width, height, fps, video_codec, video_profile, pix_fmt,
+    time_base, video_found and audio_found.
+    Results are cached on disk by path, mtime and size, so each file is probed once until it changes,
+    by any process.
+    Raises an exception if the file can not be read.
+    """
+    file_path = os.path.abspath(file_path)
+    stat = os.stat(file_path)
+    signature = [stat.st_mtime_ns, stat.st_size]
+
+    with _lock:
+        entry = _load_entry(file_path)
+        if entry and entry["signature"] == signature and entry.get("version") == entry_version:
+            return dict(entry["infos"])
+
+    infos = read_infos(file_path)
+
+    with _lock:
+        _save_entry(file_path, {"signature": signature, "version": entry_version, "infos": infos})
+    return dict(infos)
+
+
+def read_keyframes(file_path: str) -> List[float]:
+    """
+    Read the timestamps of the keyframes of the first video stream, in seconds.
+    Only the keyframes are decoded.
+    """
+    cmd = [
+        FFMPEG_BINARY,
+        "-hide_banner",
+        "-nostats",
+        "-skip_frame",
+        "nokey",
+        "-i",
+        file_path,
+        "-map",
+        "0:v:0",
+        "-vf",
+        "showinfo",
+        "-f",
+        "null",
+        "-",
+    ]
+    popen_params = cross_platform_popen_params(
+        {
+            "stdout": subprocess.DEVNULL,
+            "stderr": subprocess.PIPE,
+            "stdin": subprocess.DEVNULL,
+        }
+    )
+    proc = subprocess.run(cmd, **popen_params)
+    output = proc.stderr.decode("utf-8", errors="ignore")
+    if proc.returncode != 0:
+        raise IOError(f"failed to read keyframes: {file_path} => {output.strip()[-500:]}")
+
+    return sorted(float(t) for t in re.findall(r"pts_time:(-?[0-9.]+)", output))
+
+
+def keyframes(file_path: str) -> List[float]:
+    """
+    Return the keyframe timestamps of a video, cached next to its probe() metadata until the file changes.
+    Raises an exception if the file can not be read.
+    """
+    file_path = os.path.abspath(file_path)
+    # make sure the entry is current, a changed file drops its keyframes
+    probe(file_path)
+    with _lock:
+        entry = _load_entry(file_path)
+        if entry and "keyframes" in entry:
+            return list(entry["keyframes"])
+
+    keyframe_times = read_keyframes(file_path)
+
+    with _lock:
+        entry = _load_entry(file_path)
+        if entry:
+            _save_entry(file_path, dict(entry, keyframes=keyframe_times))
+    return list(keyframe_times)
@@ -0,0 +1,264 @@
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+from typing import List
+
+from loguru import logger
+from moviepy.config import FFMPEG_BINARY
+from moviepy.tools import cross_platform_popen_params
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+
+from app.utils import utils
+
+# the songs picked by the random bgm and listed by GET /musics
+suffix = ".mp3"
+
+# guards _index, held briefly by the readers and writers
+_lock = threading.Lock()
+# a single refresh at a time, it analyzes the songs without holding _lock
+_refresh_lock = threading.Lock()
+_index = None
+# the directory, its mtime and the time of the last scan, see is_refresh_due()
+_last_scan = None
+# a song overwritten in place does not change the directory mtime, the directory is scanned again after this many seconds
+refresh_interval = 60
+
+
+def index_file() -> str:
+    return os.path.join(utils.storage_dir("cache_songs", create=True), "songs.json")
+
+
+def _empty_index(song_dir: str) -> dict:
+    return {"song_dir": song_dir, "songs": {}}
+
+
+def _load_index() -> dict:
+    global _index
+    song_dir = utils.song_dir()
+    if _index is None:
+        _index = _empty_index(song_dir)
+        try:
+            with open(index_file(), "r", encoding="utf-8") as f:
+                _index = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"failed to load song index, starting empty: {str(e)}")
+    # the entries hold absolute paths, an index of another directory is useless
+    if _index.get("song_dir") != song_dir:
+        _index = _empty_index(song_dir)
+    return _index
+
+
+def _save_index():
+    # write to a temp file first so a concurrent reader never sees a partial index
+    temp_file = f"{index_file()}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_file, "w", encoding="utf-8") as f:
+        json.dump(_index, f)
+    os.replace(temp_file, index_file())
+
+
+def read_loudness(file_path: str) -> float:
+    """
+    Measure the integrated loudness of the first audio stream in LUFS, with the ebur128 filter.
+    The whole track is decoded, which is why the result is kept in the index.
+    """
+    cmd = [
+        FFMPEG_BINARY,
+        "-hide_banner",
+        "-nostats",
+        "-i",
+        file_path,
+        "-map",
+        "0:a:0",
+        "-af",
+        "ebur128=framelog=quiet",
+        "-f",
+        "null",
+        "-",
+    ]
+    popen_params = cross_platform_popen_params(
+        {
+            "stdout": subprocess.DEVNULL,
+            "stderr": subprocess.PIPE,
+            "stdin": subprocess.DEVNULL,
+        }
+    )
+    proc = subprocess.run(cmd, **popen_params)
+    output = proc.stderr.decode("utf-8", errors="ignore")
+    # the summary printed at the end holds the integrated loudness of the whole track
+    matches = re.findall(r"I:\s+(-?[0-9.]+) LUFS", output)
+    if proc.returncode != 0 or not matches:
+        raise IOError(f"failed to measure loudness: {file_path} => {output.strip()[-500:]}")
+    return float(matches[-1])
+
+
+def analyze(file_path: str) -> dict:
+    """
+    The index entry of a song: name, file, size, duration, sample_rate and loudness.
+    Raises an exception if the file can not be read.
+    """
+    file_path = os.path.abspath(file_path)
+    stat = os.stat(file_path)
+    infos = ffmpeg_parse_infos(file_path)
+    return {
+        "name": os.path.basename(file_path),
+        "file": file_path,
+        "size": stat.st_size,
+        "duration": infos.get("duration") or 0.0,
+        "sample_rate": infos.get("audio_fps") or 0,
+        "loudness": read_loudness(file_path),
+        "signature": [stat.st_mtime_ns, stat.st_size],
+    }
+
+
+def refresh(wait: bool = True) -> bool:
+    """
+    Bring the index up to date with the songs directory: the songs that are new, or whose mtime or size changed
+    since they were indexed, e.g. overwritten in place, are analyzed and the deleted ones are dropped.
+    One refresh runs at a time, without wait a caller returns at once while another one is running.
+    Returns True if the index changed.
+    """
+    global _last_scan
+    if not _refresh_lock.acquire(blocking=wait):
+        return False
+    try:
+        # decided from the index as it is after any refresh that ran while this one waited
+        song_dir = utils.song_dir()
+        with _lock:
+            indexed = dict(_load_index()["songs"])
+
+        # taken before listing, a song added while listing changes it again
+        _last_scan = (song_dir, get_signature(song_dir), time.monotonic())
+
+        songs = {}
+        stale = []
+        for name in sorted(os.listdir(song_dir)):
+            if not name.endswith(suffix):
+                continue
+            file_path = os.path.join(song_dir, name)
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            entry = indexed.get(name)
+            if entry and entry["signature"] == [stat.st_mtime_ns, stat.st_size]:
+                songs[name] = entry
+            else:
+                stale.append(file_path)
+        if not stale and songs.keys() == indexed.keys():
+            return False
+
+        for file_path in stale:
+            try:
+                logger.info(f"indexing song: {file_path}")
+                songs[os.path.basename(file_path)] = analyze(file_path)
+            except Exception as e:
+                # left out of the index, it is analyzed again by the next refresh
+                logger.warning(f"failed to index song: {file_path} => {str(e)}")
+
+        with _lock:
+            index = _load_index()
+            # keep the songs added while this refresh was analyzing, see add()
+            for name, entry in index["songs"].items():
+                if indexed.get(name) != entry and get_signature(entry["file"]) == entry["signature"]:
+                    songs[name] = entry
+            changed = songs != index["songs"]
+            index["songs"] = songs
+            if changed:
+                try:
+                    _save_index()
+                except Exception as e:
+                    logger.warning(f"failed to save song index: {str(e)}")
+        return changed
+    finally:
+        _refresh_lock.release()
+
+
+def get_signature(file_path: str):
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def add(file_path: str) -> dict:
+    """
+    Analyze a song written to the songs directory, e.g. an upload, and add it to the index.
+    Raises an exception if the file can not be read.
+    """
+    entry = analyze(file_path)
+    with _lock:
+        _load_index()["songs"][entry["name"]] = entry
+        try:
+            _save_index()
+        except Exception as e:
+            logger.warning(f"failed to save song index: {str(e)}")
+    return dict(entry)
+
+
+def is_refresh_due() -> bool:
+    """
+    Whether the songs directory changed since it was last scanned, from its mtime, or was last scanned
+    over refresh_interval seconds ago.
+    """
+    if _last_scan is None:
+        return True
+    song_dir, signature, scanned_at = _last_scan
+    if song_dir != utils.song_dir() or time.monotonic() - scanned_at >= refresh_interval:
+        return True
+    return get_signature(song_dir) != signature
+
+
+def refresh_in_background():
+    """
+    Start a refresh in a daemon thread, unless one is already running. Returns the thread, if one was started.
+    """
+    if _refresh_lock.locked():
+        return None
+    thread = threading.Thread(target=refresh, kwargs={"wait": False}, daemon=True)
+    thread.start()
+    return thread
+
+
+def songs() -> List[dict]:
+    """
+    The indexed songs sorted by name. The last index is returned at once and refreshed in the background when
+    is_refresh_due(), only the first call, before anything was indexed, waits for the songs to be analyzed.
+    """
+    with _lock:
+        indexed = bool(_load_index()["songs"])
+    if is_refresh_due():
+        if indexed:
+            refresh_in_background()
+        else:
+            refresh()
+    with _lock:
+        return [dict(entry) for _, entry in sorted(_load_index()["songs"].items())]
+
+
+def get(file_path: str) -> dict:
+    """
+    The index entry of a song of the songs directory, None if it is not indexed or changed since.
+    """
+    file_path = os.path.abspath(file_path)
+    with _lock:
+        entry = _load_index()["songs"].get(os.path.basename(file_path))
+    if not entry or entry["file"] != file_path or entry["signature"] != get_signature(file_path):
+        return None
+    return dict(entry)
+
+
+def gain(file_path: str, target_loudness: float) -> float:
+    """
+    The volume factor that brings a song to target_loudness LUFS, from its indexed loudness.
+    1 for the songs that are not indexed, e.g. a bgm_file outside of the songs directory.
+    """
+    entry = get(file_path)
+    if not entry:
+        return 1.0
+    return 10 ** ((target_loudness - entry["loudness"]) / 20)
@@ -0,0 +1,80 @@
+import bisect
+import itertools
+from typing import List
+
+import numpy as np
+from PIL import Image
+
+
+class SubtitleOverlay:
+    """
+    The subtitles of a video indexed by time. A frame only blends the captions shown at that time, on their
+    bounding box, where a CompositeVideoClip tests every caption and composites the whole frame.
+    Captions are dicts with the RGBA image, the x, y position of its top left corner, start and end.
+    """
+
+    def __init__(self, captions: List[dict]):
+        # sorted by start, the captions shown together are blended in the order of the subtitle file
+        self.captions = sorted(captions, key=lambda caption: caption["start"])
+        self.starts = [caption["start"] for caption in self.captions]
+        # the latest end of the captions up to each index, the search stops once it is before t
+        self.max_ends = list(itertools.accumulate((caption["end"] for caption in self.captions), max))
+        # frames come in order, the caption of the previous frame is likely the one of the next
+        self._last_key = None
+        self._last_image = None
+
+    def active(self, t: float) -> List[int]:
+        """
+        The indexes of the captions shown at t, in blending order.
+        """
+        indexes = []
+        i = bisect.bisect_right(self.starts, t)
+        while i > 0 and self.max_ends[i - 1] > t:
+            i -= 1
+            if self.captions[i]["end"] > t:
+                indexes.append(i)
+        return indexes[::-1]
+
+    def _caption_image(self, index: int, box) -> Image.Image:
+        if self._last_key != (index, box):
+            x0, y0, x1, y1 = box
+            self._last_image = Image.fromarray(self.captions[index]["image"][y0:y1, x0:x1])
+            self._last_key = (index, box)
+        return self._last_image
+
+    def apply(self, frame: np.ndarray, t: float) -> np.ndarray:
+        """
+        Blend the captions shown at t into the frame, a writable uint8 RGB array, in place.
+        """
+        frame_height, frame_width = frame.shape[:2]
+        for i in self.active(t):
+            caption = self.captions[i]
+            height, width = caption["image"].shape[:2]
+            x, y = caption["x"], caption["y"]
+            # the part of the caption inside the frame
+            x0, y0 = max(0, -x), max(0, -y)
+            x1, y1 = min(width, frame_width - x), min(height, frame_height - y)
+            if x0 >= x1 or y0 >= y1:
+                continue
+
+            region = frame[y + y0 : y + y1, x + x0 : x + x1]
+            background = Image.fromarray(region).convert("RGBA")
+            blended = Image.alpha_composite(background, self._caption_image(i, (x0, y0, x1, y1)))
+            region[:] = np.asarray(blended)[:, :, :3]
+        return frame
+
+
+def overlay_subtitles(clip, captions: List[dict]):
+    """
+    The clip with the captions blended into its frames, see SubtitleOverlay.
+    """
+    overlay = SubtitleOverlay(captions)
+
+    def blend(get_frame, t):
+        frame = get_frame(t)
+        if not overlay.active(t):
+            return frame
+        # the frame may be memoized or shared by the source clip, the captions are blended into a copy
+        return overlay.apply(frame.astype(np.uint8), t)
+
+    return clip.transform(blend)
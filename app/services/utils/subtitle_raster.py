@@ -0,0 +1,163 @@
+import functools
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from app.config import config
+
+
+@functools.lru_cache(maxsize=32)
+def get_font(font_path: str, font_size: int) -> ImageFont.FreeTypeFont:
+    """
+    The font of a path and size, loaded once per process, ImageFont.truetype() parses the font file on every call.
+    """
+    return ImageFont.truetype(font_path, font_size)
+
+
+def first_overflow(fits, start: int, end: int) -> int:
+    """
+    The first index in [start, end) where fits(index) is False, or end if there is none.
+    The width of a line only grows with its length, so fits is True up to an index and False from there.
+    """
+    while start < end:
+        middle = (start + end) // 2
+        if fits(middle):
+            start = middle + 1
+        else:
+            end = middle
+    return start
+
+
+def wrap_text(text, max_width, font="Arial", fontsize=60):
+    """
+    Break the text into lines of max_width at spaces, or anywhere when a word is wider than a line, e.g. Chinese.
+    Returns the wrapped text and its height. The breaks are found with a binary search on the width of the line,
+    instead of measuring the line again after each word or character.
+    """
+    font = get_font(font, fontsize)
+
+    def get_text_size(inner_text):
+        inner_text = inner_text.strip()
+        left, top, right, bottom = font.getbbox(inner_text)
+        return right - left, bottom - top
+
+    width, height = get_text_size(text)
+    if width <= max_width:
+        return text, height
+
+    def words_fit(start, end):
+        return get_text_size(" ".join(words[start : end + 1]))[0] <= max_width
+
+    processed = True
+
+    _wrapped_lines_ = []
+    words = text.split(" ")
+    start = 0
+    while True:
+        # a line is measured once a second word is added to it, only the first word is measured alone
+        end = first_overflow(lambda i: words_fit(start, i), start if start == 0 else start + 1, len(words))
+        if end == len(words):
+            break
+        if " ".join(words[start : end + 1]).strip() == words[end].strip():
+            processed = False
+            break
+        _wrapped_lines_.append(" ".join(words[start:end]))
+        start = end
+    if processed:
+        _wrapped_lines_.append(" ".join(words[start:]))
+        _wrapped_lines_ = [line.strip() for line in _wrapped_lines_]
+        result = "\n".join(_wrapped_lines_).strip()
+        height = len(_wrapped_lines_) * height
+        return result, height
+
+    def chars_fit(start, end):
+        return get_text_size(text[start : end + 1])[0] <= max_width
+
+    _wrapped_lines_ = []
+    start = 0
+    while True:
+        # the character that overflows the line ends it
+        end = first_overflow(lambda i: chars_fit(start, i), start, len(text))
+        if end == len(text):
+            break
+        _wrapped_lines_.append(text[start : end + 1])
+        start = end + 1
+    _wrapped_lines_.append(text[start:])
+    result = "\n".join(_wrapped_lines_).strip()
+    height = len(_wrapped_lines_) * height
+    return result, height
+
+
+def rasterize(text, font_path, font_size, color, bg_color, stroke_color, stroke_width) -> np.ndarray:
+    """
+    Draw the text into an RGBA array, pixel for pixel like a MoviePy TextClip with the same arguments.
+    """
+    font = get_font(font_path, font_size)
+    # the spacing, alignment and anchor of TextClip(method="label")
+    text_args = {"font": font, "spacing": 4, "align": "left", "stroke_width": stroke_width, "anchor": "lm"}
+    left, top, right, bottom = ImageDraw.Draw(Image.new("RGB", (1, 1))).multiline_textbbox((0, 0), text, **text_args)
+    width, height = int(right - left), int(bottom - top)
+
+    if bg_color is None:
+        bg_color = (0, 0, 0, 0)
+    img = Image.new("RGBA", (width, height), color=bg_color)
+    ImageDraw.Draw(img).multiline_text(xy=(0, height / 2), text=text, fill=color, stroke_fill=stroke_color, **text_args)
+    return np.array(img)
+
+
+class RasterCache:
+    """
+    Least recently used cache of the rendered subtitles, shared by all tasks of the process and bounded by
+    the total size of the images in bytes.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            image = self._entries.get(key)
+            if image is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return image
+
+    def put(self, key, image: np.ndarray):
+        with self._lock:
+            if key in self._entries or image.nbytes > self.max_size:
+                return
+            self._entries[key] = image
+            self.size += image.nbytes
+            while self.size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted.nbytes
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "size": self.size}
+
+
+raster_cache = RasterCache(max_size=int(config.app.get("subtitle_cache_max_size_mb", 64)) * 1024 * 1024)
+
+
+def render_subtitle(text, font_path, font_size, max_width, color, bg_color, stroke_color, stroke_width) -> np.ndarray:
+    """
+    The RGBA image of a subtitle wrapped to max_width. Images are cached, the returned array is read-only.
+    """
+    key = (text, font_path, font_size, max_width, color, bg_color, stroke_color, stroke_width)
+    image = raster_cache.get(key)
+    if image is None:
+        wrapped_text, _ = wrap_text(text, max_width=max_width, font=font_path, fontsize=font_size)
+        image = rasterize(wrapped_text, font_path, font_size, color, bg_color, stroke_color, stroke_width)
+        image.flags.writeable = False
+        raster_cache.put(key, image)
+    return image
@@ -1,4 +1,6 @@
+import numpy as np
 from moviepy import Clip, vfx
+from PIL import Image
 
 
 # FadeIn
@@ -19,3 +21,31 @@ def slidein_transition(clip: Clip, t: float, side: str) -> Clip:
 # SlideOut
 def slideout_transition(clip: Clip, t: float, side: str) -> Clip:
     return clip.with_effects([vfx.SlideOut(t, side)])
+
+
+# FitToFrame
+def fit_to_frame(clip: Clip, width: int, height: int, color=(0, 0, 0)) -> Clip:
+    """
+    Resize the clip to fit in width x height and center it on bars of `color` (letterbox or pillarbox).
+    Each frame is resized once and copied into a frame buffer allocated once per clip, where the bars never change,
+    instead of compositing it over a full background frame.
+    The returned frame is overwritten by the next one, it must be consumed before the clip is read again.
+    """
+    clip_w, clip_h = clip.size
+    scale_factor = min(width / clip_w, height / clip_h)
+    new_width = min(width, int(clip_w * scale_factor))
+    new_height = min(height, int(clip_h * scale_factor))
+    x = (width - new_width) // 2
+    y = (height - new_height) // 2
+
+    frame_buffer = np.empty((height, width, 3), dtype=np.uint8)
+    frame_buffer[:] = color
+    inner = frame_buffer[y : y + new_height, x : x + new_width]
+
+    def fit(frame):
+        # the same resampling as vfx.Resize
+        resized = Image.fromarray(frame.astype("uint8")).resize((new_width, new_height), Image.Resampling.LANCZOS)
+        inner[:] = np.asarray(resized)[:, :, :3]
+        return frame_buffer
+
+    return clip.image_transform(fit)
@@ -1,34 +1,47 @@
-import glob
 import itertools
+import json
+import math
+import multiprocessing
 import os
 import random
 import gc
 import shutil
+import uuid
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from typing import List
 from loguru import logger
 from moviepy import (
-    AudioFileClip,
-    ColorClip,
-    CompositeAudioClip,
     CompositeVideoClip,
     ImageClip,
-    TextClip,
     VideoFileClip,
-    afx,
     concatenate_videoclips,
 )
-from moviepy.video.tools.subtitles import SubtitlesClip
-from PIL import ImageFont
+from moviepy.tools import compute_position
+from moviepy.video.tools.subtitles import file_to_subtitles
+from PIL import Image
 
+from app.config import config
 from app.models import const
 from app.models.schema import (
     MaterialInfo,
+    SubtitleMode,
     VideoAspect,
     VideoConcatMode,
     VideoParams,
     VideoTransitionMode,
 )
-from app.services.utils import video_effects
+from app.services.utils import (
+    ffmpeg_render,
+    ffmpeg_tools,
+    media_probe,
+    song_index,
+    subtitle_overlay,
+    subtitle_raster,
+    video_effects,
+)
+from app.services.utils.clip_cache import clip_cache, file_hash
+from app.services.utils.subtitle_raster import wrap_text
 from app.utils import utils
 
 class SubClippedVideoClip:
@@ -51,6 +64,100 @@ audio_codec = "aac"
 video_codec = "libx264"
 fps = 30
 
+# x264 settings selectable by name, they can be overridden or extended in the [encoding_profiles] section of config.toml
+encoding_profiles = {
+    "draft": {"preset": "ultrafast", "crf": 28, "tune": "fastdecode", "fps": 24, "keyframe_interval": 48},
+    "standard": {"preset": "medium", "crf": 23, "tune": "", "fps": fps, "keyframe_interval": 250},
+    "archive": {"preset": "slow", "crf": 18, "tune": "film", "fps": fps, "keyframe_interval": 250},
+    # intermediates are decoded and encoded again, so they favour speed and near-lossless quality
+    "intermediate": {"preset": "ultrafast", "crf": 12, "tune": "", "fps": fps, "keyframe_interval": 30},
+    # low resolution proxy renders, see get_video_resolution()
+    "preview": {"preset": "ultrafast", "crf": 30, "tune": "fastdecode", "fps": 15, "keyframe_interval": 30},
+}
+
+
+def get_encoding_profile(name: str = "") -> dict:
+    name = name or "standard"
+    profiles = {**encoding_profiles, **config.encoding_profiles}
+    if name not in profiles:
+        logger.warning(f"unknown encoding profile: {name}, using standard")
+        name = "standard"
+    return {**encoding_profiles["standard"], **profiles[name], "name": name}
+
+
+def get_final_encoding_profile(params: VideoParams) -> dict:
+    if params.video_preview:
+        return get_encoding_profile(config.app.get("preview_encoding_profile", "preview"))
+    return get_encoding_profile(params.video_encoding_profile)
+
+
+def get_video_resolution(video_aspect: VideoAspect, preview: bool = False):
+    """
+    The output resolution of the aspect, previews are scaled down so their short side is preview_resolution pixels.
+    """
+    video_width, video_height = VideoAspect(video_aspect).to_resolution()
+    if preview:
+        scale = config.app.get("preview_resolution", 360) / min(video_width, video_height)
+        # x264 requires even dimensions
+        video_width = int(video_width * scale) // 2 * 2
+        video_height = int(video_height * scale) // 2 * 2
+    return video_width, video_height
+
+
+def get_intermediate_encoding_profile(final_profile: dict) -> dict:
+    """
+    The profile of the temp files rendered before final_profile, it keeps the final fps to avoid resampling frames.
+    """
+    profile = get_encoding_profile(config.app.get("intermediate_encoding_profile", "intermediate"))
+    profile["fps"] = final_profile["fps"]
+    return profile
+
+
+def is_same_encoding(profile: dict, other: dict) -> bool:
+    """
+    Whether the two profiles encode the same way, whatever their names.
+    """
+    return all(profile.get(k) == other.get(k) for k in ["preset", "crf", "tune", "fps", "keyframe_interval"])
+
+
+def encoding_write_params(profile: dict) -> dict:
+    """
+    Convert an encoding profile to write_videofile() arguments.
+    """
+    ffmpeg_params = ["-crf", str(profile["crf"]), "-g", str(profile["keyframe_interval"])]
+    if profile.get("tune"):
+        ffmpeg_params += ["-tune", profile["tune"]]
+    return {
+        "codec": video_codec,
+        "fps": profile["fps"],
+        "preset": profile["preset"],
+        "ffmpeg_params": ffmpeg_params,
+    }
+
+
+def audio_output_args() -> List[str]:
+    # the audio settings of write_videofile()
+    return ["-c:a", audio_codec, "-ar", "44100"]
+
+
+def encoding_ffmpeg_args(profile: dict) -> List[str]:
+    """
+    The ffmpeg output options of an encoding profile, the same settings as encoding_write_params().
+    """
+    write_params = encoding_write_params(profile)
+    return [
+        "-c:v",
+        write_params["codec"],
+        "-preset",
+        write_params["preset"],
+        "-r",
+        str(write_params["fps"]),
+        *write_params["ffmpeg_params"],
+        "-pix_fmt",
+        "yuv420p",
+    ]
+
+
 def close_clip(clip):
     if clip is None:
         return
@@ -98,7 +205,7 @@ def delete_files(files: List[str] | str):
         except:
             pass
 
-def get_bgm_file(bgm_type: str = "random", bgm_file: str = ""):
+def get_bgm_file(bgm_type: str = "random", bgm_file: str = "", rng: random.Random = None):
     if not bgm_type:
         return ""
 
@@ -106,14 +213,461 @@ def get_bgm_file(bgm_type: str = "random", bgm_file: str = ""):
         return bgm_file
 
     if bgm_type == "random":
-        suffix = "*.mp3"
-        song_dir = utils.song_dir()
-        files = glob.glob(os.path.join(song_dir, suffix))
-        return random.choice(files)
+        # sorted by name, a seeded rng picks the same song for the same library
+        files = [song["file"] for song in song_index.songs()]
+        return (rng or random).choice(files)
 
     return ""
 
 
+def resolve_transition(video_transition_mode: VideoTransitionMode = None, rng: random.Random = None):
+    """
+    Pick the transition and slide side of one clip, the shuffle mode is resolved to a concrete transition.
+    Resolving it before processing keeps the choice out of worker processes, where the random state is not shared.
+    """
+    rng = rng or random
+    side = rng.choice(["left", "right", "top", "bottom"])
+    if video_transition_mode is None:
+        return VideoTransitionMode.none, side
+
+    transition = VideoTransitionMode(video_transition_mode)
+    if transition.value == VideoTransitionMode.shuffle.value:
+        transition = rng.choice(
+            [
+                VideoTransitionMode.fade_in,
+                VideoTransitionMode.fade_out,
+                VideoTransitionMode.slide_in,
+                VideoTransitionMode.slide_out,
+            ]
+        )
+    return transition, side
+
+
+def apply_transition(clip, transition: VideoTransitionMode, side: str):
+    if transition.value == VideoTransitionMode.fade_in.value:
+        return video_effects.fadein_transition(clip, 1)
+    if transition.value == VideoTransitionMode.fade_out.value:
+        return video_effects.fadeout_transition(clip, 1)
+    if transition.value == VideoTransitionMode.slide_in.value:
+        return video_effects.slidein_transition(clip, 1, side)
+    if transition.value == VideoTransitionMode.slide_out.value:
+        return video_effects.slideout_transition(clip, 1, side)
+    return clip
+
+
+def build_subclip(
+    subclipped_item: SubClippedVideoClip,
+    video_width: int,
+    video_height: int,
+    transition: VideoTransitionMode,
+    side: str,
+    max_clip_duration: int,
+):
+    """
+    Build the normalized MoviePy clip of a sub-clip: cut, resized to the target resolution and with its transition.
+    Nothing is decoded until the clip is rendered.
+    """
+    # the final video only uses the voice and background music, the source audio is never decoded
+    clip = VideoFileClip(subclipped_item.file_path, audio=False).subclipped(subclipped_item.start_time, subclipped_item.end_time)
+    clip_duration = clip.duration
+    # Not all videos are same size, so we need to resize them
+    clip_w, clip_h = clip.size
+    if clip_w != video_width or clip_h != video_height:
+        clip_ratio = clip.w / clip.h
+        video_ratio = video_width / video_height
+        logger.debug(f"resizing clip, source: {clip_w}x{clip_h}, ratio: {clip_ratio:.2f}, target: {video_width}x{video_height}, ratio: {video_ratio:.2f}")
+
+        if clip_ratio == video_ratio:
+            clip = clip.resized(new_size=(video_width, video_height))
+        else:
+            clip = video_effects.fit_to_frame(clip, video_width, video_height)
+
+    clip = apply_transition(clip, transition, side)
+
+    if clip.duration > max_clip_duration:
+        clip = clip.subclipped(0, max_clip_duration)
+    return clip
+
+
+def process_subclip(
+    subclipped_item: SubClippedVideoClip,
+    clip_file: str,
+    video_width: int,
+    video_height: int,
+    transition: VideoTransitionMode,
+    side: str,
+    max_clip_duration: int,
+    encoding: dict = None,
+    stream_copy: bool = False,
+) -> SubClippedVideoClip:
+    # render to a new file and rename it over clip_file, a clip_file left over by another run
+    # may be a hard link to a clip cache entry and writing it in place would change the entry
+    base, ext = os.path.splitext(clip_file)
+    part_file = f"{base}.part{ext}"
+    try:
+        if stream_copy:
+            duration = extract_subclip(subclipped_item, part_file).duration
+        else:
+            if encoding is None:
+                encoding = get_intermediate_encoding_profile(get_encoding_profile())
+            clip = build_subclip(subclipped_item, video_width, video_height, transition, side, max_clip_duration)
+
+            # wirte clip to temp file
+            clip.write_videofile(part_file, logger=None, audio=False, **encoding_write_params(encoding))
+            duration = clip.duration
+            close_clip(clip)
+        os.replace(part_file, clip_file)
+    finally:
+        delete_files(part_file)
+
+    return SubClippedVideoClip(file_path=clip_file, duration=duration, width=subclipped_item.width, height=subclipped_item.height)
+
+
+def extract_subclip(subclipped_item: SubClippedVideoClip, clip_file: str) -> SubClippedVideoClip:
+    """
+    Copy a sub-clip that starts on a keyframe of its material without re-encoding it.
+    """
+    source_fps = media_probe.probe(subclipped_item.file_path)["fps"]
+    # seek half a frame past the keyframe, the probed timestamps are rounded
+    start_time = subclipped_item.start_time + 0.5 / source_fps
+    frame_count = max(1, round(subclipped_item.duration * source_fps))
+    if not ffmpeg_tools.extract_clip(subclipped_item.file_path, start_time, frame_count, clip_file):
+        raise IOError(f"failed to extract clip: {subclipped_item.file_path}")
+
+    duration = media_probe.read_infos(clip_file)["duration"]
+    return SubClippedVideoClip(file_path=clip_file, duration=duration, width=subclipped_item.width, height=subclipped_item.height)
+
+
+def subclip_cache_key(job: dict) -> str:
+    subclipped_item = job["subclipped_item"]
+    transition = job["transition"]
+    side = job["side"]
+    if transition.value not in [VideoTransitionMode.slide_in.value, VideoTransitionMode.slide_out.value]:
+        side = ""
+    return clip_cache.key(
+        subclipped_item.file_path,
+        start_time=subclipped_item.start_time,
+        end_time=subclipped_item.end_time,
+        resolution=(job["video_width"], job["video_height"]),
+        encoding=job.get("encoding"),
+        codec=video_codec,
+        audio=False,
+        transition=transition.value,
+        side=side,
+        max_clip_duration=job["max_clip_duration"],
+        stream_copy=job.get("stream_copy", False),
+    )
+
+
+def get_cached_subclip(job: dict):
+    """
+    Look the job up in the clip cache, returns the cache key and the clip placed at the job's clip_file on a hit.
+    """
+    try:
+        cache_key = subclip_cache_key(job)
+    except Exception as e:
+        logger.warning(f"failed to build clip cache key: {str(e)}")
+        return "", None
+
+    meta = clip_cache.get(cache_key, job["clip_file"])
+    if meta is None:
+        return cache_key, None
+
+    logger.debug(f"clip cache hit: {job['subclipped_item']}")
+    return cache_key, SubClippedVideoClip(file_path=job["clip_file"], duration=meta["duration"], width=meta["width"], height=meta["height"])
+
+
+def put_cached_subclip(cache_key: str, clip: SubClippedVideoClip):
+    if cache_key:
+        clip_cache.put(cache_key, clip.file_path, duration=clip.duration, width=clip.width, height=clip.height)
+
+
+def expected_duration(job: dict) -> float:
+    return min(job["subclipped_item"].duration, job["max_clip_duration"])
+
+
+def process_subclips(jobs: List[dict], audio_duration: float = math.inf, workers: int = 1) -> List[SubClippedVideoClip]:
+    """
+    Run process_subclip() for the jobs in order until the audio duration is covered, or for all of them by default.
+    With more than one worker the clips are encoded in a process pool, at most `workers` clips are in flight
+    and results are collected in submission order, so the output is the same as the sequential run.
+    A clip that fails is skipped, the same as in the sequential run.
+    """
+    processed_clips = []
+    video_duration = 0
+
+    if workers <= 1:
+        for i, job in enumerate(jobs):
+            if video_duration > audio_duration:
+                break
+
+            subclipped_item = job["subclipped_item"]
+            logger.debug(f"processing clip {i+1}: {subclipped_item.width}x{subclipped_item.height}, current duration: {video_duration:.2f}s, remaining: {audio_duration - video_duration:.2f}s")
+            cache_key, clip = get_cached_subclip(job)
+            try:
+                if clip is None:
+                    clip = process_subclip(**job)
+                    put_cached_subclip(cache_key, clip)
+            except Exception as e:
+                logger.error(f"failed to process clip: {str(e)}")
+                continue
+
+            processed_clips.append(clip)
+            video_duration += clip.duration
+        logger.info(f"clip cache: {clip_cache.stats()}")
+        return processed_clips
+
+    logger.info(f"processing clips with {workers} workers")
+    pending = deque()
+    next_job = 0
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        while True:
+            # only submit the clips the sequential run would reach if every pending clip succeeds
+            projected_duration = video_duration + sum(expected_duration(job) for job, _, _ in pending)
+            while next_job < len(jobs) and len(pending) < workers and projected_duration <= audio_duration:
+                job = jobs[next_job]
+                logger.debug(f"submitting clip {next_job+1}: {job['subclipped_item'].width}x{job['subclipped_item'].height}, projected duration: {projected_duration:.2f}s")
+                cache_key, clip = get_cached_subclip(job)
+                if clip is None:
+                    future = executor.submit(process_subclip, **job)
+                else:
+                    future = Future()
+                    future.set_result(clip)
+                    # already cached, nothing to store once it is collected
+                    cache_key = ""
+                pending.append((job, cache_key, future))
+                projected_duration += expected_duration(job)
+                next_job += 1
+
+            if not pending:
+                break
+
+            job, cache_key, future = pending.popleft()
+            try:
+                clip = future.result()
+            except Exception as e:
+                logger.error(f"failed to process clip: {str(e)}")
+                continue
+
+            put_cached_subclip(cache_key, clip)
+            processed_clips.append(clip)
+            video_duration += clip.duration
+
+    logger.info(f"clip cache: {clip_cache.stats()}")
+    return processed_clips
+
+
+def is_stream_copyable(infos: dict, video_width: int, video_height: int, encoding: dict) -> bool:
+    """
+    Whether the video stream of a file can be copied as it is into a video of the encoding: the same resolution,
+    codec, fps and 8 bit 4:2:0 pixel format.
+    """
+    return (
+        (infos["width"], infos["height"]) == (video_width, video_height)
+        and infos["video_codec"] == "h264"
+        and infos.get("pix_fmt") == "yuv420p"
+        and abs(infos["fps"] - encoding["fps"]) < 0.01
+    )
+
+
+def stream_copy_signature(infos: dict):
+    """
+    The stream parameters that the materials of a copy-join must share besides is_stream_copyable(), a different
+    profile or time base gives the join the timing of the wrong material.
+    """
+    return infos.get("video_profile"), infos.get("pix_fmt"), infos.get("time_base")
+
+
+def plan_subclip_jobs(
+    video_paths: List[str],
+    output_dir: str,
+    video_aspect: VideoAspect = VideoAspect.portrait,
+    video_concat_mode: VideoConcatMode = VideoConcatMode.random,
+    video_transition_mode: VideoTransitionMode = None,
+    max_clip_duration: int = 5,
+    encoding: dict = None,
+    preview: bool = False,
+    rng: random.Random = None,
+    cut_mode: str = "",
+) -> List[dict]:
+    """
+    Cut the materials into sub-clips of max_clip_duration and return the process_subclip() arguments of each one,
+    in the order they are used in the video. Pass a seeded rng to get the same order and transitions again.
+    With the "keyframe" cut mode, the sub-clips of a material that already matches the output resolution, codec and
+    fps start on its keyframes, so they can be extracted with stream copy when none of the sub-clips has to be
+    re-encoded, i.e. every material matches, with the same stream_copy_signature(), and there are no transitions.
+    """
+    rng = rng or random
+    cut_mode = cut_mode or config.app.get("subclip_cut_mode", "frame")
+    video_width, video_height = get_video_resolution(video_aspect, preview)
+    if encoding is None:
+        encoding = get_intermediate_encoding_profile(get_encoding_profile())
+
+    subclipped_items = []
+    copy_signatures = set()
+    for video_path in video_paths:
+        infos = media_probe.probe(video_path)
+        clip_duration = infos["duration"]
+        clip_w, clip_h = infos["width"], infos["height"]
+
+        keyframe_times = []
+        if cut_mode == "keyframe" and is_stream_copyable(infos, video_width, video_height, encoding):
+            try:
+                keyframe_times = media_probe.keyframes(video_path)
+            except Exception as e:
+                logger.warning(f"failed to read keyframes, cutting frame accurately: {video_path} => {str(e)}")
+        stream_copy = len(keyframe_times) > 0
+        if stream_copy:
+            copy_signatures.add(stream_copy_signature(infos))
+
+        start_time = keyframe_times[0] if stream_copy else 0
+
+        while start_time < clip_duration:
+            end_time = min(start_time + max_clip_duration, clip_duration)
+            if clip_duration - start_time >= max_clip_duration:
+                subclipped_items.append((SubClippedVideoClip(file_path= video_path, start_time=start_time, end_time=end_time, width=clip_w, height=clip_h), stream_copy))
+            start_time = end_time
+            if stream_copy:
+                # the next sub-clip starts on the first keyframe after this one
+                start_time = next((t for t in keyframe_times if t >= end_time), clip_duration)
+            if video_concat_mode.value == VideoConcatMode.sequential.value:
+                break
+
+    # random subclipped_items order
+    if video_concat_mode.value == VideoConcatMode.random.value:
+        rng.shuffle(subclipped_items)
+
+    logger.debug(f"total subclipped items: {len(subclipped_items)}")
+
+    jobs = []
+    for i, (subclipped_item, stream_copy) in enumerate(subclipped_items):
+        transition, side = resolve_transition(video_transition_mode, rng)
+        jobs.append(
+            {
+                "subclipped_item": subclipped_item,
+                "clip_file": f"{output_dir}/temp-clip-{i+1}.mp4",
+                "video_width": video_width,
+                "video_height": video_height,
+                "transition": transition,
+                "side": side,
+                "max_clip_duration": max_clip_duration,
+                "encoding": encoding,
+                # a transition has to be rendered, the sub-clip is re-encoded
+                "stream_copy": stream_copy and transition.value == VideoTransitionMode.none.value,
+            }
+        )
+
+    # the copied sub-clips keep the b-frames and timestamps of their material, the concat demuxer does not line
+    # them up with the re-encoded ones or the ones of a material with other stream parameters and the join comes
+    # out short, so they are only copied when all of them are, from materials of the same stream parameters
+    if len(copy_signatures) > 1 or not all(job["stream_copy"] for job in jobs):
+        for job in jobs:
+            job["stream_copy"] = False
+    return jobs
+
+
+def trim_job(job: dict, duration: float) -> dict:
+    """
+    A copy of the job that only renders the first `duration` seconds of its sub-clip.
+    """
+    subclipped_item = job["subclipped_item"]
+    trimmed = dict(job)
+    trimmed["subclipped_item"] = SubClippedVideoClip(
+        file_path=subclipped_item.file_path,
+        start_time=subclipped_item.start_time,
+        end_time=subclipped_item.start_time + duration,
+        width=subclipped_item.width,
+        height=subclipped_item.height,
+    )
+    # the same sub-clip may be cut to another duration by another variant
+    trimmed["clip_file"] = job["clip_file"].replace(".mp4", f"-tail-{round(duration * 1000)}.mp4")
+    return trimmed
+
+
+def plan_timeline(jobs: List[dict], audio_duration: float, min_duration: float = 1 / fps) -> List[dict]:
+    """
+    Build the edit decision list of a video from the sub-clip metadata only: the slots that cover the audio duration
+    exactly, in order. The sub-clips are looped when the materials are too short and the last one is cut at the end
+    of the audio, so only the sub-clips used by the video are ever decoded.
+    Each slot holds its position on the timeline and the process_subclip() arguments of its sub-clip,
+    looped slots share the job (and the clip_file) of the first slot that uses the sub-clip.
+    min_duration is one frame of the encoding profile the slots are rendered with.
+    """
+    jobs = [job for job in jobs if expected_duration(job) > 0]
+    timeline = []
+    if not jobs:
+        return timeline
+
+    video_duration = 0
+    for job in itertools.cycle(jobs):
+        remaining = audio_duration - video_duration
+        # stop within a frame of the audio duration, a shorter clip can not be encoded
+        if remaining < min_duration:
+            break
+        duration = expected_duration(job)
+        if duration > remaining:
+            job = trim_job(job, remaining)
+            duration = remaining
+        timeline.append({"slot": len(timeline) + 1, "start": video_duration, "duration": duration, "job": job})
+        video_duration += duration
+
+    logger.info(f"planned {len(timeline)} slots, video duration: {video_duration:.2f}s, audio duration: {audio_duration:.2f}s")
+    return timeline
+
+
+def timeline_to_edl(timeline: List[dict]) -> List[dict]:
+    edl = []
+    for entry in timeline:
+        job = entry["job"]
+        subclipped_item = job["subclipped_item"]
+        transition = job["transition"]
+        side = job["side"]
+        if transition.value not in [VideoTransitionMode.slide_in.value, VideoTransitionMode.slide_out.value]:
+            side = ""
+        edl.append(
+            {
+                "slot": entry["slot"],
+                "start": round(entry["start"], 3),
+                "duration": round(entry["duration"], 3),
+                "source": subclipped_item.file_path,
+                "in": subclipped_item.start_time,
+                "out": subclipped_item.end_time,
+                "transition": transition.value,
+                "side": side,
+            }
+        )
+    return edl
+
+
+def dump_timeline(timeline: List[dict]) -> List[dict]:
+    """
+    A JSON serializable copy of a timeline, to hand it to another process or node, see load_timeline().
+    """
+    data = []
+    for entry in timeline:
+        job = dict(entry["job"])
+        job["subclipped_item"] = dict(vars(job["subclipped_item"]))
+        job["transition"] = job["transition"].value
+        data.append(dict(entry, job=job))
+    return data
+
+
+def load_timeline(data: List[dict]) -> List[dict]:
+    timeline = []
+    for entry in data:
+        job = dict(entry["job"])
+        job["subclipped_item"] = SubClippedVideoClip(**job["subclipped_item"])
+        job["transition"] = VideoTransitionMode(job["transition"])
+        timeline.append(dict(entry, job=job))
+    return timeline
+
+
+def save_timeline(timeline: List[dict], timeline_file: str):
+    with open(timeline_file, "w", encoding="utf-8") as f:
+        f.write(utils.to_json(timeline_to_edl(timeline)))
+    logger.info(f"timeline saved: {timeline_file}")
+
+
 def combine_videos(
     combined_video_path: str,
     video_paths: List[str],
@@ -123,114 +677,160 @@ def combine_videos(
     video_transition_mode: VideoTransitionMode = None,
     max_clip_duration: int = 5,
     threads: int = 2,
+    workers: int = 0,
+    encoding_profile: str = "",
+    preview: bool = False,
+    rng: random.Random = None,
+    timeline_file: str = "",
 ) -> str:
-    audio_clip = AudioFileClip(audio_file)
-    audio_duration = audio_clip.duration
+    audio_duration = media_probe.probe(audio_file)["duration"]
     logger.info(f"audio duration: {audio_duration} seconds")
     # Required duration of each clip
     req_dur = audio_duration / len(video_paths)
     req_dur = max_clip_duration
     logger.info(f"maximum clip duration: {req_dur} seconds")
     output_dir = os.path.dirname(combined_video_path)
+    encoding = get_intermediate_encoding_profile(get_encoding_profile(encoding_profile))
+    logger.info(f"intermediate encoding profile: {encoding}")
 
-    aspect = VideoAspect(video_aspect)
-    video_width, video_height = aspect.to_resolution()
+    jobs = plan_subclip_jobs(
+        video_paths=video_paths,
+        output_dir=output_dir,
+        video_aspect=video_aspect,
+        video_concat_mode=video_concat_mode,
+        video_transition_mode=video_transition_mode,
+        max_clip_duration=max_clip_duration,
+        encoding=encoding,
+        preview=preview,
+        rng=rng,
+    )
 
-    processed_clips = []
-    subclipped_items = []
-    video_duration = 0
-    for video_path in video_paths:
-        clip = VideoFileClip(video_path)
-        clip_duration = clip.duration
-        clip_w, clip_h = clip.size
-        close_clip(clip)
-        
-        start_time = 0
+    # Add downloaded clips over and over until the duration of the audio (max_duration) has been reached
+    # a slot shorter than one frame of the profile can not be encoded
+    timeline = plan_timeline(jobs, audio_duration, min_duration=1 / encoding["fps"])
+    if timeline_file:
+        save_timeline(timeline, timeline_file)
 
-        while start_time < clip_duration:
-            end_time = min(start_time + max_clip_duration, clip_duration)            
-            if clip_duration - start_time >= max_clip_duration:
-                subclipped_items.append(SubClippedVideoClip(file_path= video_path, start_time=start_time, end_time=end_time, width=clip_w, height=clip_h))
-            start_time = end_time    
-            if video_concat_mode.value == VideoConcatMode.sequential.value:
-                break
+    if not workers:
+        workers = config.app.get("clip_workers", 1)
+    render_timelines(
+        timelines=[timeline],
+        combined_video_paths=[combined_video_path],
+        audio_duration=audio_duration,
+        threads=threads,
+        workers=workers,
+        encoding=encoding,
+    )
+    return combined_video_path
 
-    # random subclipped_items order
-    if video_concat_mode.value == VideoConcatMode.random.value:
-        random.shuffle(subclipped_items)
-        
-    logger.debug(f"total subclipped items: {len(subclipped_items)}")
-    
-    # Add downloaded clips over and over until the duration of the audio (max_duration) has been reached
-    for i, subclipped_item in enumerate(subclipped_items):
-        if video_duration > audio_duration:
-            break
-        
-        logger.debug(f"processing clip {i+1}: {subclipped_item.width}x{subclipped_item.height}, current duration: {video_duration:.2f}s, remaining: {audio_duration - video_duration:.2f}s")
-        
-        try:
-            clip = VideoFileClip(subclipped_item.file_path).subclipped(subclipped_item.start_time, subclipped_item.end_time)
-            clip_duration = clip.duration
-            # Not all videos are same size, so we need to resize them
-            clip_w, clip_h = clip.size
-            if clip_w != video_width or clip_h != video_height:
-                clip_ratio = clip.w / clip.h
-                video_ratio = video_width / video_height
-                logger.debug(f"resizing clip, source: {clip_w}x{clip_h}, ratio: {clip_ratio:.2f}, target: {video_width}x{video_height}, ratio: {video_ratio:.2f}")
-                
-                if clip_ratio == video_ratio:
-                    clip = clip.resized(new_size=(video_width, video_height))
-                else:
-                    if clip_ratio > video_ratio:
-                        scale_factor = video_width / clip_w
-                    else:
-                        scale_factor = video_height / clip_h
-
-                    new_width = int(clip_w * scale_factor)
-                    new_height = int(clip_h * scale_factor)
-
-                    background = ColorClip(size=(video_width, video_height), color=(0, 0, 0)).with_duration(clip_duration)
-                    clip_resized = clip.resized(new_size=(new_width, new_height)).with_position("center")
-                    clip = CompositeVideoClip([background, clip_resized])
-                    
-            shuffle_side = random.choice(["left", "right", "top", "bottom"])
-            if video_transition_mode.value == VideoTransitionMode.none.value:
-                clip = clip
-            elif video_transition_mode.value == VideoTransitionMode.fade_in.value:
-                clip = video_effects.fadein_transition(clip, 1)
-            elif video_transition_mode.value == VideoTransitionMode.fade_out.value:
-                clip = video_effects.fadeout_transition(clip, 1)
-            elif video_transition_mode.value == VideoTransitionMode.slide_in.value:
-                clip = video_effects.slidein_transition(clip, 1, shuffle_side)
-            elif video_transition_mode.value == VideoTransitionMode.slide_out.value:
-                clip = video_effects.slideout_transition(clip, 1, shuffle_side)
-            elif video_transition_mode.value == VideoTransitionMode.shuffle.value:
-                transition_funcs = [
-                    lambda c: video_effects.fadein_transition(c, 1),
-                    lambda c: video_effects.fadeout_transition(c, 1),
-                    lambda c: video_effects.slidein_transition(c, 1, shuffle_side),
-                    lambda c: video_effects.slideout_transition(c, 1, shuffle_side),
-                ]
-                shuffle_transition = random.choice(transition_funcs)
-                clip = shuffle_transition(clip)
-
-            if clip.duration > max_clip_duration:
-                clip = clip.subclipped(0, max_clip_duration)
-                
-            # wirte clip to temp file
-            clip_file = f"{output_dir}/temp-clip-{i+1}.mp4"
-            clip.write_videofile(clip_file, logger=None, fps=fps, codec=video_codec)
-            
-            close_clip(clip)
-        
-            processed_clips.append(SubClippedVideoClip(file_path=clip_file, duration=clip.duration, width=clip_w, height=clip_h))
-            video_duration += clip.duration
-            
-        except Exception as e:
-            logger.error(f"failed to process clip: {str(e)}")
-    
-    # loop processed clips until the video duration matches or exceeds the audio duration.
-    if video_duration < audio_duration:
+
+def combine_video_variants(
+    combined_video_paths: List[str],
+    video_paths: List[str],
+    audio_file: str,
+    video_aspect: VideoAspect = VideoAspect.portrait,
+    video_transition_mode: VideoTransitionMode = None,
+    max_clip_duration: int = 5,
+    threads: int = 2,
+    workers: int = 0,
+    encoding_profile: str = "",
+    preview: bool = False,
+    rngs: List[random.Random] = None,
+    timeline_files: List[str] = None,
+) -> List[str]:
+    """
+    Combine one video per path in combined_video_paths, each with its own random order of the sub-clips.
+    The materials are cut into one shared pool of sub-clips, with their transitions, and every sub-clip used
+    by any variant is normalized once, so N variants cost about one encode of the pool plus N stream copies.
+    rngs holds the random generator of each variant, the first one also picks the transitions of the pool.
+    """
+    variant_count = len(combined_video_paths)
+    rngs = rngs or [None] * variant_count
+    audio_duration = media_probe.probe(audio_file)["duration"]
+    logger.info(f"audio duration: {audio_duration} seconds, variants: {variant_count}")
+    encoding = get_intermediate_encoding_profile(get_encoding_profile(encoding_profile))
+    logger.info(f"intermediate encoding profile: {encoding}")
+
+    pool = plan_subclip_jobs(
+        video_paths=video_paths,
+        output_dir=os.path.dirname(combined_video_paths[0]),
+        video_aspect=video_aspect,
+        video_concat_mode=VideoConcatMode.random,
+        video_transition_mode=video_transition_mode,
+        max_clip_duration=max_clip_duration,
+        encoding=encoding,
+        preview=preview,
+        rng=rngs[0],
+    )
+
+    timelines = []
+    for i, rng in enumerate(rngs):
+        jobs = pool.copy()
+        (rng or random).shuffle(jobs)
+        timeline = plan_timeline(jobs, audio_duration, min_duration=1 / encoding["fps"])
+        if timeline_files:
+            save_timeline(timeline, timeline_files[i])
+        timelines.append(timeline)
+
+    if not workers:
+        workers = config.app.get("clip_workers", 1)
+    render_timelines(
+        timelines=timelines,
+        combined_video_paths=combined_video_paths,
+        audio_duration=audio_duration,
+        threads=threads,
+        workers=workers,
+        encoding=encoding,
+    )
+    return combined_video_paths
+
+
+def render_timelines(
+    timelines: List[List[dict]],
+    combined_video_paths: List[str],
+    audio_duration: float,
+    threads: int = 2,
+    workers: int = 1,
+    encoding: dict = None,
+):
+    """
+    Render the sub-clips of the timelines and merge each timeline into its combined video.
+    Every sub-clip is rendered once, slots that loop it or share it between timelines reuse the file.
+    """
+    timeline_jobs = {}
+    for timeline in timelines:
+        for entry in timeline:
+            timeline_jobs.setdefault(entry["job"]["clip_file"], entry["job"])
+    rendered_clips = {
+        clip.file_path: clip for clip in process_subclips(list(timeline_jobs.values()), workers=workers)
+    }
+
+    for timeline, combined_video_path in zip(timelines, combined_video_paths):
+        processed_clips = [
+            rendered_clips[entry["job"]["clip_file"]]
+            for entry in timeline
+            if entry["job"]["clip_file"] in rendered_clips
+        ]
+        merge_clips(processed_clips, combined_video_path, audio_duration, threads, encoding)
+
+    # clean temp files
+    delete_files(list(rendered_clips.keys()))
+    logger.info("video combining completed")
+
+
+def merge_clips(
+    processed_clips: List[SubClippedVideoClip],
+    combined_video_path: str,
+    audio_duration: float,
+    threads: int = 2,
+    encoding: dict = None,
+) -> str:
+    video_duration = sum(clip.duration for clip in processed_clips)
+
+    # loop processed clips until the video duration matches or exceeds the audio duration,
+    # only needed when some clips of the timeline failed to render
+    frame_rate = (encoding or {}).get("fps", fps)
+    if processed_clips and video_duration < audio_duration - 1 / frame_rate:
         logger.warning(f"video duration ({video_duration:.2f}s) is shorter than audio duration ({audio_duration:.2f}s), looping clips to match audio length.")
         base_clips = processed_clips.copy()
         for clip in itertools.cycle(base_clips):
@@ -239,38 +839,64 @@ def combine_videos(
             processed_clips.append(clip)
             video_duration += clip.duration
         logger.info(f"video duration: {video_duration:.2f}s, audio duration: {audio_duration:.2f}s, looped {len(processed_clips)-len(base_clips)} clips")
-     
-    # merge video clips progressively, avoid loading all videos at once to avoid memory overflow
-    logger.info("starting clip merging process")
+
+    logger.info(f"starting clip merging process: {combined_video_path}")
     if not processed_clips:
         logger.warning("no clips available for merging")
         return combined_video_path
-    
+
     # if there is only one clip, use it directly
     if len(processed_clips) == 1:
         logger.info("using single clip directly")
         shutil.copy(processed_clips[0].file_path, combined_video_path)
-        delete_files(processed_clips)
-        logger.info("video combining completed")
         return combined_video_path
-    
+
+    # all temp clips are written with the same codec, fps and resolution,
+    # so they can usually be joined in one pass without re-encoding
+    clip_files = [clip.file_path for clip in processed_clips]
+    if ffmpeg_tools.is_concat_compatible(clip_files) and ffmpeg_tools.concat_videos(
+        clip_files, combined_video_path
+    ):
+        logger.info(f"merged {len(clip_files)} clips in a single pass")
+    else:
+        logger.warning("single-pass concat is not possible, merging clips progressively")
+        merge_videos_progressively(
+            processed_clips=processed_clips,
+            combined_video_path=combined_video_path,
+            threads=threads,
+            encoding=encoding,
+        )
+    return combined_video_path
+
+
+def merge_videos_progressively(
+    processed_clips: List[SubClippedVideoClip],
+    combined_video_path: str,
+    threads: int = 2,
+    encoding: dict = None,
+) -> str:
+    if encoding is None:
+        encoding = get_intermediate_encoding_profile(get_encoding_profile())
+    # merge video clips progressively, avoid loading all videos at once to avoid memory overflow
+    output_dir = os.path.dirname(combined_video_path)
+
     # create initial video file as base
     base_clip_path = processed_clips[0].file_path
     temp_merged_video = f"{output_dir}/temp-merged-video.mp4"
     temp_merged_next = f"{output_dir}/temp-merged-next.mp4"
-    
+
     # copy first clip as initial merged video
     shutil.copy(base_clip_path, temp_merged_video)
-    
+
     # merge remaining video clips one by one
     for i, clip in enumerate(processed_clips[1:], 1):
         logger.info(f"merging clip {i}/{len(processed_clips)-1}, duration: {clip.duration:.2f}s")
-        
+
         try:
             # load current base video and next clip to merge
-            base_clip = VideoFileClip(temp_merged_video)
-            next_clip = VideoFileClip(clip.file_path)
-            
+            base_clip = VideoFileClip(temp_merged_video, audio=False)
+            next_clip = VideoFileClip(clip.file_path, audio=False)
+
             # merge these two clips
             merged_clip = concatenate_videoclips([base_clip, next_clip])
 
@@ -279,85 +905,32 @@ def combine_videos(
                 filename=temp_merged_next,
                 threads=threads,
                 logger=None,
-                temp_audiofile_path=output_dir,
-                audio_codec=audio_codec,
-                fps=fps,
+                audio=False,
+                **encoding_write_params(encoding),
             )
             close_clip(base_clip)
             close_clip(next_clip)
             close_clip(merged_clip)
-            
+
             # replace base file with new merged file
             delete_files(temp_merged_video)
             os.rename(temp_merged_next, temp_merged_video)
-            
+
         except Exception as e:
             logger.error(f"failed to merge clip: {str(e)}")
             continue
-    
+
     # after merging, rename final result to target file name
-    os.rename(temp_merged_video, combined_video_path)
-    
-    # clean temp files
-    clip_files = [clip.file_path for clip in processed_clips]
-    delete_files(clip_files)
-            
-    logger.info("video combining completed")
+    os.replace(temp_merged_video, combined_video_path)
     return combined_video_path
 
 
-def wrap_text(text, max_width, font="Arial", fontsize=60):
-    # Create ImageFont
-    font = ImageFont.truetype(font, fontsize)
-
-    def get_text_size(inner_text):
-        inner_text = inner_text.strip()
-        left, top, right, bottom = font.getbbox(inner_text)
-        return right - left, bottom - top
-
-    width, height = get_text_size(text)
-    if width <= max_width:
-        return text, height
-
-    processed = True
-
-    _wrapped_lines_ = []
-    words = text.split(" ")
-    _txt_ = ""
-    for word in words:
-        _before = _txt_
-        _txt_ += f"{word} "
-        _width, _height = get_text_size(_txt_)
-        if _width <= max_width:
-            continue
-        else:
-            if _txt_.strip() == word.strip():
-                processed = False
-                break
-            _wrapped_lines_.append(_before)
-            _txt_ = f"{word} "
-    _wrapped_lines_.append(_txt_)
-    if processed:
-        _wrapped_lines_ = [line.strip() for line in _wrapped_lines_]
-        result = "\n".join(_wrapped_lines_).strip()
-        height = len(_wrapped_lines_) * height
-        return result, height
-
-    _wrapped_lines_ = []
-    chars = list(text)
-    _txt_ = ""
-    for word in chars:
-        _txt_ += word
-        _width, _height = get_text_size(_txt_)
-        if _width <= max_width:
-            continue
-        else:
-            _wrapped_lines_.append(_txt_)
-            _txt_ = ""
-    _wrapped_lines_.append(_txt_)
-    result = "\n".join(_wrapped_lines_).strip()
-    height = len(_wrapped_lines_) * height
-    return result, height
+def get_subtitle_modes(params: VideoParams):
+    """
+    Whether the subtitles are burned into the frames, and whether they are muxed as a text track.
+    """
+    mode = SubtitleMode(params.subtitle_mode or SubtitleMode.burn.value)
+    return mode.value != SubtitleMode.soft.value, mode.value != SubtitleMode.burn.value
 
 
 def generate_video(
@@ -366,9 +939,9 @@ def generate_video(
     subtitle_path: str,
     output_file: str,
     params: VideoParams,
+    rng: random.Random = None,
 ):
-    aspect = VideoAspect(params.video_aspect)
-    video_width, video_height = aspect.to_resolution()
+    video_width, video_height = get_video_resolution(params.video_aspect, params.video_preview)
 
     logger.info(f"generating video: {video_width} x {video_height}")
     logger.info(f"  ① video: {video_path}")
@@ -376,10 +949,62 @@ def generate_video(
     logger.info(f"  ③ subtitle: {subtitle_path}")
     logger.info(f"  ④ output: {output_file}")
 
-    # https://github.com/harry0703/MoneyPrinterTurbo/issues/217
-    # PermissionError: [WinError 32] The process cannot access the file because it is being used by another process: 'final-1.mp4.tempTEMP_MPY_wvf_snd.mp3'
-    # write into the same directory as the output file
-    output_dir = os.path.dirname(output_file)
+    infos = media_probe.read_infos(video_path)
+    burn_subtitles, soft_subtitles = get_subtitle_modes(params)
+    final_encoding = get_final_encoding_profile(params)
+    # the combined video is encoded with the intermediate profile, it is only kept when that is the final one
+    if (
+        not burn_subtitles
+        and is_same_encoding(get_intermediate_encoding_profile(final_encoding), final_encoding)
+        and is_stream_copyable(infos, video_width, video_height, final_encoding)
+    ):
+        # nothing is drawn on the frames, the combined video is muxed with the audio and subtitles as it is
+        logger.info("subtitles are not burned in, copying the video stream of the combined video")
+        mux_audio(video_path, audio_path, output_file, params, rng, subtitle_path=subtitle_path if soft_subtitles else "")
+        return
+
+    # the combined video fills the whole timeline, as one slot without transition
+    duration = infos["duration"]
+    timeline = [
+        {
+            "slot": 1,
+            "start": 0,
+            "duration": duration,
+            "job": {
+                "subclipped_item": SubClippedVideoClip(
+                    file_path=video_path, start_time=0, end_time=duration, width=infos["width"], height=infos["height"]
+                ),
+                "clip_file": video_path,
+                "video_width": video_width,
+                "video_height": video_height,
+                "transition": VideoTransitionMode.none,
+                "side": "",
+                "max_clip_duration": duration,
+            },
+        }
+    ]
+    render_timeline(
+        timeline=timeline,
+        audio_path=audio_path,
+        subtitle_path=subtitle_path,
+        output_file=output_file,
+        params=params,
+        rng=rng,
+    )
+
+
+def make_subtitle_captions(subtitle_path: str, params: VideoParams, video_width: int, video_height: int) -> list:
+    """
+    Render the subtitles styled for the video resolution, each one as a dict with its RGBA image,
+    the x, y position of its top left corner and its start and end times.
+    """
+    if not subtitle_path or not os.path.exists(subtitle_path):
+        return []
+
+    # subtitles are styled for the full resolution, scale them with the preview
+    scale = video_width / VideoAspect(params.video_aspect).to_resolution()[0]
+    font_size = int(int(params.font_size) * scale)
+    stroke_width = int(int(params.stroke_width) * scale)
 
     font_path = ""
     if params.subtitle_enabled:
@@ -391,112 +1016,662 @@ def generate_video(
 
         logger.info(f"  ⑤ font: {font_path}")
 
-    def create_text_clip(subtitle_item):
-        params.font_size = int(params.font_size)
-        params.stroke_width = int(params.stroke_width)
+    def create_caption(subtitle_item):
         phrase = subtitle_item[1]
-        max_width = video_width * 0.9
-        wrapped_txt, txt_height = wrap_text(
-            phrase, max_width=max_width, font=font_path, fontsize=params.font_size
-        )
-        interline = int(params.font_size * 0.25)
-        size=(int(max_width), int(txt_height + params.font_size * 0.25 + (interline * (wrapped_txt.count("\n") + 1))))
-
-        _clip = TextClip(
-            text=wrapped_txt,
-            font=font_path,
-            font_size=params.font_size,
+        image = subtitle_raster.render_subtitle(
+            phrase,
+            font_path=font_path,
+            font_size=font_size,
+            max_width=video_width * 0.9,
             color=params.text_fore_color,
             bg_color=params.text_background_color,
             stroke_color=params.stroke_color,
-            stroke_width=params.stroke_width,
-            # interline=interline,
-            # size=size,
+            stroke_width=stroke_width,
         )
-        duration = subtitle_item[0][1] - subtitle_item[0][0]
-        _clip = _clip.with_start(subtitle_item[0][0])
-        _clip = _clip.with_end(subtitle_item[0][1])
-        _clip = _clip.with_duration(duration)
+        image_height = image.shape[0]
         if params.subtitle_position == "bottom":
-            _clip = _clip.with_position(("center", video_height * 0.95 - _clip.h))
+            position = ("center", video_height * 0.95 - image_height)
         elif params.subtitle_position == "top":
-            _clip = _clip.with_position(("center", video_height * 0.05))
+            position = ("center", video_height * 0.05)
         elif params.subtitle_position == "custom":
             # Ensure the subtitle is fully within the screen bounds
             margin = 10  # Additional margin, in pixels
-            max_y = video_height - _clip.h - margin
+            max_y = video_height - image_height - margin
             min_y = margin
-            custom_y = (video_height - _clip.h) * (params.custom_position / 100)
+            custom_y = (video_height - image_height) * (params.custom_position / 100)
             custom_y = max(
                 min_y, min(custom_y, max_y)
             )  # Constrain the y value within the valid range
-            _clip = _clip.with_position(("center", custom_y))
+            position = ("center", custom_y)
         else:  # center
-            _clip = _clip.with_position(("center", "center"))
-        return _clip
+            position = ("center", "center")
+        x, y = compute_position(image.shape[1::-1], (video_width, video_height), position)
+        return {"image": image, "x": x, "y": y, "start": subtitle_item[0][0], "end": subtitle_item[0][1]}
 
-    video_clip = VideoFileClip(video_path).without_audio()
-    audio_clip = AudioFileClip(audio_path).with_effects(
-        [afx.MultiplyVolume(params.voice_volume)]
-    )
+    captions = []
+    for item in file_to_subtitles(subtitle_path, encoding="utf-8"):
+        captions.append(create_caption(subtitle_item=item))
+    return captions
 
-    def make_textclip(text):
-        return TextClip(
-            text=text,
-            font=font_path,
-            font_size=params.font_size,
-        )
 
-    if subtitle_path and os.path.exists(subtitle_path):
-        sub = SubtitlesClip(
-            subtitles=subtitle_path, encoding="utf-8", make_textclip=make_textclip
+def render_final_video(
+    video_clip,
+    audio_path: str,
+    subtitle_path: str,
+    output_file: str,
+    params: VideoParams,
+    rng: random.Random = None,
+):
+    """
+    Overlay the subtitles on the video clip and encode it with the voice mixed with the background music,
+    see get_mixed_audio(). Without audio_path only the video is encoded.
+    """
+    video_width, video_height = get_video_resolution(params.video_aspect, params.video_preview)
+
+    captions = make_subtitle_captions(subtitle_path, params, video_width, video_height)
+    if captions:
+        video_clip = subtitle_overlay.overlay_subtitles(video_clip, captions)
+
+    if not audio_path:
+        video_clip.write_videofile(
+            output_file,
+            audio=False,
+            threads=params.n_threads or 2,
+            logger=None,
+            **encoding_write_params(get_final_encoding_profile(params)),
         )
-        text_clips = []
-        for item in sub.subtitles:
-            clip = create_text_clip(subtitle_item=item)
-            text_clips.append(clip)
-        video_clip = CompositeVideoClip([video_clip, *text_clips])
-
-    bgm_file = get_bgm_file(bgm_type=params.bgm_type, bgm_file=params.bgm_file)
-    if bgm_file:
-        try:
-            bgm_clip = AudioFileClip(bgm_file).with_effects(
-                [
-                    afx.MultiplyVolume(params.bgm_volume),
-                    afx.AudioFadeOut(3),
-                    afx.AudioLoop(duration=video_clip.duration),
-                ]
-            )
-            audio_clip = CompositeAudioClip([audio_clip, bgm_clip])
-        except Exception as e:
-            logger.error(f"failed to add bgm: {str(e)}")
+        video_clip.close()
+        return
 
-    video_clip = video_clip.with_audio(audio_clip)
+    # the voice and the background music are mixed once and copied into the video
+    mixed_audio_file = get_mixed_audio(audio_path, params, video_clip.duration, rng)
     video_clip.write_videofile(
         output_file,
-        audio_codec=audio_codec,
-        temp_audiofile_path=output_dir,
+        audio=mixed_audio_file,
         threads=params.n_threads or 2,
         logger=None,
-        fps=fps,
+        **encoding_write_params(get_final_encoding_profile(params)),
     )
     video_clip.close()
     del video_clip
 
 
+class RenderBackend:
+    """
+    Renders a planned timeline (see plan_timeline()) with the subtitles, the voice and the background music
+    into the final video.
+    """
+
+    name = ""
+
+    def render(
+        self,
+        timeline: List[dict],
+        audio_path: str,
+        subtitle_path: str,
+        output_file: str,
+        params: VideoParams,
+        combined_video_path: str = "",
+        rng: random.Random = None,
+    ) -> str:
+        """
+        Returns the output file, or an empty string when no clip could be rendered.
+        The combined video, without subtitles and audio, is also written when combined_video_path is set.
+        With an empty audio_path only the video is rendered, without the voice and background music.
+        """
+        raise NotImplementedError()
+
+
+class MoviePyRenderBackend(RenderBackend):
+    """
+    Composites the frames in Python with MoviePy.
+    """
+
+    name = "moviepy"
+
+    def render(
+        self,
+        timeline: List[dict],
+        audio_path: str,
+        subtitle_path: str,
+        output_file: str,
+        params: VideoParams,
+        combined_video_path: str = "",
+        rng: random.Random = None,
+    ) -> str:
+        # looped slots reuse the clip built for the first slot of the same sub-clip
+        base_clips = {}
+        clips = []
+        for entry in timeline:
+            job = entry["job"]
+            if job["clip_file"] not in base_clips:
+                try:
+                    base_clips[job["clip_file"]] = build_subclip(
+                        subclipped_item=job["subclipped_item"],
+                        video_width=job["video_width"],
+                        video_height=job["video_height"],
+                        transition=job["transition"],
+                        side=job["side"],
+                        max_clip_duration=job["max_clip_duration"],
+                    )
+                except Exception as e:
+                    logger.error(f"failed to process clip: {str(e)}")
+                    base_clips[job["clip_file"]] = None
+            if base_clips[job["clip_file"]] is not None:
+                clips.append(base_clips[job["clip_file"]])
+
+        if not clips:
+            logger.warning("no clips available for the video")
+            return ""
+
+        video_clip = concatenate_videoclips(clips) if len(clips) > 1 else clips[0]
+        if combined_video_path:
+            logger.info(f"writing combined video for debugging: {combined_video_path}")
+            encoding = get_intermediate_encoding_profile(get_final_encoding_profile(params))
+            video_clip.write_videofile(combined_video_path, logger=None, audio=False, threads=params.n_threads or 2, **encoding_write_params(encoding))
+
+        render_final_video(
+            video_clip=video_clip,
+            audio_path=audio_path,
+            subtitle_path=subtitle_path,
+            output_file=output_file,
+            params=params,
+            rng=rng,
+        )
+        for clip in base_clips.values():
+            if clip is not None:
+                close_clip(clip)
+        return output_file
+
+
+class FFmpegRenderBackend(RenderBackend):
+    """
+    Compiles the timeline into one ffmpeg filter_complex graph: scale/pad and fades for the clips,
+    overlays for the subtitles, rendered to images by subtitle_raster as for the MoviePy backend.
+    The audio is the mixed track of get_mixed_audio(), copied into the output.
+    The frames never go through Python, ffmpeg decodes, filters and encodes them in its own threads.
+    """
+
+    name = "ffmpeg"
+
+    def render(
+        self,
+        timeline: List[dict],
+        audio_path: str,
+        subtitle_path: str,
+        output_file: str,
+        params: VideoParams,
+        combined_video_path: str = "",
+        rng: random.Random = None,
+    ) -> str:
+        if not timeline:
+            logger.warning("no clips available for the video")
+            return ""
+
+        video_width, video_height = get_video_resolution(params.video_aspect, params.video_preview)
+        encoding = get_final_encoding_profile(params)
+        duration = sum(entry["duration"] for entry in timeline)
+
+        slots = []
+        for entry in timeline:
+            job = entry["job"]
+            subclipped_item = job["subclipped_item"]
+            width, height = subclipped_item.width, subclipped_item.height
+            if not width or not height:
+                infos = media_probe.probe(subclipped_item.file_path)
+                width, height = infos["width"], infos["height"]
+            slots.append(
+                {
+                    "source": subclipped_item.file_path,
+                    "start": subclipped_item.start_time,
+                    "duration": entry["duration"],
+                    "width": width,
+                    "height": height,
+                    "transition": job["transition"].value,
+                }
+            )
+
+        temp_files = []
+        overlays = []
+        for i, caption in enumerate(make_subtitle_captions(subtitle_path, params, video_width, video_height)):
+            image_file = f"{output_file}.subtitle-{i+1}.png"
+            Image.fromarray(caption["image"]).save(image_file)
+            temp_files.append(image_file)
+            overlays.append(dict(caption, image=image_file))
+
+        input_args, filter_graph = ffmpeg_render.build_render_args(
+            slots=slots,
+            overlays=overlays,
+            video_width=video_width,
+            video_height=video_height,
+            fps=encoding["fps"],
+            combined=bool(combined_video_path),
+        )
+        audio_args = ["-an"]
+        if audio_path:
+            # the mixed audio track is copied as it is
+            audio_args = ["-map", f"{input_args.count('-i')}:a:0", "-c:a", "copy"]
+            input_args += ["-i", get_mixed_audio(audio_path, params, duration, rng)]
+        # the graph grows with the clips and subtitles, keep it off the command line
+        filter_file = f"{output_file}.filter.txt"
+        with open(filter_file, "w", encoding="utf-8") as f:
+            f.write(filter_graph)
+        temp_files.append(filter_file)
+
+        args = [
+            *input_args,
+            "-filter_complex_script",
+            filter_file,
+            "-map",
+            "[vout]",
+            *encoding_ffmpeg_args(encoding),
+            *audio_args,
+            "-threads",
+            str(params.n_threads or 2),
+            "-t",
+            f"{duration:.6f}",
+            "-movflags",
+            "+faststart",
+            output_file,
+        ]
+        if combined_video_path:
+            logger.info(f"writing combined video for debugging: {combined_video_path}")
+            intermediate = get_intermediate_encoding_profile(encoding)
+            args += ["-map", "[vcombined]", "-an", *encoding_ffmpeg_args(intermediate), combined_video_path]
+
+        try:
+            if not ffmpeg_tools.run_ffmpeg(args):
+                raise IOError(f"failed to render video: {output_file}")
+        finally:
+            delete_files(temp_files)
+        return output_file
+
+
+render_backends = {
+    MoviePyRenderBackend.name: MoviePyRenderBackend(),
+    FFmpegRenderBackend.name: FFmpegRenderBackend(),
+}
+
+
+def get_render_backend(name: str = "") -> RenderBackend:
+    name = name or config.app.get("render_backend", MoviePyRenderBackend.name)
+    if name not in render_backends:
+        logger.warning(f"unknown render backend: {name}, using {MoviePyRenderBackend.name}")
+        name = MoviePyRenderBackend.name
+    return render_backends[name]
+
+
+def split_timeline(timeline: List[dict], segment_count: int, frame_rate: int = fps) -> List[List[dict]]:
+    """
+    Split a timeline into at most segment_count segments of about the same duration, at clip boundaries.
+    A slot without transition that is longer than a segment, e.g. the combined video, is cut into several slots,
+    on frame boundaries. The slots of each segment start at 0.
+    """
+    total_duration = sum(entry["duration"] for entry in timeline)
+    if segment_count <= 1 or not timeline:
+        return [timeline]
+    segment_duration = max(1, round(total_duration / segment_count * frame_rate)) / frame_rate
+
+    slots = []
+    for entry in timeline:
+        job = entry["job"]
+        offset = 0
+        while job["transition"].value == VideoTransitionMode.none.value and entry["duration"] - offset > segment_duration * 1.5:
+            slots.append(offset_slot(entry, offset, segment_duration))
+            offset += segment_duration
+        slots.append(offset_slot(entry, offset, entry["duration"] - offset) if offset else entry)
+
+    segments = [[]]
+    segment_start = 0
+    elapsed = 0
+    for entry in slots:
+        if segments[-1] and elapsed >= segment_duration * len(segments) and len(segments) < segment_count:
+            segments.append([])
+            segment_start = elapsed
+        segments[-1].append(dict(entry, start=elapsed - segment_start))
+        elapsed += entry["duration"]
+    return segments
+
+
+def offset_slot(entry: dict, offset: float, duration: float) -> dict:
+    """
+    The part of a slot that starts `offset` seconds into it and lasts `duration` seconds.
+    """
+    job = entry["job"]
+    subclipped_item = job["subclipped_item"]
+    start_time = subclipped_item.start_time + offset
+    part = dict(job)
+    part["subclipped_item"] = SubClippedVideoClip(
+        file_path=subclipped_item.file_path,
+        start_time=start_time,
+        end_time=start_time + duration,
+        width=subclipped_item.width,
+        height=subclipped_item.height,
+    )
+    part["max_clip_duration"] = duration
+    part["clip_file"] = job["clip_file"].replace(".mp4", f"-part-{round(offset * 1000)}.mp4")
+    return dict(entry, start=entry["start"] + offset, duration=duration, job=part)
+
+
+def write_segment_subtitles(subtitle_path: str, segment_start: float, segment_end: float, output_file: str) -> str:
+    """
+    Write the subtitles shown between segment_start and segment_end, with times relative to the segment.
+    """
+    if not subtitle_path or not os.path.exists(subtitle_path):
+        return ""
+
+    items = []
+    for (start_time, end_time), text in file_to_subtitles(subtitle_path, encoding="utf-8"):
+        if end_time <= segment_start or start_time >= segment_end:
+            continue
+        start_time = max(start_time, segment_start) - segment_start
+        end_time = min(end_time, segment_end) - segment_start
+        items.append(utils.text_to_srt(len(items) + 1, text, start_time, end_time))
+    if not items:
+        return ""
+
+    with open(output_file, "w", encoding="utf-8") as f:
+        f.write("\n".join(items) + "\n")
+    return output_file
+
+
+def render_segment(backend_name: str, timeline: List[dict], subtitle_path: str, output_file: str, params: VideoParams) -> str:
+    return get_render_backend(backend_name).render(
+        timeline=timeline,
+        audio_path="",
+        subtitle_path=subtitle_path,
+        output_file=output_file,
+        params=params,
+    )
+
+
+def mix_audio(
+    audio_path: str,
+    output_file: str,
+    voice_volume: float,
+    bgm_file: str,
+    bgm_volume: float,
+    duration: float,
+) -> str:
+    """
+    Mix the voice with the looped background music into one AAC track of duration seconds,
+    the volume, fade out and loop are the ones of the MoviePy effects the renders used to apply.
+    """
+    audio_args, audio_filters = ffmpeg_render.build_audio_args(
+        input_index=0,
+        audio_path=audio_path,
+        voice_volume=voice_volume,
+        bgm_file=bgm_file,
+        bgm_volume=bgm_volume,
+        bgm_duration=media_probe.probe(bgm_file)["duration"] if bgm_file else 0,
+        duration=duration,
+    )
+    args = [
+        *audio_args,
+        "-filter_complex",
+        ";".join(audio_filters),
+        "-map",
+        "[aout]",
+        *audio_output_args(),
+        "-f",
+        "mp4",
+        output_file,
+    ]
+    if not ffmpeg_tools.run_ffmpeg(args):
+        raise IOError(f"failed to mix audio: {output_file}")
+    return output_file
+
+
+def get_mixed_audio(audio_path: str, params: VideoParams, duration: float, rng: random.Random = None) -> str:
+    """
+    The voice mixed with the background music of params, encoded once into an AAC file next to the voice,
+    e.g. in the task directory, and copied into the videos by every render, variant and restyle with the same mix.
+    Keyed by the content of the voice and the bgm, the volumes and the duration.
+    With bgm_target_loudness set, the volume of the bgm is scaled so the song plays at that loudness.
+    """
+    bgm_file = get_bgm_file(bgm_type=params.bgm_type, bgm_file=params.bgm_file, rng=rng)
+    bgm_volume = params.bgm_volume
+    target_loudness = config.app.get("bgm_target_loudness", 0)
+    if bgm_file and target_loudness:
+        # from the loudness of the song index, the song is not decoded to measure it
+        bgm_volume *= song_index.gain(bgm_file, target_loudness)
+    key = utils.md5(
+        json.dumps(
+            {
+                "voice": file_hash(audio_path),
+                "voice_volume": params.voice_volume,
+                "bgm": file_hash(bgm_file) if bgm_file else "",
+                "bgm_volume": bgm_volume if bgm_file else 0,
+                "duration": round(float(duration), 3),
+                "codec": audio_output_args(),
+            },
+            sort_keys=True,
+        )
+    )
+    name = os.path.splitext(os.path.basename(audio_path))[0]
+    mixed_audio_file = os.path.join(os.path.dirname(audio_path), f"{name}-mix-{key}.m4a")
+    if os.path.exists(mixed_audio_file):
+        logger.debug(f"reusing mixed audio: {mixed_audio_file}")
+        return mixed_audio_file
+
+    # variants rendered in parallel may mix the same track, the first one written wins
+    temp_file = f"{mixed_audio_file}.{uuid.uuid4().hex}.tmp"
+    try:
+        try:
+            mix_audio(audio_path, temp_file, params.voice_volume, bgm_file, bgm_volume, duration)
+        except Exception as e:
+            if not bgm_file:
+                raise
+            logger.error(f"failed to add bgm: {str(e)}")
+            mix_audio(audio_path, temp_file, params.voice_volume, "", 0, duration)
+        os.replace(temp_file, mixed_audio_file)
+    finally:
+        delete_files(temp_file)
+    logger.info(f"mixed audio: {mixed_audio_file}")
+    return mixed_audio_file
+
+
+def mux_audio(
+    video_file: str,
+    audio_path: str,
+    output_file: str,
+    params: VideoParams,
+    rng: random.Random = None,
+    subtitle_path: str = "",
+) -> str:
+    """
+    Mux the video with the voice mixed with the background music, see get_mixed_audio(). Both are copied
+    without re-encoding. With subtitle_path, the subtitles are added as a mov_text track.
+    """
+    duration = media_probe.read_infos(video_file)["duration"]
+    mixed_audio_file = get_mixed_audio(audio_path, params, duration, rng)
+    if subtitle_path and not os.path.exists(subtitle_path):
+        subtitle_path = ""
+    if not ffmpeg_tools.replace_audio(video_file, mixed_audio_file, output_file, subtitle_path=subtitle_path):
+        raise IOError(f"failed to mux audio: {output_file}")
+    return output_file
+
+
+def remux_audio(
+    video_file: str,
+    audio_path: str,
+    params: VideoParams,
+    rng: random.Random = None,
+    subtitle_path: str = "",
+    output_file: str = "",
+) -> str:
+    """
+    Replace the audio of a rendered video with a new mix of the voice and the background music,
+    the video stream is copied, so a bgm variant only costs the audio mix. The video is replaced in place
+    unless output_file is given. The subtitles are muxed again as a text track if the subtitle_mode has one.
+    """
+    _, soft_subtitles = get_subtitle_modes(params)
+    output_file = output_file or video_file
+    temp_file = f"{output_file}.remux.mp4"
+    try:
+        mux_audio(video_file, audio_path, temp_file, params, rng, subtitle_path=subtitle_path if soft_subtitles else "")
+    except Exception:
+        delete_files(temp_file)
+        raise
+    os.replace(temp_file, output_file)
+    return output_file
+
+
+def add_subtitle_track(video_file: str, subtitle_path: str):
+    """
+    Mux the subtitles into the video as a mov_text track, the other streams are copied.
+    """
+    temp_file = f"{video_file}.subtitled.mp4"
+    if not ffmpeg_tools.mux_subtitles(video_file, subtitle_path, temp_file):
+        delete_files(temp_file)
+        raise IOError(f"failed to mux subtitles: {video_file}")
+    os.replace(temp_file, video_file)
+
+
+def render_timeline(
+    timeline: List[dict],
+    audio_path: str,
+    subtitle_path: str,
+    output_file: str,
+    params: VideoParams,
+    combined_video_path: str = "",
+    rng: random.Random = None,
+) -> str:
+    """
+    Render the final video with the configured backend. With render_segments > 1, the timeline is split into
+    segments rendered in parallel processes, the video of each one with its subtitles, then the segments are
+    joined without re-encoding and the mixed audio is muxed once over the whole video.
+    With render_distributed, the segments are rendered by the worker nodes of the Redis queue instead,
+    see render_queue.render_segments().
+    The subtitle_mode of params selects whether the subtitles are burned in, muxed as a text track, or both.
+    """
+    burn_subtitles, soft_subtitles = get_subtitle_modes(params)
+    soft_subtitle_path = subtitle_path if soft_subtitles else ""
+    if not burn_subtitles:
+        subtitle_path = ""
+
+    backend = get_render_backend()
+    segment_count = config.app.get("render_segments", 1)
+    segments = split_timeline(timeline, segment_count, get_final_encoding_profile(params)["fps"])
+    if len(segments) <= 1 or combined_video_path:
+        backend.render(
+            timeline=timeline,
+            audio_path=audio_path,
+            subtitle_path=subtitle_path,
+            output_file=output_file,
+            params=params,
+            combined_video_path=combined_video_path,
+            rng=rng,
+        )
+        if soft_subtitle_path and os.path.exists(soft_subtitle_path):
+            add_subtitle_track(output_file, soft_subtitle_path)
+        return output_file
+
+    distributed = config.app.get("render_distributed", False) and config.app.get("enable_redis", False)
+    logger.info(f"rendering {len(segments)} segments {'on the worker nodes' if distributed else 'in parallel'} with the {backend.name} backend")
+    segment_jobs = []
+    temp_files = []
+    segment_start = 0
+    for i, segment in enumerate(segments):
+        segment_end = segment_start + sum(entry["duration"] for entry in segment)
+        segment_file = f"{output_file}.segment-{i+1}.mp4"
+        segment_subtitle_path = write_segment_subtitles(
+            subtitle_path, segment_start, segment_end, f"{output_file}.segment-{i+1}.srt"
+        )
+        temp_files.extend([segment_file, segment_subtitle_path])
+        segment_jobs.append(
+            {
+                "backend_name": backend.name,
+                "timeline": segment,
+                "subtitle_path": segment_subtitle_path,
+                "output_file": segment_file,
+                "params": params,
+            }
+        )
+        segment_start = segment_end
+
+    try:
+        if distributed:
+            from app.services import render_queue
+
+            segment_files = render_queue.render_segments(segment_jobs)
+            temp_files.extend(segment_files)
+        else:
+            with ProcessPoolExecutor(max_workers=len(segments), mp_context=multiprocessing.get_context("spawn")) as executor:
+                futures = [executor.submit(render_segment, **job) for job in segment_jobs]
+                segment_files = [future.result() for future in futures]
+        if not all(segment_files):
+            raise IOError(f"failed to render a segment of {output_file}")
+
+        # the segments share the encoding settings of the final profile, they are joined as they are
+        video_file = f"{output_file}.video.mp4"
+        temp_files.append(video_file)
+        if not ffmpeg_tools.concat_videos(segment_files, video_file):
+            raise IOError(f"failed to join the segments of {output_file}")
+        mux_audio(video_file, audio_path, output_file, params, rng, subtitle_path=soft_subtitle_path)
+    finally:
+        delete_files([file for file in set(temp_files) if file])
+    return output_file
+
+
+def generate_video_fused(
+    video_paths: List[str],
+    audio_path: str,
+    subtitle_path: str,
+    output_file: str,
+    params: VideoParams,
+    video_concat_mode: VideoConcatMode = VideoConcatMode.random,
+    combined_video_path: str = "",
+    rng: random.Random = None,
+    timeline_file: str = "",
+):
+    """
+    Build one timeline of the sub-clips, subtitles, voice and background music and encode it once.
+    The sub-clips are not written to temp files, the combined video is only written when combined_video_path is set,
+    which costs one more encode and is meant for debugging.
+    """
+    audio_duration = media_probe.probe(audio_path)["duration"]
+    logger.info(f"generating video in a single pass, audio duration: {audio_duration} seconds")
+    logger.info(f"  ① materials: {len(video_paths)}")
+    logger.info(f"  ② audio: {audio_path}")
+    logger.info(f"  ③ subtitle: {subtitle_path}")
+    logger.info(f"  ④ output: {output_file}")
+
+    jobs = plan_subclip_jobs(
+        video_paths=video_paths,
+        output_dir=os.path.dirname(output_file),
+        video_aspect=params.video_aspect,
+        video_concat_mode=video_concat_mode,
+        video_transition_mode=params.video_transition_mode,
+        max_clip_duration=params.video_clip_duration,
+        preview=params.video_preview,
+        rng=rng,
+    )
+
+    timeline = plan_timeline(jobs, audio_duration, min_duration=1 / get_final_encoding_profile(params)["fps"])
+    if timeline_file:
+        save_timeline(timeline, timeline_file)
+
+    return render_timeline(
+        timeline=timeline,
+        audio_path=audio_path,
+        subtitle_path=subtitle_path,
+        output_file=output_file,
+        params=params,
+        combined_video_path=combined_video_path,
+        rng=rng,
+    )
+
+
 def preprocess_video(materials: List[MaterialInfo], clip_duration=4):
     for material in materials:
         if not material.url:
             continue
 
         ext = utils.parse_extension(material.url)
-        try:
-            clip = VideoFileClip(material.url)
-        except Exception:
-            clip = ImageClip(material.url)
-
-        width = clip.size[0]
-        height = clip.size[1]
+        infos = media_probe.probe(material.url)
+        width = infos["width"]
+        height = infos["height"]
         if width < 480 or height < 480:
             logger.warning(f"low resolution material: {width}x{height}, minimum 480x480 required")
             continue
@@ -524,7 +1699,8 @@ def preprocess_video(materials: List[MaterialInfo], clip_duration=4):
 
             # Output the video to a file.
             video_file = f"{material.url}.mp4"
-            final_clip.write_videofile(video_file, fps=30, logger=None)
+            encoding = get_intermediate_encoding_profile(get_encoding_profile())
+            final_clip.write_videofile(video_file, logger=None, **encoding_write_params(encoding))
             close_clip(clip)
             material.url = video_file
             logger.success(f"image processed: {video_file}")
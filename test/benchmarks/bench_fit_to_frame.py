@@ -0,0 +1,81 @@
+"""
+Benchmark: fitting a 1080p landscape clip into the 1080x1920 portrait frame,
+with a CompositeVideoClip over a black ColorClip and with the fit_to_frame effect.
+
+Usage:
+    python test/benchmarks/bench_fit_to_frame.py [duration]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from moviepy import ColorClip, CompositeVideoClip, VideoClip, VideoFileClip
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.services.utils import video_effects
+
+video_width, video_height = 1080, 1920
+
+
+def make_source(file_path, duration):
+    # a moving gradient, so every frame differs
+    x = np.linspace(0, 255, 1920, dtype=np.float32)[None, :, None]
+    y = np.linspace(0, 255, 1080, dtype=np.float32)[:, None, None]
+
+    def frame_function(t):
+        frame = (x + y * 0.5 + t * 40) % 256
+        return np.broadcast_to(frame, (1080, 1920, 3)).astype(np.uint8)
+
+    clip = VideoClip(frame_function, duration=duration)
+    clip.write_videofile(file_path, fps=30, codec="libx264", logger=None)
+    clip.close()
+
+
+def fit_with_composite(clip):
+    # the combine stage before fit_to_frame
+    new_height = int(clip.h * video_width / clip.w)
+    background = ColorClip(size=(video_width, video_height), color=(0, 0, 0)).with_duration(clip.duration)
+    clip_resized = clip.resized(new_size=(video_width, new_height)).with_position("center")
+    return CompositeVideoClip([background, clip_resized])
+
+
+def fit_with_effect(clip):
+    return video_effects.fit_to_frame(clip, video_width, video_height)
+
+
+def run(name, fit, source_file):
+    clip = VideoFileClip(source_file, audio=False)
+    fitted = fit(clip)
+    start = time.perf_counter()
+    frames = 0
+    for _ in fitted.iter_frames(fps=30, dtype="uint8"):
+        frames += 1
+    elapsed = time.perf_counter() - start
+    clip.close()
+    print(f"{name:>10}: {elapsed:6.2f}s, {frames / elapsed:6.1f} frames/s")
+    return elapsed
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    temp_dir = tempfile.mkdtemp()
+    try:
+        source_file = os.path.join(temp_dir, "source.mp4")
+        make_source(source_file, duration)
+
+        print(f"fitting {duration}s of 1920x1080 into {video_width}x{video_height}")
+        composite = run("composite", fit_with_composite, source_file)
+        effect = run("effect", fit_with_effect, source_file)
+        print(f"speedup: {composite / effect:.2f}x")
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Benchmark: CPU time of encoding the combine stage sub-clips with and without the source audio.
+
+Usage:
+    python test/benchmarks/bench_intermediate_audio.py [clip_count]
+"""
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from moviepy import AudioClip, ColorClip, VideoFileClip
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.models.schema import VideoTransitionMode
+from app.services import video as vd
+
+
+def cpu_time():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def make_source(file_path, duration):
+    audio = AudioClip(
+        lambda t: np.sin(2 * np.pi * 440 * t) * 0.1, duration=duration, fps=44100
+    )
+    clip = ColorClip(size=(1080, 1920), color=(40, 80, 120)).with_duration(duration).with_audio(audio)
+    clip.write_videofile(file_path, fps=30, codec="libx264", audio_codec="aac", logger=None)
+    clip.close()
+
+
+def encode_with_audio(source_file, clip_file, start_time, end_time):
+    # the combine stage before intermediates were made video-only
+    clip = VideoFileClip(source_file).subclipped(start_time, end_time)
+    clip.write_videofile(clip_file, logger=None, fps=vd.fps, codec=vd.video_codec)
+    vd.close_clip(clip)
+
+
+def encode_without_audio(source_file, clip_file, start_time, end_time):
+    vd.process_subclip(
+        subclipped_item=vd.SubClippedVideoClip(file_path=source_file, start_time=start_time, end_time=end_time),
+        clip_file=clip_file,
+        video_width=1080,
+        video_height=1920,
+        transition=VideoTransitionMode.none,
+        side="left",
+        max_clip_duration=end_time - start_time,
+    )
+
+
+def run(name, encode, source_file, temp_dir, clip_count, clip_duration):
+    cpu_start, wall_start = cpu_time(), time.perf_counter()
+    for i in range(clip_count):
+        start_time = i * clip_duration
+        encode(source_file, os.path.join(temp_dir, f"{name}-{i}.mp4"), start_time, start_time + clip_duration)
+    cpu, wall = cpu_time() - cpu_start, time.perf_counter() - wall_start
+    print(f"{name:>16}: cpu {cpu:7.2f}s, wall {wall:7.2f}s")
+    return cpu
+
+
+def main():
+    clip_count = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    clip_duration = 2
+    temp_dir = tempfile.mkdtemp()
+    vd.clip_cache.enabled = False
+    try:
+        source_file = os.path.join(temp_dir, "source.mp4")
+        make_source(source_file, clip_count * clip_duration)
+
+        print(f"encoding {clip_count} sub-clips of {clip_duration}s at 1080x1920")
+        with_audio = run("with audio", encode_with_audio, source_file, temp_dir, clip_count, clip_duration)
+        without_audio = run("video only", encode_without_audio, source_file, temp_dir, clip_count, clip_duration)
+        print(f"cpu saved: {with_audio - without_audio:.2f}s ({(1 - without_audio / with_audio) * 100:.1f}%)")
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Benchmark: blending 240 subtitle lines over a 3 minute 1080x1920 video,
+with a CompositeVideoClip of the caption clips and with the interval-indexed subtitle overlay.
+Only every `step`-th frame is rendered, the composite takes minutes for the whole video.
+
+Usage:
+    python test/benchmarks/bench_subtitle_overlay.py [step]
+"""
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from moviepy import CompositeVideoClip, ImageClip, VideoClip
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.services.utils import subtitle_overlay, subtitle_raster
+from app.utils import utils
+
+video_width, video_height = 1080, 1920
+duration = 180
+line_count = 240
+fps = 30
+
+
+def make_background():
+    x = np.linspace(0, 255, video_width, dtype=np.float32)[None, :, None]
+
+    def frame_function(t):
+        return np.broadcast_to((x + t * 40) % 256, (video_height, video_width, 3)).astype(np.uint8)
+
+    return VideoClip(frame_function, duration=duration)
+
+
+def make_captions():
+    font_path = os.path.join(utils.font_dir(), "Charm-Regular.ttf")
+    line_duration = duration / line_count
+    captions = []
+    for i in range(line_count):
+        image = subtitle_raster.render_subtitle(
+            f"subtitle line number {i + 1} of the script",
+            font_path=font_path,
+            font_size=60,
+            max_width=video_width * 0.9,
+            color="#FFFFFF",
+            bg_color=True,
+            stroke_color="#000000",
+            stroke_width=1,
+        )
+        x = (video_width - image.shape[1]) // 2
+        y = int(video_height * 0.95 - image.shape[0])
+        # a short gap between the lines, as in the generated subtitles
+        start = i * line_duration
+        captions.append({"image": image, "x": x, "y": y, "start": start, "end": start + line_duration * 0.9})
+    return captions
+
+
+def with_composite(clip, captions):
+    text_clips = [
+        ImageClip(caption["image"]).with_start(caption["start"]).with_end(caption["end"]).with_position((caption["x"], caption["y"]))
+        for caption in captions
+    ]
+    return CompositeVideoClip([clip, *text_clips])
+
+
+def with_overlay(clip, captions):
+    return subtitle_overlay.overlay_subtitles(clip, captions)
+
+
+def run(name, overlay, captions, step):
+    clip = overlay(make_background(), captions)
+    times = np.arange(0, duration, step / fps)
+    start = time.perf_counter()
+    for t in times:
+        clip.get_frame(t)
+    elapsed = time.perf_counter() - start
+    print(f"{name:>10}: {elapsed:6.2f}s, {len(times) / elapsed:6.1f} frames/s")
+    return elapsed
+
+
+def main():
+    step = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    captions = make_captions()
+    print(f"blending {line_count} subtitle lines over {duration}s of {video_width}x{video_height}, every {step} frames")
+    # the background alone, to tell the cost of the subtitles apart
+    background = run("none", lambda clip, _: clip, captions, step)
+    composite = run("composite", with_composite, captions, step)
+    overlay = run("overlay", with_overlay, captions, step)
+    print(f"subtitle cost: composite {composite - background:.2f}s, overlay {overlay - background:.2f}s")
+    print(f"speedup: {composite / overlay:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Benchmark: wrapping the subtitle lines of a Chinese script,
+with the previous wrap_text, which loaded the font and measured the line after each character,
+and with the cached font and binary search of subtitle_raster.wrap_text. Both must give the same lines.
+
+Usage:
+    python test/benchmarks/bench_wrap_text.py [font_path]
+"""
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+from PIL import ImageFont
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.services.utils import subtitle_raster
+from app.utils import utils
+
+video_width = 1080
+font_size = 60
+line_count = 200
+
+
+def previous_wrap_text(text, max_width, font="Arial", fontsize=60):
+    font = ImageFont.truetype(font, fontsize)
+
+    def get_text_size(inner_text):
+        inner_text = inner_text.strip()
+        left, top, right, bottom = font.getbbox(inner_text)
+        return right - left, bottom - top
+
+    width, height = get_text_size(text)
+    if width <= max_width:
+        return text, height
+
+    processed = True
+
+    _wrapped_lines_ = []
+    words = text.split(" ")
+    _txt_ = ""
+    for word in words:
+        _before = _txt_
+        _txt_ += f"{word} "
+        _width, _height = get_text_size(_txt_)
+        if _width <= max_width:
+            continue
+        else:
+            if _txt_.strip() == word.strip():
+                processed = False
+                break
+            _wrapped_lines_.append(_before)
+            _txt_ = f"{word} "
+    _wrapped_lines_.append(_txt_)
+    if processed:
+        _wrapped_lines_ = [line.strip() for line in _wrapped_lines_]
+        result = "\n".join(_wrapped_lines_).strip()
+        height = len(_wrapped_lines_) * height
+        return result, height
+
+    _wrapped_lines_ = []
+    chars = list(text)
+    _txt_ = ""
+    for word in chars:
+        _txt_ += word
+        _width, _height = get_text_size(_txt_)
+        if _width <= max_width:
+            continue
+        else:
+            _wrapped_lines_.append(_txt_)
+            _txt_ = ""
+    _wrapped_lines_.append(_txt_)
+    result = "\n".join(_wrapped_lines_).strip()
+    height = len(_wrapped_lines_) * height
+    return result, height
+
+
+def make_lines():
+    rng = random.Random(0)
+    chars = "这是一段用来测试中文长句换行的文本内容应该会根据宽度限制进行换行处理，。"
+    return ["".join(rng.choice(chars) for _ in range(rng.randint(20, 80))) for _ in range(line_count)]
+
+
+def run(name, wrap, lines, font_path):
+    start = time.perf_counter()
+    results = [wrap(line, max_width=video_width * 0.9, font=font_path, fontsize=font_size) for line in lines]
+    elapsed = time.perf_counter() - start
+    print(f"{name:>10}: {elapsed:6.3f}s, {len(lines) / elapsed:8.1f} lines/s")
+    return elapsed, results
+
+
+def main():
+    font_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(utils.font_dir(), "STHeitiMedium.ttc")
+    lines = make_lines()
+    print(f"wrapping {line_count} lines of 20 to 80 characters at {font_size}px into {video_width * 0.9:.0f}px, {font_path}")
+    previous, expected = run("previous", previous_wrap_text, lines, font_path)
+    current, actual = run("current", subtitle_raster.wrap_text, lines, font_path)
+    if actual != expected:
+        raise AssertionError("the wrapped lines differ")
+    print(f"speedup: {previous / current:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
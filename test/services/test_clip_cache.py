@@ -0,0 +1,71 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.services.utils.clip_cache import ClipCache
+
+
+class TestClipCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache = ClipCache(cache_dir=os.path.join(self.temp_dir, "cache"), max_size=250)
+        self.source_file = self.write_file("source.mp4", b"source")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def write_file(self, name, content):
+        file_path = os.path.join(self.temp_dir, name)
+        with open(file_path, "wb") as f:
+            f.write(content)
+        return file_path
+
+    def test_key_depends_on_content_and_params(self):
+        key = self.cache.key(self.source_file, start_time=0, end_time=5)
+        self.assertEqual(key, self.cache.key(self.source_file, start_time=0, end_time=5))
+        self.assertNotEqual(key, self.cache.key(self.source_file, start_time=5, end_time=10))
+
+        other_file = self.write_file("other.mp4", b"other")
+        self.assertNotEqual(key, self.cache.key(other_file, start_time=0, end_time=5))
+
+    def test_get_put_counts_hits_and_misses(self):
+        key = self.cache.key(self.source_file, start_time=0, end_time=5)
+        output_file = os.path.join(self.temp_dir, "temp-clip-1.mp4")
+        self.assertIsNone(self.cache.get(key, output_file))
+
+        clip_file = self.write_file("clip.mp4", b"x" * 100)
+        self.cache.put(key, clip_file, duration=5.0, width=1080, height=1920)
+        meta = self.cache.get(key, output_file)
+
+        self.assertEqual(meta, {"duration": 5.0, "width": 1080, "height": 1920})
+        with open(output_file, "rb") as f:
+            self.assertEqual(f.read(), b"x" * 100)
+        self.assertEqual(self.cache.stats(), {"hits": 1, "misses": 1})
+
+    def test_evicts_least_recently_used(self):
+        keys = []
+        for i in range(3):
+            key = self.cache.key(self.source_file, index=i)
+            clip_file = self.write_file(f"clip-{i}.mp4", b"x" * 100)
+            self.cache.put(key, clip_file, duration=1.0, width=1, height=1)
+            keys.append(key)
+            # keep the mtime order stable on coarse file systems
+            os.utime(os.path.join(self.cache.cache_dir, f"{key}.mp4"), (time.time() - 10 + i, time.time() - 10 + i))
+
+        # 300 bytes over a 250 bytes limit: the first clip must be gone
+        self.cache.evict()
+        output_file = os.path.join(self.temp_dir, "out.mp4")
+        self.assertIsNone(self.cache.get(keys[0], output_file))
+        self.assertIsNotNone(self.cache.get(keys[1], output_file))
+        self.assertIsNotNone(self.cache.get(keys[2], output_file))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,211 @@
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import requests
+from moviepy import ColorClip
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.models.schema import MaterialInfo
+from app.services import material
+
+
+class FakeResponse:
+    def __init__(self, content, content_length=None, status_code=200):
+        self.content = content
+        self.headers = {"Content-Length": str(len(content) if content_length is None else content_length)}
+        self.status_code = status_code
+        self.chunk_sizes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} error", response=self)
+
+    def iter_content(self, chunk_size):
+        self.chunk_sizes.append(chunk_size)
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i : i + chunk_size]
+
+
+def make_items(durations):
+    items = []
+    for i, duration in enumerate(durations):
+        item = MaterialInfo()
+        item.provider = "pexels"
+        item.url = f"https://example.com/video-{i}.mp4"
+        item.duration = duration
+        items.append(item)
+    return items
+
+
+class TestDownloadItems(unittest.TestCase):
+    def download(self, items, failed_urls=(), workers=4, **kwargs):
+        """
+        Run download_items with a save_video that takes a random time, returns the calls in the order they started.
+        """
+        calls = []
+        stats_objects = set()
+        running = []
+        max_running = []
+        lock = threading.Lock()
+        rng = random.Random(1)
+        delays = {item.url: rng.uniform(0, 0.05) for item in items}
+
+        def save_video(video_url, save_dir="", stats=None):
+            with lock:
+                calls.append(video_url)
+                stats_objects.add(id(stats))
+                running.append(video_url)
+                max_running.append(len(running))
+            time.sleep(delays[video_url])
+            with lock:
+                running.remove(video_url)
+            if video_url in failed_urls:
+                raise IOError("connection reset")
+            return video_url.replace("https://example.com/", "/cache/")
+
+        with mock.patch.object(material, "save_video", side_effect=save_video):
+            video_paths = material.download_items(items, workers=workers, **kwargs)
+        # the downloads of a call share its stats
+        self.assertEqual(len(stats_objects), 1)
+        return video_paths, calls, max(max_running or [0])
+
+    def test_same_videos_as_sequential(self):
+        items = make_items([10, 3, 8, 2, 6, 9, 4, 7])
+        failed_urls = {items[1].url, items[4].url}
+        expected, _, _ = self.download(items, failed_urls, workers=1, audio_duration=14, max_clip_duration=5)
+        # 5 + 5 + 2 + 5 covers 14 seconds, the failed downloads are skipped
+        self.assertEqual(expected, [f"/cache/video-{i}.mp4" for i in [0, 2, 3, 5]])
+        for _ in range(3):
+            video_paths, _, max_running = self.download(items, failed_urls, workers=3, audio_duration=14, max_clip_duration=5)
+            self.assertEqual(video_paths, expected)
+            self.assertLessEqual(max_running, 3)
+
+    def test_stops_once_duration_is_covered(self):
+        items = make_items([5] * 20)
+        video_paths, calls, max_running = self.download(items, workers=4, audio_duration=12, max_clip_duration=5)
+        self.assertEqual(video_paths, [f"/cache/video-{i}.mp4" for i in range(3)])
+        # the downloads in flight were already enough, no more were started
+        self.assertEqual(calls, [item.url for item in items[:3]])
+        self.assertEqual(max_running, 3)
+
+        # the materials run out before the duration is covered
+        video_paths, _, _ = self.download(items[:2], workers=4, audio_duration=100, max_clip_duration=5)
+        self.assertEqual(video_paths, ["/cache/video-0.mp4", "/cache/video-1.mp4"])
+
+    def test_deletes_stale_temp_files(self):
+        save_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, save_dir, ignore_errors=True)
+        for name in ["vid-a.mp4.1-1.tmp", "vid-b.mp4.2-2.tmp", "vid-c.mp4"]:
+            with open(os.path.join(save_dir, name), "wb") as f:
+                f.write(b"video")
+        # an interrupted download, and one still being written by another process
+        stale_time = time.time() - material.stale_temp_file_age - 10
+        os.utime(os.path.join(save_dir, "vid-a.mp4.1-1.tmp"), (stale_time, stale_time))
+
+        self.download(make_items([5]), save_dir=save_dir, audio_duration=5)
+        self.assertEqual(sorted(os.listdir(save_dir)), ["vid-b.mp4.2-2.tmp", "vid-c.mp4"])
+
+
+class TestSaveVideo(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        video_file = os.path.join(self.temp_dir, "source.mp4")
+        clip = ColorClip(size=(320, 240), color=(255, 0, 0)).with_duration(1)
+        clip.write_videofile(video_file, fps=10, codec="libx264", logger=None)
+        clip.close()
+        with open(video_file, "rb") as f:
+            self.content = f.read()
+        self.save_dir = os.path.join(self.temp_dir, "videos")
+        self.stats = material.DownloadStats()
+        self.patches = [
+            mock.patch.object(material, "download_chunk_size", 4096),
+            mock.patch.object(material.time, "sleep"),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_streams_to_the_video_path(self):
+        response = FakeResponse(self.content)
+        with mock.patch.object(material.requests, "get", return_value=response) as get:
+            video_path = material.save_video("https://example.com/video.mp4?token=1", self.save_dir, self.stats)
+        self.assertTrue(get.call_args.kwargs["stream"])
+        self.assertEqual(response.chunk_sizes, [4096])
+        self.assertEqual(os.path.basename(video_path), f"vid-{material.utils.md5('https://example.com/video.mp4')}.mp4")
+        with open(video_path, "rb") as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertEqual(os.listdir(self.save_dir), [os.path.basename(video_path)])
+        stats = self.stats.stats()
+        self.assertEqual((stats["downloads"], stats["retries"], stats["bytes"]), (1, 0, len(self.content)))
+        self.assertGreater(stats["bytes_per_second"], 0)
+
+        # the next call finds the complete video
+        with mock.patch.object(material.requests, "get") as get:
+            self.assertEqual(material.save_video("https://example.com/video.mp4", self.save_dir), video_path)
+            get.assert_not_called()
+
+    def test_retries_failed_downloads(self):
+        responses = [
+            requests.ConnectionError("connection reset"),
+            # cut short, the partial file never reaches the video path
+            FakeResponse(self.content[:1000], content_length=len(self.content)),
+            FakeResponse(self.content),
+        ]
+        with mock.patch.dict(material.config.app, {"material_download_retries": 2}):
+            with mock.patch.object(material.requests, "get", side_effect=responses):
+                video_path = material.save_video("https://example.com/video.mp4", self.save_dir, self.stats)
+        self.assertEqual(os.path.getsize(video_path), len(self.content))
+        stats = self.stats.stats()
+        self.assertEqual((stats["downloads"], stats["retries"], stats["failures"]), (1, 2, 0))
+
+        with mock.patch.dict(material.config.app, {"material_download_retries": 1}):
+            with mock.patch.object(material.requests, "get", side_effect=requests.ConnectionError("timed out")):
+                with self.assertRaises(requests.ConnectionError):
+                    material.save_video("https://example.com/other.mp4", self.save_dir, self.stats)
+        self.assertEqual(self.stats.stats()["failures"], 1)
+        self.assertEqual(os.listdir(self.save_dir), [os.path.basename(video_path)])
+
+    def test_retries_only_transient_errors(self):
+        with mock.patch.dict(material.config.app, {"material_download_retries": 2}):
+            # a server error or a rate limit may pass on the next attempt
+            responses = [FakeResponse(b"", status_code=503), FakeResponse(b"", status_code=429), FakeResponse(self.content)]
+            with mock.patch.object(material.requests, "get", side_effect=responses):
+                self.assertTrue(material.save_video("https://example.com/video.mp4", self.save_dir, self.stats))
+            self.assertEqual(self.stats.stats()["retries"], 2)
+
+            # a deleted video is not tried again
+            with mock.patch.object(material.requests, "get", return_value=FakeResponse(b"", status_code=404)) as get:
+                with self.assertRaises(requests.HTTPError):
+                    material.save_video("https://example.com/other.mp4", self.save_dir, self.stats)
+            get.assert_called_once()
+        stats = self.stats.stats()
+        self.assertEqual((stats["downloads"], stats["retries"], stats["failures"]), (1, 2, 1))
+
+    def test_invalid_video_is_not_saved(self):
+        with mock.patch.object(material.requests, "get", return_value=FakeResponse(b"<html>not found</html>")):
+            self.assertEqual(material.save_video("https://example.com/video.mp4", self.save_dir), "")
+        self.assertEqual(os.listdir(self.save_dir), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
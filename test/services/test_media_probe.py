@@ -0,0 +1,133 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from collections import OrderedDict
+from pathlib import Path
+from unittest import mock
+
+from moviepy import ColorClip
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.services.utils import media_probe
+
+resources_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "resources")
+
+
+def make_color_video(file_path, size, duration):
+    clip = ColorClip(size=size, color=(255, 0, 0)).with_duration(duration)
+    clip.write_videofile(file_path, fps=10, codec="libx264", logger=None)
+    clip.close()
+    return file_path
+
+
+class TestMediaProbe(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        cache_dir = os.path.join(self.temp_dir, "cache_probe")
+        os.makedirs(cache_dir)
+        self.patches = [
+            mock.patch.object(media_probe, "cache_dir", lambda: cache_dir),
+            mock.patch.object(media_probe, "_entries", OrderedDict()),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_probe_video(self):
+        # test_video removes the videos in the resources dir, write one instead
+        video_file = make_color_video(os.path.join(self.temp_dir, "video.mp4"), (320, 240), 3)
+        infos = media_probe.probe(video_file)
+        self.assertEqual((infos["width"], infos["height"]), (320, 240))
+        self.assertAlmostEqual(infos["duration"], 3.0, delta=0.1)
+        self.assertGreater(infos["fps"], 0)
+        self.assertFalse(infos["audio_found"])
+        self.assertEqual((infos["video_profile"], infos["pix_fmt"]), ("High", "yuv420p"))
+        self.assertRegex(infos["time_base"], r"^1/\d+$")
+
+    def test_probe_image(self):
+        infos = media_probe.probe(os.path.join(resources_dir, "1.png"))
+        self.assertEqual((infos["width"], infos["height"]), (580, 751))
+        self.assertEqual(infos["duration"], 0.0)
+
+    def test_probe_is_cached_until_file_changes(self):
+        video_file = make_color_video(os.path.join(self.temp_dir, "video.mp4"), (320, 240), 1)
+        infos = media_probe.probe(video_file)
+
+        # a fresh process must be served from the disk cache
+        media_probe._entries = OrderedDict()
+        with mock.patch.object(media_probe, "read_infos", side_effect=AssertionError("probed twice")):
+            self.assertEqual(media_probe.probe(video_file), infos)
+
+        # a changed file must be probed again
+        make_color_video(video_file, (240, 320), 2)
+        os.utime(video_file, ns=(0, 0))
+        with mock.patch.object(media_probe, "read_infos", return_value={"duration": 1.0}) as read_infos:
+            self.assertEqual(media_probe.probe(video_file), {"duration": 1.0})
+            read_infos.assert_called_once()
+
+    def test_processes_do_not_lose_entries(self):
+        videos = [make_color_video(os.path.join(self.temp_dir, f"video-{i}.mp4"), (320, 240), 1) for i in range(3)]
+
+        # two render workers with their own memory, probing in turn
+        media_probe.probe(videos[0])
+        first_process = media_probe._entries
+        media_probe._entries = OrderedDict()
+        media_probe.probe(videos[1])
+        media_probe._entries = first_process
+        media_probe.probe(videos[2])
+
+        # every entry reached the disk, none was overwritten by the other process
+        media_probe._entries = OrderedDict()
+        with mock.patch.object(media_probe, "read_infos", side_effect=AssertionError("probed twice")):
+            for video in videos:
+                self.assertEqual(media_probe.probe(video)["width"], 320)
+        self.assertEqual(len([f for f in os.listdir(media_probe.cache_dir()) if f.endswith(".json")]), 3)
+
+    def test_memory_entries_are_capped(self):
+        videos = [make_color_video(os.path.join(self.temp_dir, f"video-{i}.mp4"), (320, 240), 1) for i in range(3)]
+        with mock.patch.object(media_probe, "max_memory_entries", 2):
+            for video in videos:
+                media_probe.probe(video)
+            self.assertEqual(list(media_probe._entries), videos[1:])
+
+            # the dropped entry is read back from the disk, not probed again
+            with mock.patch.object(media_probe, "read_infos", side_effect=AssertionError("probed twice")):
+                media_probe.probe(videos[0])
+            self.assertEqual(list(media_probe._entries), [videos[2], videos[0]])
+
+    def test_prune(self):
+        videos = [make_color_video(os.path.join(self.temp_dir, f"video-{i}.mp4"), (320, 240), 1) for i in range(4)]
+        for i, video in enumerate(videos):
+            media_probe.probe(video)
+            # keep the use order stable on coarse file systems
+            os.utime(media_probe.entry_file(video), (time.time() - 10 + i, time.time() - 10 + i))
+        os.remove(videos[3])
+
+        with mock.patch.dict(media_probe.config.app, {"probe_cache_max_entries": 2}):
+            media_probe.prune()
+
+        # the entry of the deleted file is gone, then the least recently used one
+        remaining = sorted(os.listdir(media_probe.cache_dir()))
+        self.assertEqual(remaining, sorted(os.path.basename(media_probe.entry_file(video)) for video in videos[1:3]))
+
+    def test_keyframes(self):
+        video_file = make_color_video(os.path.join(self.temp_dir, "video.mp4"), (320, 240), 3)
+        keyframes = media_probe.keyframes(video_file)
+        self.assertEqual(keyframes[:1], [0.0])
+
+        media_probe._entries = OrderedDict()
+        with mock.patch.object(media_probe, "read_keyframes", side_effect=AssertionError("read twice")):
+            self.assertEqual(media_probe.keyframes(video_file), keyframes)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from unittest import mock
+
+from moviepy import VideoFileClip
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+from app.models.schema import VideoAspect, VideoParams, VideoTransitionMode
+from app.services import render_queue
+from app.services import video as vd
+from app.utils import utils
+from test.services.test_video import make_gradient_video, make_tone_audio
+
+
+def redis_available():
+    try:
+        return render_queue.get_client().ping()
+    except Exception:
+        return False
+
+
+def make_timeline(video_path, duration):
+    return [
+        {
+            "slot": 1,
+            "start": 0,
+            "duration": duration,
+            "job": {
+                "subclipped_item": vd.SubClippedVideoClip(file_path=video_path, start_time=0, end_time=duration, width=320, height=240),
+                "clip_file": video_path,
+                "video_width": 360,
+                "video_height": 360,
+                "transition": VideoTransitionMode.none,
+                "side": "",
+                "max_clip_duration": duration,
+            },
+        }
+    ]
+
+
+class TestRenderQueue(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.params = VideoParams(
+            video_subject="test",
+            video_aspect=VideoAspect.square,
+            video_preview=True,
+            bgm_type="",
+            font_name="Charm-Regular.ttf",
+            font_size=60,
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_segment_job_round_trip(self):
+        timeline = make_timeline("src.mp4", 6)
+        timeline[0]["job"]["transition"] = VideoTransitionMode.fade_in
+        job = {
+            "backend_name": "ffmpeg",
+            "timeline": timeline,
+            "subtitle_path": "",
+            "output_file": "segment-1.mp4",
+            "params": self.params,
+        }
+        loaded = render_queue.load_segment_job(render_queue.dump_segment_job(job, "job", 2))
+        self.assertEqual(loaded["index"], 2)
+        self.assertEqual(loaded["params"], self.params)
+        self.assertEqual(vd.timeline_to_edl(loaded["timeline"]), vd.timeline_to_edl(timeline))
+        self.assertEqual(loaded["timeline"][0]["job"]["transition"], VideoTransitionMode.fade_in)
+
+        none_timeline = vd.load_timeline(vd.dump_timeline(make_timeline("src.mp4", 6)))
+        self.assertEqual(none_timeline[0]["job"]["transition"], VideoTransitionMode.none)
+
+    @unittest.skipUnless(redis_available(), "redis is not reachable")
+    def test_render_on_workers(self):
+        video_path = make_gradient_video(os.path.join(self.temp_dir, "src.mp4"), (320, 240), 6)
+        audio_file = make_tone_audio(os.path.join(self.temp_dir, "audio.mp3"), 6)
+        subtitle_file = os.path.join(self.temp_dir, "subtitle.srt")
+        with open(subtitle_file, "w", encoding="utf-8") as f:
+            f.write(utils.text_to_srt(1, "hello world", 1.0, 3.0))
+        output_file = os.path.join(self.temp_dir, "final-1.mp4")
+
+        config = {"render_segments": 3, "render_distributed": True, "enable_redis": True}
+        with ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("spawn")) as executor:
+            workers = [executor.submit(render_queue.run_worker, idle_timeout=10) for _ in range(2)]
+            # the coordinator only waits, so every segment is rendered by the workers
+            with mock.patch.dict(vd.config.app, config), mock.patch.object(render_queue, "process_next", return_value=False):
+                vd.render_timeline(make_timeline(video_path, 6), audio_file, subtitle_file, output_file, self.params)
+            self.assertEqual(sum(worker.result() for worker in workers), 3)
+
+        clip = VideoFileClip(output_file)
+        self.assertAlmostEqual(clip.duration, 6, delta=0.1)
+        self.assertIsNotNone(clip.audio)
+        clip.close()
+        files = sorted(os.listdir(self.temp_dir))
+        # the mixed audio track is kept next to the voice for the next renders
+        self.assertEqual([f for f in files if "-mix-" not in f], ["audio.mp3", "final-1.mp4", "src.mp4", "subtitle.srt"])
+        self.assertEqual(len([f for f in files if f.startswith("audio-mix-")]), 1)
+
+    @unittest.skipUnless(redis_available(), "redis is not reachable")
+    def test_missing_segments_are_rendered_locally(self):
+        video_path = make_gradient_video(os.path.join(self.temp_dir, "src.mp4"), (320, 240), 2)
+        jobs = [
+            {
+                "backend_name": "ffmpeg",
+                "timeline": segment,
+                "subtitle_path": "",
+                "output_file": os.path.join(self.temp_dir, f"segment-{i+1}.mp4"),
+                "params": self.params,
+            }
+            for i, segment in enumerate(vd.split_timeline(make_timeline(video_path, 2), 2))
+        ]
+        # no worker takes the segments, they are left in the queue until the timeout
+        with mock.patch.object(render_queue, "process_next", return_value=False):
+            segment_files = render_queue.render_segments(jobs, timeout=1)
+
+        self.assertEqual(segment_files, [job["output_file"].replace(".mp4", "-local.mp4") for job in jobs])
+        for segment_file in segment_files:
+            self.assertTrue(os.path.exists(segment_file))
+        # the segments left behind are removed from the queue
+        client = render_queue.get_client()
+        for payload in client.lrange(render_queue.queue_name, 0, -1):
+            self.assertNotIn(self.temp_dir, payload.decode("utf-8"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+from moviepy import AudioClip
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.services import video as vd
+from app.services.utils import song_index
+
+
+def make_tone_song(file_path, duration, amplitude):
+    clip = AudioClip(lambda t: np.sin(2 * np.pi * 440 * t) * amplitude, duration=duration, fps=44100)
+    clip.write_audiofile(file_path, logger=None)
+    clip.close()
+    return file_path
+
+
+class TestSongIndex(unittest.TestCase):
+    def setUp(self):
+        self.refresh_in_background = song_index.refresh_in_background
+        self.temp_dir = tempfile.mkdtemp()
+        self.song_dir = os.path.join(self.temp_dir, "songs")
+        os.makedirs(self.song_dir)
+        index_file = os.path.join(self.temp_dir, "songs.json")
+        self.patches = [
+            mock.patch.object(song_index, "index_file", lambda: index_file),
+            mock.patch.object(song_index, "_index", None),
+            mock.patch.object(song_index, "_last_scan", None),
+            mock.patch.object(song_index.utils, "song_dir", lambda: self.song_dir),
+            # refresh in the test thread, a background refresh could outlive the patches
+            mock.patch.object(song_index, "refresh_in_background", lambda: song_index.refresh(wait=False)),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_index_songs(self):
+        make_tone_song(os.path.join(self.song_dir, "quiet.mp3"), 2, 0.05)
+        make_tone_song(os.path.join(self.song_dir, "loud.mp3"), 3, 0.5)
+
+        songs = song_index.songs()
+        self.assertEqual([song["name"] for song in songs], ["loud.mp3", "quiet.mp3"])
+        loud, quiet = songs
+        self.assertAlmostEqual(loud["duration"], 3, delta=0.1)
+        self.assertEqual(loud["sample_rate"], 44100)
+        self.assertEqual(loud["file"], os.path.join(self.song_dir, "loud.mp3"))
+        # a tenth of the amplitude is 20 dB quieter
+        self.assertAlmostEqual(loud["loudness"] - quiet["loudness"], 20, delta=1)
+        self.assertAlmostEqual(song_index.gain(quiet["file"], quiet["loudness"] + 6), 10 ** (6 / 20))
+        self.assertEqual(song_index.gain(os.path.join(self.temp_dir, "other.mp3"), -20), 1.0)
+
+        # a fresh process is served from the disk index, without analyzing anything
+        with mock.patch.object(song_index, "_index", None), mock.patch.object(song_index, "analyze") as analyze:
+            self.assertEqual(song_index.songs(), songs)
+            analyze.assert_not_called()
+
+    def test_refresh_is_incremental(self):
+        make_tone_song(os.path.join(self.song_dir, "a.mp3"), 1, 0.1)
+        song_index.refresh()
+
+        with mock.patch.object(song_index, "analyze", wraps=song_index.analyze) as analyze:
+            # nothing changed, nothing is analyzed
+            self.assertFalse(song_index.refresh())
+            analyze.assert_not_called()
+
+            make_tone_song(os.path.join(self.song_dir, "b.mp3"), 1, 0.1)
+            os.remove(os.path.join(self.song_dir, "a.mp3"))
+            self.assertTrue(song_index.refresh())
+            # only the new song is analyzed, the deleted one is dropped
+            self.assertEqual([c.args[0] for c in analyze.call_args_list], [os.path.join(self.song_dir, "b.mp3")])
+            self.assertEqual([song["name"] for song in song_index.songs()], ["b.mp3"])
+
+            # a song overwritten in place does not change the directory, its own mtime and size do
+            make_tone_song(os.path.join(self.song_dir, "b.mp3"), 2, 0.1)
+            self.assertTrue(song_index.refresh())
+            self.assertAlmostEqual(song_index.songs()[0]["duration"], 2, delta=0.1)
+            self.assertEqual(analyze.call_count, 2)
+
+            # an uploaded song is analyzed once, when it is added
+            song_index.add(make_tone_song(os.path.join(self.song_dir, "c.mp3"), 1, 0.1))
+            self.assertEqual([song["name"] for song in song_index.songs()], ["b.mp3", "c.mp3"])
+            self.assertEqual(analyze.call_count, 3)
+
+    def test_readers_do_not_wait_for_a_refresh(self):
+        make_tone_song(os.path.join(self.song_dir, "a.mp3"), 1, 0.1)
+        song_index.refresh()
+        make_tone_song(os.path.join(self.song_dir, "b.mp3"), 1, 0.1)
+
+        started, release = threading.Event(), threading.Event()
+        analyze = song_index.analyze
+
+        def slow_analyze(file_path):
+            started.set()
+            release.wait(10)
+            return analyze(file_path)
+
+        with mock.patch.object(song_index, "analyze", side_effect=slow_analyze) as analyze_mock:
+            thread = self.refresh_in_background()
+            self.assertTrue(started.wait(10))
+            # the last index is served while b.mp3 is analyzed, and no second refresh starts
+            self.assertEqual([song["name"] for song in song_index.songs()], ["a.mp3"])
+            self.assertFalse(song_index.refresh(wait=False))
+            self.assertIsNone(self.refresh_in_background())
+            release.set()
+            thread.join(10)
+            self.assertEqual(analyze_mock.call_count, 1)
+        self.assertEqual([song["name"] for song in song_index.songs()], ["a.mp3", "b.mp3"])
+
+    def test_songs_do_not_rescan_an_unchanged_directory(self):
+        make_tone_song(os.path.join(self.song_dir, "a.mp3"), 1, 0.1)
+        song_index.songs()
+
+        with mock.patch.object(song_index.os, "listdir", wraps=os.listdir) as listdir:
+            for _ in range(5):
+                self.assertEqual([song["name"] for song in song_index.songs()], ["a.mp3"])
+            listdir.assert_not_called()
+
+            # an added song changes the directory mtime
+            make_tone_song(os.path.join(self.song_dir, "b.mp3"), 1, 0.1)
+            self.assertEqual([song["name"] for song in song_index.songs()], ["a.mp3", "b.mp3"])
+            self.assertEqual(listdir.call_count, 1)
+
+            # a song overwritten in place does not, it is found by the next scan after refresh_interval
+            make_tone_song(os.path.join(self.song_dir, "b.mp3"), 2, 0.1)
+            self.assertAlmostEqual(song_index.songs()[1]["duration"], 1, delta=0.1)
+            scanned_at = time.monotonic() + song_index.refresh_interval
+            with mock.patch.object(song_index.time, "monotonic", return_value=scanned_at):
+                self.assertAlmostEqual(song_index.songs()[1]["duration"], 2, delta=0.1)
+            self.assertEqual(listdir.call_count, 2)
+
+    def test_random_bgm_from_index(self):
+        for name in ["b.mp3", "a.mp3", "c.mp3"]:
+            make_tone_song(os.path.join(self.song_dir, name), 1, 0.1)
+        files = sorted(os.path.join(self.song_dir, name) for name in ["a.mp3", "b.mp3", "c.mp3"])
+        # the same pick as the sorted directory listing, for the same seed
+        self.assertEqual(vd.get_bgm_file("random", rng=random.Random(7)), random.Random(7).choice(files))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import os
+import sys
+import unittest
+from pathlib import Path
+
+import numpy as np
+from moviepy import CompositeVideoClip, ImageClip, VideoClip
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+from app.services.utils import subtitle_overlay, subtitle_raster
+from app.utils import utils
+
+font_path = os.path.join(utils.font_dir(), "Charm-Regular.ttf")
+
+
+def make_caption(text, x, y, start, end):
+    image = subtitle_raster.rasterize(text, font_path, 40, "#FFFFFF", None, "#000000", 2)
+    return {"image": image, "x": x, "y": y, "start": start, "end": end}
+
+
+class TestSubtitleOverlay(unittest.TestCase):
+    def test_active(self):
+        captions = [
+            make_caption("first", 0, 0, 0.0, 1.0),
+            make_caption("long", 0, 0, 0.5, 4.0),
+            make_caption("second", 0, 0, 1.0, 2.0),
+            make_caption("third", 0, 0, 3.0, 3.5),
+        ]
+        overlay = subtitle_overlay.SubtitleOverlay(captions)
+        self.assertEqual(overlay.active(0.2), [0])
+        self.assertEqual(overlay.active(0.7), [0, 1])
+        # the end is excluded, as in CompositeVideoClip
+        self.assertEqual(overlay.active(1.0), [1, 2])
+        self.assertEqual(overlay.active(2.5), [1])
+        self.assertEqual(overlay.active(3.2), [1, 3])
+        self.assertEqual(overlay.active(4.0), [])
+
+    def test_overlay_matches_composite(self):
+        width, height = 320, 240
+        x = np.linspace(0, 255, width)[None, :, None]
+        background = VideoClip(
+            lambda t: np.broadcast_to((x + t * 50) % 256, (height, width, 3)).astype("uint8"),
+            duration=3,
+        )
+        captions = [
+            make_caption("hello world", 40, 150, 0.0, 2.0),
+            # overlaps the first one, and is cut by the frame edges
+            make_caption("a line too wide for the frame", -30, 200, 1.0, 3.0),
+        ]
+        text_clips = [
+            ImageClip(caption["image"]).with_start(caption["start"]).with_end(caption["end"]).with_position((caption["x"], caption["y"]))
+            for caption in captions
+        ]
+        expected = CompositeVideoClip([background, *text_clips])
+        actual = subtitle_overlay.overlay_subtitles(background, captions)
+        for t in [0.5, 1.5, 2.5]:
+            np.testing.assert_array_equal(actual.get_frame(t), expected.get_frame(t))
+
+        # an image clip returns the same array for every frame, it is left as it is
+        still = ImageClip(np.zeros((height, width, 3), dtype="uint8")).with_duration(3)
+        frame = subtitle_overlay.overlay_subtitles(still, captions).get_frame(0.5)
+        self.assertGreater(frame.max(), 0)
+        self.assertEqual(still.get_frame(0.5).max(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
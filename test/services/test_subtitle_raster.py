@@ -0,0 +1,98 @@
+import os
+import sys
+import unittest
+from pathlib import Path
+
+import numpy as np
+from moviepy import TextClip
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+from app.services.utils import subtitle_raster
+from app.utils import utils
+
+font_path = os.path.join(utils.font_dir(), "Charm-Regular.ttf")
+
+
+class TestSubtitleRaster(unittest.TestCase):
+    def test_rasterize_matches_text_clip(self):
+        for text, bg_color in [("hello world", True), ("two\nlines", None), ("on a box", "#203040")]:
+            image = subtitle_raster.rasterize(text, font_path, 48, "#FFFFFF", bg_color, "#000000", 2)
+            clip = TextClip(
+                text=text,
+                font=font_path,
+                font_size=48,
+                color="#FFFFFF",
+                bg_color=bg_color,
+                stroke_color="#000000",
+                stroke_width=2,
+            )
+            self.assertEqual(image.shape[2], 4)
+            np.testing.assert_array_equal(image[:, :, :3], clip.get_frame(0))
+            np.testing.assert_array_equal(image[:, :, 3] / 255, clip.mask.get_frame(0))
+            clip.close()
+
+    def test_wrap_text(self):
+        self.assertIs(subtitle_raster.get_font(font_path, 30), subtitle_raster.get_font(font_path, 30))
+        font = subtitle_raster.get_font(font_path, 30)
+
+        text = "This is a test text for wrapping long sentences in english language"
+        wrapped_text, _ = subtitle_raster.wrap_text(text, max_width=300, font=font_path, fontsize=30)
+        lines = wrapped_text.split("\n")
+        self.assertGreater(len(lines), 1)
+        self.assertEqual(" ".join(lines), text)
+        for i, line in enumerate(lines):
+            left, _, right, _ = font.getbbox(line)
+            self.assertLessEqual(right - left, 300)
+            # each line takes as many words as fit
+            if i + 1 < len(lines):
+                left, _, right, _ = font.getbbox(f"{line} {lines[i + 1].split(' ')[0]}")
+                self.assertGreater(right - left, 300)
+
+        # a word wider than a line is broken anywhere, after the character that overflows
+        text = "abcdefghijklmnopqrstuvwxyz" * 3
+        wrapped_text, _ = subtitle_raster.wrap_text(text, max_width=300, font=font_path, fontsize=30)
+        lines = wrapped_text.split("\n")
+        self.assertEqual("".join(lines), text)
+        for line in lines[:-1]:
+            left, _, right, _ = font.getbbox(line[:-1])
+            self.assertLessEqual(right - left, 300)
+            left, _, right, _ = font.getbbox(line)
+            self.assertGreater(right - left, 300)
+
+    def test_render_subtitle_cache(self):
+        cache = subtitle_raster.raster_cache
+        args = {
+            "font_path": font_path,
+            "font_size": 40,
+            "max_width": 200,
+            "color": "#FFFFFF",
+            "bg_color": True,
+            "stroke_color": "#000000",
+            "stroke_width": 1,
+        }
+        text = "a subtitle line long enough to be wrapped"
+        hits = cache.stats()["hits"]
+        image = subtitle_raster.render_subtitle(text, **args)
+        self.assertLessEqual(image.shape[1], 200)
+        self.assertFalse(image.flags.writeable)
+        self.assertIs(subtitle_raster.render_subtitle(text, **args), image)
+        self.assertEqual(cache.stats()["hits"], hits + 1)
+        # any other style is another entry
+        self.assertIsNot(subtitle_raster.render_subtitle(text, **dict(args, color="#FF0000")), image)
+
+    def test_raster_cache_eviction(self):
+        cache = subtitle_raster.RasterCache(max_size=250)
+        for key in ["a", "b", "c"]:
+            cache.put(key, np.zeros(100, dtype="uint8"))
+        # the least recently used entry is evicted first
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("b"))
+        cache.put("d", np.zeros(100, dtype="uint8"))
+        self.assertIsNone(cache.get("c"))
+        self.assertIsNotNone(cache.get("b"))
+        self.assertEqual(cache.stats()["size"], 200)
+
+
+if __name__ == "__main__":
+    unittest.main()
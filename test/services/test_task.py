@@ -1,13 +1,24 @@
+import json
 import unittest
 import os
+import shutil
 import sys
 from pathlib import Path
+from unittest import mock
+
+import numpy as np
+from moviepy import AudioClip, ColorClip, VideoFileClip
 
 # add project root to python path
 sys.path.insert(0, str(Path(__file__).parent.parent.parent))
 
+from app.models import const
 from app.services import task as tm
+from app.services import state as sm
+from app.services import video
+from app.services.utils import song_index
 from app.models.schema import MaterialInfo, VideoParams
+from app.utils import utils
 
 resources_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "resources")
 
@@ -60,7 +71,239 @@ class TestTaskService(unittest.TestCase):
         )
         result = tm.start(task_id=task_id, params=params)
         print(result)
-    
+
+    def test_promote_preview(self):
+        task_id = "00000000-0000-0000-0000-000000000001"
+        task_dir = utils.task_dir(task_id)
+        self.addCleanup(shutil.rmtree, task_dir, ignore_errors=True)
+
+        materials = []
+        for i, color in enumerate([(255, 0, 0), (0, 0, 255)]):
+            clip = ColorClip(size=(320, 240), color=color).with_duration(2)
+            materials.append(os.path.join(task_dir, f"material-{i}.mp4"))
+            clip.write_videofile(materials[-1], fps=10, logger=None)
+        audio_file = os.path.join(task_dir, "audio.mp3")
+        AudioClip(lambda t: np.sin(2 * np.pi * 440 * t) * 0.1, duration=3, fps=22050).write_audiofile(audio_file, logger=None)
+
+        params = VideoParams(
+            video_subject="test",
+            video_aspect="1:1",
+            video_concat_mode="random",
+            video_transition_mode="Shuffle",
+            video_clip_duration=2,
+            video_preview=True,
+            subtitle_enabled=False,
+            bgm_type="",
+        )
+        seed = 1
+        tm.save_script_data(task_id, "script", [], params, seed)
+        preview_videos, _, _ = tm.generate_final_videos(task_id, params, materials, audio_file, "", seed)
+        sm.state.update_task(
+            task_id,
+            state=const.TASK_STATE_COMPLETE,
+            progress=100,
+            videos=preview_videos,
+            materials=materials,
+            audio_file=audio_file,
+            subtitle_path="",
+            preview=True,
+        )
+
+        result = tm.promote(task_id)
+
+        self.assertEqual(result["preview_videos"], preview_videos)
+        preview_clip = VideoFileClip(preview_videos[0])
+        final_clip = VideoFileClip(result["videos"][0])
+        self.assertEqual(tuple(preview_clip.size), (360, 360))
+        self.assertEqual(preview_clip.fps, 15)
+        self.assertEqual(tuple(final_clip.size), (1080, 1080))
+        self.assertAlmostEqual(preview_clip.duration, final_clip.duration, delta=0.2)
+        preview_clip.close()
+        final_clip.close()
+        self.assertFalse(sm.state.get_task(task_id)["preview"])
+
+        # the promoted params are saved, a restyle renders the full resolution videos again
+        tm.restyle(task_id, {"font_size": 80})
+        final_clip = VideoFileClip(result["videos"][0])
+        self.assertEqual(tuple(final_clip.size), (1080, 1080))
+        final_clip.close()
+
+    def test_restyle(self):
+        task_id = "00000000-0000-0000-0000-000000000002"
+        task_dir = utils.task_dir(task_id)
+        self.addCleanup(shutil.rmtree, task_dir, ignore_errors=True)
+
+        clip = ColorClip(size=(320, 240), color=(0, 0, 255)).with_duration(3)
+        material = os.path.join(task_dir, "material-0.mp4")
+        clip.write_videofile(material, fps=10, logger=None)
+        audio_file = os.path.join(task_dir, "audio.mp3")
+        AudioClip(lambda t: np.sin(2 * np.pi * 440 * t) * 0.1, duration=3, fps=22050).write_audiofile(audio_file, logger=None)
+        subtitle_path = os.path.join(task_dir, "subtitle.srt")
+        with open(subtitle_path, "w", encoding="utf-8") as f:
+            f.write(utils.text_to_srt(1, "hello world", 0.5, 2.5))
+
+        params = VideoParams(
+            video_subject="test",
+            video_aspect="1:1",
+            video_concat_mode="random",
+            video_transition_mode="None",
+            video_clip_duration=3,
+            video_preview=True,
+            bgm_type="",
+            font_name="Charm-Regular.ttf",
+            font_size=40,
+        )
+        seed = 1
+        tm.save_script_data(task_id, "script", [], params, seed)
+        videos, combined_videos, _ = tm.generate_final_videos(task_id, params, [material], audio_file, subtitle_path, seed)
+        sm.state.update_task(
+            task_id,
+            state=const.TASK_STATE_COMPLETE,
+            progress=100,
+            videos=videos,
+            combined_videos=combined_videos,
+            audio_file=audio_file,
+            subtitle_path=subtitle_path,
+            preview=True,
+        )
+
+        def read_video(file_path):
+            clip = VideoFileClip(file_path)
+            frame = clip.get_frame(1.5).astype(int)
+            volume = np.abs(clip.audio.to_soundarray(fps=22050)).mean()
+            clip.close()
+            return frame, volume
+
+        frame, volume = read_video(videos[0])
+
+        # only the audio changes, the video stream is kept
+        tm.restyle(task_id, {"voice_volume": 0.5})
+        remixed_frame, remixed_volume = read_video(videos[0])
+        np.testing.assert_array_equal(remixed_frame, frame)
+        self.assertAlmostEqual(remixed_volume / volume, 0.5, delta=0.05)
+
+        # the subtitles are rendered again over the combined video
+        tm.restyle(task_id, {"font_size": 80})
+        restyled_frame, restyled_volume = read_video(videos[0])
+        self.assertGreater(np.abs(restyled_frame - frame).mean(), 0.5)
+        self.assertAlmostEqual(restyled_volume, remixed_volume, delta=remixed_volume * 0.05)
+
+        task = sm.state.get_task(task_id)
+        self.assertEqual(task["state"], const.TASK_STATE_COMPLETE)
+        self.assertEqual(task["videos"], videos)
+        with open(os.path.join(task_dir, "script.json"), "r", encoding="utf-8") as f:
+            saved_params = json.load(f)["params"]
+        self.assertEqual((saved_params["voice_volume"], saved_params["font_size"]), (0.5, 80))
+        files = sorted(os.listdir(task_dir))
+        self.assertEqual(
+            [f for f in files if "-mix-" not in f],
+            ["audio.mp3", "combined-1.mp4", "material-0.mp4", "preview-1.mp4", "script.json", "subtitle.srt", "timeline-1.json"],
+        )
+        # one mix per voice volume, the last restyle reused the mix of the previous one
+        self.assertEqual(len([f for f in files if f.startswith("audio-mix-")]), 2)
+
+        # a render that fails half way keeps the previous video and fails the task
+        def failed_render(output_file, **kwargs):
+            with open(output_file, "wb") as f:
+                f.write(b"partial")
+            raise IOError("render failed")
+
+        with mock.patch.object(video, "generate_video", side_effect=failed_render):
+            self.assertIsNone(tm.restyle(task_id, {"font_size": 60}))
+        np.testing.assert_array_equal(read_video(videos[0])[0], restyled_frame)
+        task = sm.state.get_task(task_id)
+        self.assertEqual(task["state"], const.TASK_STATE_FAILED)
+        self.assertEqual(task["videos"], videos)
+        self.assertEqual(sorted(os.listdir(task_dir)), files)
+
+    def test_transition_task(self):
+        state = sm.MemoryState()
+        task_id = "00000000-0000-0000-0000-000000000004"
+        self.assertFalse(state.transition_task(task_id, const.TASK_STATE_COMPLETE, const.TASK_STATE_PROCESSING))
+
+        state.update_task(task_id, state=const.TASK_STATE_COMPLETE, progress=100, videos=["final-1.mp4"])
+        # only the first of two concurrent requests claims the task, the results are kept
+        self.assertTrue(state.transition_task(task_id, const.TASK_STATE_COMPLETE, const.TASK_STATE_PROCESSING))
+        self.assertFalse(state.transition_task(task_id, const.TASK_STATE_COMPLETE, const.TASK_STATE_PROCESSING))
+        self.assertEqual(
+            state.get_task(task_id),
+            {"task_id": task_id, "state": const.TASK_STATE_PROCESSING, "progress": 100, "videos": ["final-1.mp4"]},
+        )
+
+
+    def test_restyle_keeps_random_bgm(self):
+        task_id = "00000000-0000-0000-0000-000000000003"
+        task_dir = utils.task_dir(task_id)
+        self.addCleanup(shutil.rmtree, task_dir, ignore_errors=True)
+        song_dir = os.path.join(task_dir, "songs")
+        os.makedirs(song_dir)
+        for i in range(5):
+            AudioClip(lambda t, i=i: np.sin(2 * np.pi * (220 + i * 110) * t) * 0.1, duration=1, fps=22050).write_audiofile(
+                os.path.join(song_dir, f"song-{i}.mp3"), logger=None
+            )
+        index_file = os.path.join(task_dir, "songs.json")
+        for p in [
+            mock.patch.object(song_index.utils, "song_dir", lambda: song_dir),
+            mock.patch.object(song_index, "index_file", lambda: index_file),
+            mock.patch.object(song_index, "_index", None),
+            mock.patch.object(song_index, "_last_scan", None),
+            mock.patch.object(song_index, "refresh_in_background", lambda: song_index.refresh(wait=False)),
+        ]:
+            p.start()
+            self.addCleanup(p.stop)
+
+        clip = ColorClip(size=(320, 240), color=(0, 0, 255)).with_duration(3)
+        material = os.path.join(task_dir, "material-0.mp4")
+        clip.write_videofile(material, fps=10, logger=None)
+        audio_file = os.path.join(task_dir, "audio.mp3")
+        AudioClip(lambda t: np.sin(2 * np.pi * 440 * t) * 0.1, duration=3, fps=22050).write_audiofile(audio_file, logger=None)
+
+        params = VideoParams(
+            video_subject="test",
+            video_aspect="1:1",
+            video_concat_mode="random",
+            video_transition_mode="Shuffle",
+            video_clip_duration=3,
+            video_preview=True,
+            subtitle_enabled=False,
+            bgm_type="random",
+        )
+        mixed_bgm_files = []
+        get_bgm_file = video.get_bgm_file
+
+        def spy_get_bgm_file(*args, **kwargs):
+            mixed_bgm_files.append(get_bgm_file(*args, **kwargs))
+            return mixed_bgm_files[-1]
+
+        for seed in range(3):
+            bgm_files = tm.resolve_bgm_files(params, seed)
+            tm.save_script_data(task_id, "script", [], params, seed, bgm_files)
+            with mock.patch.object(video, "get_bgm_file", side_effect=spy_get_bgm_file):
+                videos, combined_videos, _ = tm.generate_final_videos(task_id, params, [material], audio_file, "", seed, bgm_files)
+                sm.state.update_task(
+                    task_id,
+                    state=const.TASK_STATE_COMPLETE,
+                    progress=100,
+                    videos=videos,
+                    combined_videos=combined_videos,
+                    audio_file=audio_file,
+                    subtitle_path="",
+                    preview=True,
+                )
+                # a video and an audio only restyle both keep the song of the render
+                tm.restyle(task_id, {"subtitle_enabled": True})
+                tm.restyle(task_id, {"bgm_volume": 0.5})
+            self.assertEqual(set(mixed_bgm_files), {bgm_files[0]})
+            mixed_bgm_files.clear()
+            with open(os.path.join(task_dir, "script.json"), "r", encoding="utf-8") as f:
+                self.assertEqual(json.load(f)["bgm_files"], bgm_files)
+
+        # a new bgm_file replaces the song
+        other_file = os.path.join(song_dir, "song-0.mp3" if bgm_files[0].endswith("song-1.mp3") else "song-1.mp3")
+        tm.restyle(task_id, {"bgm_file": other_file})
+        with open(os.path.join(task_dir, "script.json"), "r", encoding="utf-8") as f:
+            self.assertEqual(json.load(f)["bgm_files"], [other_file])
+
 
 if __name__ == "__main__":
-    unittest.main() 
\ No newline at end of file
+    unittest.main()
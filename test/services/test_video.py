@@ -1,19 +1,58 @@
 
+import json
+import random
+import re
 import unittest
 import os
+import shutil
+import subprocess
 import sys
+import tempfile
 from pathlib import Path
+from unittest import mock
+
+import numpy as np
 from moviepy import (
+    AudioClip,
+    ColorClip,
+    CompositeVideoClip,
+    ImageClip,
+    VideoClip,
     VideoFileClip,
 )
+from moviepy.config import FFMPEG_BINARY
 # add project root to python path
 sys.path.insert(0, str(Path(__file__).parent.parent.parent))
-from app.models.schema import MaterialInfo
+from app.models.schema import (
+    MaterialInfo,
+    VideoAspect,
+    VideoConcatMode,
+    VideoParams,
+    VideoRenderMode,
+    VideoTransitionMode,
+)
 from app.services import video as vd
+from app.services.utils import media_probe, video_effects
 from app.utils import utils
 
 resources_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "resources")
 
+
+def make_color_video(file_path, size, duration, color=(255, 0, 0)):
+    clip = ColorClip(size=size, color=color).with_duration(duration)
+    clip.write_videofile(file_path, fps=10, codec="libx264", logger=None)
+    clip.close()
+    return file_path
+
+
+def make_tone_audio(file_path, duration):
+    clip = AudioClip(
+        lambda t: np.sin(2 * np.pi * 440 * t) * 0.1, duration=duration, fps=22050
+    )
+    clip.write_audiofile(file_path, logger=None)
+    clip.close()
+    return file_path
+
 class TestVideoService(unittest.TestCase):
     def setUp(self):
         self.test_img_path = os.path.join(resources_dir, "1.png")
@@ -81,5 +120,639 @@ class TestVideoService(unittest.TestCase):
         except Exception as e:
             self.fail(f"test wrap_text failed: {str(e)}")
 
+    def test_encoding_profiles(self):
+        draft = vd.get_encoding_profile("draft")
+        self.assertEqual(draft["preset"], "ultrafast")
+        self.assertEqual(vd.get_encoding_profile("unknown")["name"], "standard")
+
+        # intermediates keep the fps of the final profile
+        intermediate = vd.get_intermediate_encoding_profile(draft)
+        self.assertEqual(intermediate["fps"], draft["fps"])
+        self.assertLess(intermediate["crf"], draft["crf"])
+
+        write_params = vd.encoding_write_params(draft)
+        self.assertEqual(write_params["fps"], 24)
+        self.assertEqual(write_params["preset"], "ultrafast")
+        self.assertEqual(write_params["ffmpeg_params"], ["-crf", "28", "-g", "48", "-tune", "fastdecode"])
+
+    def test_fit_to_frame(self):
+        image = np.random.RandomState(0).randint(0, 256, (240, 320, 3), dtype=np.uint8)
+        clip = ImageClip(image).with_duration(1)
+
+        fitted = video_effects.fit_to_frame(clip, 180, 320)
+        frame = fitted.get_frame(0)
+        self.assertEqual(tuple(fitted.size), (180, 320))
+        self.assertEqual(frame.shape, (320, 180, 3))
+        # letterbox bars above and below the 180x135 picture
+        self.assertEqual(frame[:92].max(), 0)
+        self.assertEqual(frame[92 + 135 :].max(), 0)
+
+        # same frame as resizing the clip over a black background
+        background = ColorClip(size=(180, 320), color=(0, 0, 0)).with_duration(1)
+        composite = CompositeVideoClip([background, clip.resized(new_size=(180, 135)).with_position("center")])
+        np.testing.assert_array_equal(frame, composite.get_frame(0))
+
+
+class TestCombineVideos(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        # keep the shared clip cache out of the storage directory
+        self.cache_dir = vd.clip_cache.cache_dir
+        vd.clip_cache.cache_dir = os.path.join(self.temp_dir, "cache_clips")
+
+    def tearDown(self):
+        vd.clip_cache.cache_dir = self.cache_dir
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_combine_videos_single_pass(self):
+        video_paths = [
+            make_color_video(os.path.join(self.temp_dir, f"src-{i}.mp4"), (320, 240), 2, color)
+            for i, color in enumerate([(255, 0, 0), (0, 255, 0), (0, 0, 255)])
+        ]
+        audio_file = make_tone_audio(os.path.join(self.temp_dir, "audio.wav"), 5)
+        combined_video_path = os.path.join(self.temp_dir, "combined-1.mp4")
+
+        vd.combine_videos(
+            combined_video_path=combined_video_path,
+            video_paths=video_paths,
+            audio_file=audio_file,
+            video_aspect=VideoAspect.square,
+            video_concat_mode=VideoConcatMode.sequential,
+            video_transition_mode=VideoTransitionMode.none,
+            max_clip_duration=2,
+        )
+
+        clip = VideoFileClip(combined_video_path)
+        self.assertEqual(tuple(clip.size), VideoAspect.square.to_resolution())
+        # the last clip is cut at the end of the audio
+        self.assertAlmostEqual(clip.duration, 5, delta=0.2)
+        clip.close()
+
+        # temp clips must be cleaned up after merging
+        leftovers = [f for f in os.listdir(self.temp_dir) if f.startswith("temp-")]
+        self.assertEqual(leftovers, [])
+
+    def test_combine_videos_preview_short_tail(self):
+        video_paths = [
+            make_color_video(os.path.join(self.temp_dir, f"src-{i}.mp4"), (320, 240), 2, color)
+            for i, color in enumerate([(255, 0, 0), (0, 255, 0)])
+        ]
+        # the tail after the two clips is longer than a frame at 30 fps, but shorter than one at 15 fps
+        audio_file = make_tone_audio(os.path.join(self.temp_dir, "audio.wav"), 4.05)
+        combined_video_path = os.path.join(self.temp_dir, "combined-1.mp4")
+        timeline_file = os.path.join(self.temp_dir, "timeline-1.json")
+
+        with mock.patch.object(vd, "merge_videos_progressively", wraps=vd.merge_videos_progressively) as merge:
+            vd.combine_videos(
+                combined_video_path=combined_video_path,
+                video_paths=video_paths,
+                audio_file=audio_file,
+                video_aspect=VideoAspect.square,
+                video_concat_mode=VideoConcatMode.sequential,
+                video_transition_mode=VideoTransitionMode.none,
+                max_clip_duration=2,
+                encoding_profile="preview",
+                preview=True,
+                timeline_file=timeline_file,
+            )
+            # the clips are joined in a single pass
+            merge.assert_not_called()
+
+        with open(timeline_file, "r", encoding="utf-8") as f:
+            self.assertEqual([entry["out"] - entry["in"] for entry in json.load(f)], [2, 2])
+        clip = VideoFileClip(combined_video_path)
+        self.assertAlmostEqual(clip.duration, 4, delta=0.1)
+        clip.close()
+
+    def test_plan_timeline(self):
+        video_paths = [
+            make_color_video(os.path.join(self.temp_dir, f"src-{i}.mp4"), (320, 240), 3, color)
+            for i, color in enumerate([(255, 0, 0), (0, 255, 0)])
+        ]
+        jobs = vd.plan_subclip_jobs(
+            video_paths=video_paths,
+            output_dir=self.temp_dir,
+            video_aspect=VideoAspect.square,
+            video_concat_mode=VideoConcatMode.sequential,
+            video_transition_mode=VideoTransitionMode.slide_in,
+            max_clip_duration=2,
+        )
+
+        timeline = vd.plan_timeline(jobs, audio_duration=7)
+
+        # the two sub-clips are looped, the last one is cut at the end of the audio
+        self.assertEqual([entry["duration"] for entry in timeline], [2, 2, 2, 1])
+        self.assertEqual([entry["start"] for entry in timeline], [0, 2, 4, 6])
+        self.assertIs(timeline[2]["job"], timeline[0]["job"])
+        self.assertTrue(timeline[3]["job"]["clip_file"].endswith("-tail-1000.mp4"))
+        # nothing is rendered while planning
+        self.assertFalse(any(f.startswith("temp-") for f in os.listdir(self.temp_dir)))
+
+        timeline_file = os.path.join(self.temp_dir, "timeline-1.json")
+        vd.save_timeline(timeline, timeline_file)
+        with open(timeline_file, "r", encoding="utf-8") as f:
+            edl = json.load(f)
+        self.assertEqual(edl[3]["source"], video_paths[1])
+        self.assertEqual((edl[3]["in"], edl[3]["out"]), (0, 1))
+        self.assertEqual((edl[3]["transition"], edl[3]["slot"]), ("SlideIn", 4))
+
+    def test_combine_video_variants(self):
+        video_paths = [
+            make_color_video(os.path.join(self.temp_dir, f"src-{i}.mp4"), (320, 240), 4, color)
+            for i, color in enumerate([(255, 0, 0), (0, 255, 0)])
+        ]
+        audio_file = make_tone_audio(os.path.join(self.temp_dir, "audio.wav"), 5)
+        combined_video_paths = [os.path.join(self.temp_dir, f"combined-{i+1}.mp4") for i in range(3)]
+
+        with mock.patch.object(vd, "process_subclip", wraps=vd.process_subclip) as process_subclip:
+            vd.combine_video_variants(
+                combined_video_paths=combined_video_paths,
+                video_paths=video_paths,
+                audio_file=audio_file,
+                video_aspect=VideoAspect.square,
+                video_transition_mode=VideoTransitionMode.none,
+                max_clip_duration=2,
+                rngs=[random.Random(f"seed-{i}") for i in range(3)],
+            )
+
+        # every sub-clip of the shared pool is encoded at most once for all variants
+        clip_files = [call.kwargs["clip_file"] for call in process_subclip.call_args_list]
+        self.assertEqual(len(clip_files), len(set(clip_files)))
+        for combined_video_path in combined_video_paths:
+            clip = VideoFileClip(combined_video_path)
+            self.assertAlmostEqual(clip.duration, 5, delta=0.2)
+            clip.close()
+        leftovers = [f for f in os.listdir(self.temp_dir) if f.startswith("temp-")]
+        self.assertEqual(leftovers, [])
+
+    def test_combine_videos_keyframe_cuts(self):
+        # a material at the output resolution and fps, with a keyframe every 1.5s
+        copy_source = os.path.join(self.temp_dir, "src-copy.mp4")
+        clip = ColorClip(size=(1080, 1080), color=(255, 0, 0)).with_duration(6)
+        clip.write_videofile(copy_source, fps=30, codec="libx264", logger=None, ffmpeg_params=["-g", "45"])
+        clip.close()
+        encode_source = make_color_video(os.path.join(self.temp_dir, "src-encode.mp4"), (320, 240), 2, (0, 0, 255))
+        audio_file = make_tone_audio(os.path.join(self.temp_dir, "audio.wav"), 6)
+        combined_video_path = os.path.join(self.temp_dir, "combined-1.mp4")
+
+        jobs = vd.plan_subclip_jobs(
+            video_paths=[copy_source],
+            output_dir=self.temp_dir,
+            video_aspect=VideoAspect.square,
+            video_concat_mode=VideoConcatMode.random,
+            max_clip_duration=2,
+            cut_mode="keyframe",
+        )
+        self.assertEqual([job["subclipped_item"].start_time for job in sorted(jobs, key=lambda job: job["subclipped_item"].start_time)], [0, 3])
+        self.assertTrue(all(job["stream_copy"] for job in jobs))
+
+        # a material of another resolution has to be encoded, the sub-clips of the join are all encoded with it
+        mixed_jobs = vd.plan_subclip_jobs(
+            video_paths=[copy_source, encode_source],
+            output_dir=self.temp_dir,
+            video_aspect=VideoAspect.square,
+            video_concat_mode=VideoConcatMode.random,
+            max_clip_duration=2,
+            cut_mode="keyframe",
+        )
+        self.assertFalse(any(job["stream_copy"] for job in mixed_jobs))
+
+        for video_paths, encoded in [([copy_source], set()), ([copy_source, encode_source], {copy_source, encode_source})]:
+            with mock.patch.dict(vd.config.app, {"subclip_cut_mode": "keyframe"}), mock.patch.object(
+                vd, "build_subclip", wraps=vd.build_subclip
+            ) as build_subclip:
+                vd.combine_videos(
+                    combined_video_path=combined_video_path,
+                    video_paths=video_paths,
+                    audio_file=audio_file,
+                    video_aspect=VideoAspect.square,
+                    video_concat_mode=VideoConcatMode.random,
+                    video_transition_mode=VideoTransitionMode.none,
+                    max_clip_duration=2,
+                    rng=random.Random(1),
+                )
+
+            self.assertEqual({call.args[0].file_path for call in build_subclip.call_args_list}, encoded)
+            # the joined clips decode to the right colors, without a frame lost at the joins
+            clip = VideoFileClip(combined_video_path)
+            self.assertEqual(tuple(clip.size), (1080, 1080))
+            self.assertAlmostEqual(clip.duration, 6, delta=0.05)
+            frames = list(clip.iter_frames())
+            self.assertEqual(len(frames), 180)
+            colors = {tuple(int(c) for c in np.round(frame[540, 540] / 255)) for frame in frames[::6]}
+            self.assertEqual(colors, {(1, 0, 0), (0, 0, 1)} if encoded else {(1, 0, 0)})
+            clip.close()
+
+    def test_combine_videos_keyframe_cuts_of_mixed_materials(self):
+        # two materials at the output resolution and fps, a baseline one and a high profile one with b-frames
+        video_paths = []
+        for name, color, ffmpeg_params in [
+            ("baseline", (255, 0, 0), ["-g", "45", "-profile:v", "baseline"]),
+            ("high", (0, 0, 255), ["-g", "45", "-profile:v", "high", "-bf", "3"]),
+        ]:
+            video_path = os.path.join(self.temp_dir, f"src-{name}.mp4")
+            clip = ColorClip(size=(1080, 1080), color=color).with_duration(6)
+            clip.write_videofile(video_path, fps=30, codec="libx264", logger=None, ffmpeg_params=ffmpeg_params)
+            clip.close()
+            video_paths.append(video_path)
+        audio_file = make_tone_audio(os.path.join(self.temp_dir, "audio.wav"), 8)
+        combined_video_path = os.path.join(self.temp_dir, "combined-1.mp4")
+
+        def plan(paths):
+            return vd.plan_subclip_jobs(
+                video_paths=paths,
+                output_dir=self.temp_dir,
+                video_aspect=VideoAspect.square,
+                video_concat_mode=VideoConcatMode.random,
+                max_clip_duration=2,
+                cut_mode="keyframe",
+            )
+
+        # each material is copied on its own, not joined with the other one
+        for video_path in video_paths:
+            self.assertTrue(all(job["stream_copy"] for job in plan([video_path])))
+        self.assertFalse(any(job["stream_copy"] for job in plan(video_paths)))
+
+        with mock.patch.dict(vd.config.app, {"subclip_cut_mode": "keyframe"}):
+            vd.combine_videos(
+                combined_video_path=combined_video_path,
+                video_paths=video_paths,
+                audio_file=audio_file,
+                video_aspect=VideoAspect.square,
+                video_concat_mode=VideoConcatMode.random,
+                video_transition_mode=VideoTransitionMode.none,
+                max_clip_duration=2,
+                rng=random.Random(1),
+            )
+
+        infos = media_probe.read_infos(combined_video_path)
+        self.assertEqual(infos["fps"], 30)
+        self.assertAlmostEqual(infos["duration"], 8, delta=0.02)
+        clip = VideoFileClip(combined_video_path)
+        self.assertEqual(len(list(clip.iter_frames())), 240)
+        clip.close()
+
+    def test_process_subclips_parallel(self):
+        video_path = make_color_video(os.path.join(self.temp_dir, "src.mp4"), (320, 240), 4)
+        jobs = []
+        for i in range(4):
+            jobs.append(
+                {
+                    "subclipped_item": vd.SubClippedVideoClip(file_path=video_path, start_time=i, end_time=i + 1),
+                    "clip_file": os.path.join(self.temp_dir, f"temp-clip-{i+1}.mp4"),
+                    "video_width": 240,
+                    "video_height": 240,
+                    "transition": VideoTransitionMode.none,
+                    "side": "left",
+                    "max_clip_duration": 1,
+                }
+            )
+        # a missing source must be skipped without failing the other clips
+        jobs[1]["subclipped_item"] = vd.SubClippedVideoClip(file_path=os.path.join(self.temp_dir, "missing.mp4"), start_time=0, end_time=1)
+
+        processed_clips = vd.process_subclips(jobs, audio_duration=2.5, workers=2)
+
+        self.assertEqual(
+            [os.path.basename(clip.file_path) for clip in processed_clips],
+            ["temp-clip-1.mp4", "temp-clip-3.mp4", "temp-clip-4.mp4"],
+        )
+
+    def test_process_subclips_reuses_cached_clips(self):
+        video_path = make_color_video(os.path.join(self.temp_dir, "src.mp4"), (320, 240), 2)
+        job = {
+            "subclipped_item": vd.SubClippedVideoClip(file_path=video_path, start_time=0, end_time=1),
+            "clip_file": os.path.join(self.temp_dir, "temp-clip-1.mp4"),
+            "video_width": 240,
+            "video_height": 240,
+            "transition": VideoTransitionMode.fade_in,
+            "side": "left",
+            "max_clip_duration": 1,
+        }
+        hits = vd.clip_cache.stats()["hits"]
+
+        first = vd.process_subclips([job], audio_duration=1, workers=1)
+        os.remove(first[0].file_path)
+        second = vd.process_subclips([job], audio_duration=1, workers=1)
+
+        self.assertEqual(vd.clip_cache.stats()["hits"], hits + 1)
+        self.assertTrue(os.path.exists(second[0].file_path))
+        self.assertAlmostEqual(second[0].duration, first[0].duration)
+
+    def test_leftover_clip_does_not_change_cached_clip(self):
+        red = make_color_video(os.path.join(self.temp_dir, "red.mp4"), (320, 240), 1, (255, 0, 0))
+        blue = make_color_video(os.path.join(self.temp_dir, "blue.mp4"), (320, 240), 1, (0, 0, 255))
+        clip_file = os.path.join(self.temp_dir, "temp-clip-1.mp4")
+
+        def make_job(video_path):
+            return {
+                "subclipped_item": vd.SubClippedVideoClip(file_path=video_path, start_time=0, end_time=1),
+                "clip_file": clip_file,
+                "video_width": 240,
+                "video_height": 240,
+                "transition": VideoTransitionMode.none,
+                "side": "",
+                "max_clip_duration": 1,
+            }
+
+        def center_color(file_path):
+            clip = VideoFileClip(file_path)
+            color = tuple(int(c) for c in np.round(clip.get_frame(0)[120, 120] / 255))
+            clip.close()
+            return color
+
+        # the red clip is cached, and left over at clip_file
+        vd.process_subclips([make_job(red)], workers=1)
+        # another run renders a blue clip at the same temp path
+        vd.process_subclips([make_job(blue)], workers=1)
+        self.assertEqual(center_color(clip_file), (0, 0, 1))
+
+        os.remove(clip_file)
+        hits = vd.clip_cache.stats()["hits"]
+        vd.process_subclips([make_job(red)], workers=1)
+        self.assertEqual(vd.clip_cache.stats()["hits"], hits + 1)
+        self.assertEqual(center_color(clip_file), (1, 0, 0))
+        self.assertEqual([f for f in os.listdir(self.temp_dir) if ".part" in f or f.endswith(".tmp")], [])
+
+    def test_generate_video_fused(self):
+        video_paths = [
+            make_color_video(os.path.join(self.temp_dir, f"src-{i}.mp4"), (320, 240), 2, color)
+            for i, color in enumerate([(255, 0, 0), (0, 255, 0)])
+        ]
+        audio_file = make_tone_audio(os.path.join(self.temp_dir, "audio.mp3"), 3)
+        subtitle_file = os.path.join(self.temp_dir, "subtitle.srt")
+        with open(subtitle_file, "w", encoding="utf-8") as f:
+            f.write(utils.text_to_srt(1, "hello world", 0.5, 2.0))
+        output_file = os.path.join(self.temp_dir, "final-1.mp4")
+        params = VideoParams(
+            video_subject="test",
+            video_aspect=VideoAspect.square,
+            video_transition_mode=VideoTransitionMode.fade_in,
+            video_clip_duration=2,
+            video_render_mode=VideoRenderMode.fused,
+            bgm_type="",
+            font_name="Charm-Regular.ttf",
+            font_size=40,
+        )
+
+        vd.generate_video_fused(
+            video_paths=video_paths,
+            audio_path=audio_file,
+            subtitle_path=subtitle_file,
+            output_file=output_file,
+            params=params,
+            video_concat_mode=VideoConcatMode.sequential,
+        )
+
+        clip = VideoFileClip(output_file)
+        self.assertEqual(tuple(clip.size), VideoAspect.square.to_resolution())
+        self.assertAlmostEqual(clip.duration, 3, delta=0.2)
+        self.assertIsNotNone(clip.audio)
+        clip.close()
+        # no intermediate file is written in the fused mode
+        self.assertEqual(
+            sorted(f for f in os.listdir(self.temp_dir) if f.endswith(".mp4")),
+            ["final-1.mp4", "src-0.mp4", "src-1.mp4"],
+        )
+
+
+def make_gradient_video(file_path, size, duration):
+    width, height = size
+    x = np.linspace(0, 255, width)[None, :, None]
+    clip = VideoClip(
+        lambda t: np.broadcast_to((x + t * 50) % 256, (height, width, 3)).astype("uint8"),
+        duration=duration,
+    )
+    clip.write_videofile(file_path, fps=30, codec="libx264", logger=None)
+    clip.close()
+    return file_path
+
+
+class TestRenderBackends(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_ffmpeg_backend_matches_moviepy(self):
+        # landscape and portrait materials, so both are letterboxed into the square frame
+        video_paths = [
+            make_gradient_video(os.path.join(self.temp_dir, "src-0.mp4"), (320, 240), 3),
+            make_gradient_video(os.path.join(self.temp_dir, "src-1.mp4"), (240, 320), 3),
+        ]
+        audio_file = make_tone_audio(os.path.join(self.temp_dir, "audio.mp3"), 5)
+        bgm_file = make_tone_audio(os.path.join(self.temp_dir, "bgm.mp3"), 4)
+        subtitle_file = os.path.join(self.temp_dir, "subtitle.srt")
+        with open(subtitle_file, "w", encoding="utf-8") as f:
+            f.write(utils.text_to_srt(1, "hello world", 0.5, 2.0) + "\n")
+            f.write(utils.text_to_srt(2, "second line", 2.5, 4.0))
+        params = VideoParams(
+            video_subject="test",
+            video_aspect=VideoAspect.square,
+            video_clip_duration=2,
+            video_preview=True,
+            bgm_type="random",
+            bgm_file=bgm_file,
+            font_name="Charm-Regular.ttf",
+            font_size=60,
+        )
+
+        for transition in [VideoTransitionMode.fade_in, VideoTransitionMode.fade_out]:
+            jobs = vd.plan_subclip_jobs(
+                video_paths=video_paths,
+                output_dir=self.temp_dir,
+                video_aspect=params.video_aspect,
+                video_concat_mode=VideoConcatMode.sequential,
+                video_transition_mode=transition,
+                max_clip_duration=2,
+                preview=True,
+            )
+            timeline = vd.plan_timeline(jobs, audio_duration=5)
+
+            clips = {}
+            for name in ["moviepy", "ffmpeg"]:
+                output_file = os.path.join(self.temp_dir, f"{name}.mp4")
+                vd.get_render_backend(name).render(timeline, audio_file, subtitle_file, output_file, params)
+                clips[name] = VideoFileClip(output_file)
+
+            expected, actual = clips["moviepy"], clips["ffmpeg"]
+            self.assertEqual(tuple(actual.size), tuple(expected.size))
+            self.assertEqual(actual.fps, expected.fps)
+            self.assertAlmostEqual(actual.duration, expected.duration, delta=0.1)
+            for t in [0.1, 0.7, 1.5, 2.5, 3.0, 4.5]:
+                diff = np.abs(actual.get_frame(t).astype(int) - expected.get_frame(t).astype(int)).mean()
+                self.assertLess(diff, 5, f"{transition.value} frame at {t}s differs by {diff:.2f}")
+            expected_rms = np.sqrt(np.mean(expected.audio.to_soundarray(fps=22050) ** 2))
+            actual_rms = np.sqrt(np.mean(actual.audio.to_soundarray(fps=22050) ** 2))
+            self.assertGreater(expected_rms, 0.01)
+            self.assertAlmostEqual(actual_rms, expected_rms, delta=expected_rms * 0.1)
+            for clip in clips.values():
+                clip.close()
+
+    def test_render_timeline_in_segments(self):
+        video_path = make_gradient_video(os.path.join(self.temp_dir, "src.mp4"), (320, 240), 6)
+        audio_file = make_tone_audio(os.path.join(self.temp_dir, "audio.mp3"), 6)
+        subtitle_file = os.path.join(self.temp_dir, "subtitle.srt")
+        with open(subtitle_file, "w", encoding="utf-8") as f:
+            # shown across the boundary of the first two segments
+            f.write(utils.text_to_srt(1, "hello world", 1.0, 3.0))
+        params = VideoParams(
+            video_subject="test",
+            video_aspect=VideoAspect.square,
+            video_preview=True,
+            bgm_type="",
+            font_name="Charm-Regular.ttf",
+            font_size=60,
+        )
+        # one long slot, as in the standard mode, is cut into segments
+        timeline = [
+            {
+                "slot": 1,
+                "start": 0,
+                "duration": 6,
+                "job": {
+                    "subclipped_item": vd.SubClippedVideoClip(file_path=video_path, start_time=0, end_time=6, width=320, height=240),
+                    "clip_file": video_path,
+                    "video_width": 360,
+                    "video_height": 360,
+                    "transition": VideoTransitionMode.none,
+                    "side": "",
+                    "max_clip_duration": 6,
+                },
+            }
+        ]
+        segments = vd.split_timeline(timeline, 3, 15)
+        self.assertEqual([[entry["duration"] for entry in segment] for segment in segments], [[2], [2], [2]])
+        self.assertEqual(segments[2][0]["job"]["subclipped_item"].start_time, 4)
+
+        expected_file = os.path.join(self.temp_dir, "expected.mp4")
+        vd.render_timeline(timeline, audio_file, subtitle_file, expected_file, params)
+        output_file = os.path.join(self.temp_dir, "final-1.mp4")
+        with mock.patch.dict(vd.config.app, {"render_segments": 3}):
+            vd.render_timeline(timeline, audio_file, subtitle_file, output_file, params)
+
+        expected, actual = VideoFileClip(expected_file), VideoFileClip(output_file)
+        self.assertAlmostEqual(actual.duration, expected.duration, delta=0.1)
+        self.assertIsNotNone(actual.audio)
+        for t in [0.5, 1.5, 2.5, 3.5, 5.5]:
+            diff = np.abs(actual.get_frame(t).astype(int) - expected.get_frame(t).astype(int)).mean()
+            self.assertLess(diff, 3, f"frame at {t}s differs by {diff:.2f}")
+        expected.close()
+        actual.close()
+        files = sorted(os.listdir(self.temp_dir))
+        self.assertEqual([f for f in files if "-mix-" not in f], ["audio.mp3", "expected.mp4", "final-1.mp4", "src.mp4", "subtitle.srt"])
+        # both renders copied the same mixed audio track
+        self.assertEqual(len([f for f in files if f.startswith("audio-mix-")]), 1)
+
+    def test_subtitle_modes(self):
+        # the combined video of a preview, at the resolution and fps of the final profile
+        video_path = os.path.join(self.temp_dir, "combined-1.mp4")
+        x = np.linspace(0, 255, 360)[None, :, None]
+        clip = VideoClip(lambda t: np.broadcast_to((x + t * 50) % 256, (360, 360, 3)).astype("uint8"), duration=3)
+        clip.write_videofile(video_path, fps=15, codec="libx264", logger=None)
+        clip.close()
+        audio_file = make_tone_audio(os.path.join(self.temp_dir, "audio.mp3"), 3)
+        subtitle_file = os.path.join(self.temp_dir, "subtitle.srt")
+        with open(subtitle_file, "w", encoding="utf-8") as f:
+            f.write(utils.text_to_srt(1, "hello world", 0.5, 2.5))
+
+        def has_subtitle_track(file_path):
+            proc = subprocess.run([FFMPEG_BINARY, "-hide_banner", "-i", file_path], capture_output=True)
+            return "Subtitle: mov_text" in proc.stderr.decode("utf-8", errors="ignore")
+
+        frames = {}
+        for mode in ["burn", "soft", "both"]:
+            params = VideoParams(
+                video_subject="test",
+                video_aspect=VideoAspect.square,
+                video_preview=True,
+                bgm_type="",
+                font_name="Charm-Regular.ttf",
+                font_size=60,
+                subtitle_mode=mode,
+            )
+            output_file = os.path.join(self.temp_dir, f"final-{mode}.mp4")
+            # the combined video is encoded with the final profile, so it can be copied as it is
+            with mock.patch.dict(vd.config.app, {"intermediate_encoding_profile": "preview"}):
+                vd.generate_video(video_path, audio_file, subtitle_file, output_file, params)
+            self.assertEqual(has_subtitle_track(output_file), mode != "burn")
+            output = VideoFileClip(output_file)
+            self.assertIsNotNone(output.audio)
+            frames[mode] = output.get_frame(1.5).astype(int)
+            output.close()
+
+        source = VideoFileClip(video_path)
+        # the soft mode copies the video stream, the frames are the ones of the combined video
+        np.testing.assert_array_equal(frames["soft"], source.get_frame(1.5))
+        source.close()
+        # the subtitles are drawn the same way with or without the text track
+        self.assertGreater(np.abs(frames["both"] - frames["soft"]).mean(), 0.5)
+        np.testing.assert_array_equal(frames["both"], frames["burn"])
+
+    def test_soft_subtitles_use_final_profile(self):
+        # a combined video encoded with the intermediate profile, at the resolution and fps of the final one
+        encoding = vd.get_intermediate_encoding_profile(vd.get_encoding_profile("preview"))
+        video_path = os.path.join(self.temp_dir, "combined-1.mp4")
+        clip = ColorClip(size=(360, 360), color=(255, 0, 0)).with_duration(2)
+        clip.write_videofile(video_path, logger=None, audio=False, **vd.encoding_write_params(encoding))
+        clip.close()
+        audio_file = make_tone_audio(os.path.join(self.temp_dir, "audio.mp3"), 2)
+        subtitle_file = os.path.join(self.temp_dir, "subtitle.srt")
+        with open(subtitle_file, "w", encoding="utf-8") as f:
+            f.write(utils.text_to_srt(1, "hello world", 0.5, 1.5))
+
+        def x264_options(file_path):
+            with open(file_path, "rb") as f:
+                options = re.search(rb"options: ([^\x00]*)", f.read()).group(1).decode()
+            return dict(option.split("=", 1) for option in options.split() if "=" in option)
+
+        params = VideoParams(
+            video_subject="test", video_aspect=VideoAspect.square, video_preview=True, bgm_type="", subtitle_mode="soft"
+        )
+        output_file = os.path.join(self.temp_dir, "final-1.mp4")
+        vd.generate_video(video_path, audio_file, subtitle_file, output_file, params)
+
+        # re-encoded with the preview profile, not copied with the crf of the intermediate one
+        final = vd.get_final_encoding_profile(params)
+        self.assertEqual(float(x264_options(video_path)["crf"]), encoding["crf"])
+        options = x264_options(output_file)
+        self.assertEqual(float(options["crf"]), final["crf"])
+        self.assertEqual(int(options["keyint"]), final["keyframe_interval"])
+        proc = subprocess.run([FFMPEG_BINARY, "-hide_banner", "-i", output_file], capture_output=True)
+        self.assertIn("Subtitle: mov_text", proc.stderr.decode("utf-8", errors="ignore"))
+
+    def test_remux_bgm_variant(self):
+        video_path = make_gradient_video(os.path.join(self.temp_dir, "src.mp4"), (320, 240), 3)
+        audio_file = make_tone_audio(os.path.join(self.temp_dir, "audio.mp3"), 2)
+        bgm_file = make_tone_audio(os.path.join(self.temp_dir, "bgm.mp3"), 1)
+        params = VideoParams(video_subject="test", video_aspect=VideoAspect.square, video_preview=True, bgm_type="")
+        final_file = os.path.join(self.temp_dir, "final-1.mp4")
+        vd.generate_video(video_path, audio_file, "", final_file, params)
+
+        variant_file = os.path.join(self.temp_dir, "final-1-bgm.mp4")
+        params.bgm_type, params.bgm_file, params.bgm_volume = "custom", bgm_file, 1.0
+        self.assertEqual(vd.remux_audio(final_file, audio_file, params, output_file=variant_file), variant_file)
+
+        final, variant = VideoFileClip(final_file), VideoFileClip(variant_file)
+        # the video stream is copied, only the audio has the looped bgm
+        self.assertAlmostEqual(variant.duration, final.duration, delta=0.05)
+        np.testing.assert_array_equal(variant.get_frame(1.5), final.get_frame(1.5))
+        final_audio = final.audio.to_soundarray(fps=22050)
+        variant_audio = variant.audio.to_soundarray(fps=22050)
+        # the voice ends at 2s, after it only the bgm is heard
+        self.assertLess(np.abs(final_audio[int(2.2 * 22050) :]).mean(), 0.001)
+        self.assertGreater(np.abs(variant_audio[int(2.2 * 22050) :]).mean(), 0.01)
+        final.close()
+        variant.close()
+        files = sorted(os.listdir(self.temp_dir))
+        self.assertEqual([f for f in files if "-mix-" not in f], ["audio.mp3", "bgm.mp3", "final-1-bgm.mp4", "final-1.mp4", "src.mp4"])
+        # a mix without and one with the bgm
+        self.assertEqual(len([f for f in files if f.startswith("audio-mix-")]), 2)
+
+    def test_get_render_backend(self):
+        self.assertEqual(vd.get_render_backend("ffmpeg").name, "ffmpeg")
+        self.assertEqual(vd.get_render_backend("unknown").name, "moviepy")
+
+
 if __name__ == "__main__":
     unittest.main() 
\ No newline at end of file